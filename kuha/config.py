@@ -1,3 +1,4 @@
+import os
 import re
 
 from lxml import etree
@@ -18,6 +19,10 @@ def clean_oai_settings(settings):
         repository_descriptions
         repository_name
         sqlalchemy.url
+    Optional settings are:
+        response_cache
+        response_cache_directory
+        response_cache_size
 
     Parameters
     ----------
@@ -36,9 +41,23 @@ def clean_oai_settings(settings):
         'logging_config': _clean_unicode,
         'repository_descriptions': _load_repository_descriptions,
         'repository_name': _clean_unicode,
+        'response_cache': _clean_response_cache,
+        'response_cache_directory': _clean_unicode,
+        'response_cache_size': _clean_size,
         'sqlalchemy.url': _clean_unicode,
     }
-    _clean_settings(settings, cleaners)
+    defaults = {
+        'response_cache': 'none',
+        'response_cache_directory': '',
+        'response_cache_size': '64MB',
+    }
+    _clean_settings(settings, cleaners, defaults)
+
+    if (settings['response_cache'] == 'file'
+            and not settings['response_cache_directory']):
+        raise ConfigurationError(
+            'missing setting response_cache_directory'
+        )
 
 
 def clean_importer_settings(settings):
@@ -54,6 +73,16 @@ def clean_importer_settings(settings):
         sqlalchemy.url
         timestamp_file
         metadata_provider_class
+    Optional settings are:
+        harvest_batch_interval
+        harvest_batch_size
+        harvest_worker_type
+        harvest_workers
+        watch
+        watch_delay
+        watch_method
+        watch_poll_interval
+        validation_schemas
 
     Parameters
     ----------
@@ -73,11 +102,31 @@ def clean_importer_settings(settings):
         'sqlalchemy.url': _clean_unicode,
         'timestamp_file': _clean_unicode,
         'metadata_provider_class': _clean_provider_class,
+        'harvest_batch_interval': _clean_batch_interval,
+        'harvest_batch_size': _clean_batch_size,
+        'harvest_worker_type': _clean_worker_type,
+        'harvest_workers': _clean_workers,
+        'watch': _clean_boolean,
+        'watch_delay': _clean_watch_delay,
+        'watch_method': _clean_watch_method,
+        'watch_poll_interval': _clean_poll_interval,
+        'validation_schemas': _clean_validation_schemas,
+    }
+    defaults = {
+        'harvest_batch_interval': '10',
+        'harvest_batch_size': '100',
+        'harvest_worker_type': 'process',
+        'harvest_workers': '0',
+        'watch': 'false',
+        'watch_delay': '2',
+        'watch_method': 'auto',
+        'watch_poll_interval': '5',
+        'validation_schemas': '',
     }
-    return _clean_settings(settings, cleaners)
+    return _clean_settings(settings, cleaners, defaults)
 
 
-def _clean_settings(settings, cleaners):
+def _clean_settings(settings, cleaners, defaults=None):
     """Check that settings are ok.
 
     The parameter `cleaners` is a dict from setting names to functions.
@@ -92,12 +141,19 @@ def _clean_settings(settings, cleaners):
         The settings dictionary.
     cleaners: dict from str to callable
         Mapping from setting names to cleaner functions.
+    defaults: dict from str to str or None
+        Values of optional settings. Missing settings are set to these
+        values before cleaning.
 
     Raises
     ------
     ConfigurationError:
         If any setting is missing or invalid.
     """
+    if defaults is not None:
+        for name, value in defaults.items():
+            settings.setdefault(name, value)
+
     for name, func in cleaners.items():
         if name not in settings:
             raise ConfigurationError('missing setting {0}'.format(name))
@@ -151,6 +207,111 @@ def _clean_item_list_limit(value):
     return int_value
 
 
+def _clean_batch_size(value):
+    """Check that value is a positive integer."""
+    int_value = int(value)
+    if int_value <= 0:
+        raise ValueError('harvest_batch_size must be positive')
+    return int_value
+
+
+def _clean_batch_interval(value):
+    """Return the value as a number of seconds, or None if it is 0."""
+    seconds = float(value)
+    if seconds < 0:
+        raise ValueError('harvest_batch_interval must not be negative')
+    return seconds if seconds > 0 else None
+
+
+def _clean_workers(value):
+    """Check that value is a non-negative integer."""
+    int_value = int(value)
+    if int_value < 0:
+        raise ValueError('harvest_workers must not be negative')
+    return int_value
+
+
+def _clean_worker_type(value):
+    """Check that value is one of "process", "thread"."""
+    allowed_values = ['process', 'thread']
+    if value not in allowed_values:
+        raise ValueError('harvest_worker_type must be one of {0}'.format(
+            allowed_values
+        ))
+    return str(value)
+
+
+def _clean_watch_delay(value):
+    """Check that value is a non-negative number of seconds."""
+    seconds = float(value)
+    if seconds < 0:
+        raise ValueError('watch_delay must not be negative')
+    return seconds
+
+
+def _clean_watch_method(value):
+    """Check that value is one of "auto", "inotify", "poll"."""
+    allowed_values = ['auto', 'inotify', 'poll']
+    if value not in allowed_values:
+        raise ValueError('watch_method must be one of {0}'.format(
+            allowed_values
+        ))
+    return str(value)
+
+
+def _clean_poll_interval(value):
+    """Check that value is a positive number of seconds."""
+    seconds = float(value)
+    if seconds <= 0:
+        raise ValueError('watch_poll_interval must be positive')
+    return seconds
+
+
+def _clean_validation_schemas(value):
+    """Parse lines of metadata prefixes and paths of XSD files."""
+    schemas = {}
+    for line in _clean_unicode(value).splitlines():
+        if not line.strip():
+            continue
+        try:
+            prefix, path = line.split()
+        except ValueError:
+            raise ValueError(
+                'expected a prefix and a path: {0}'.format(repr(line))
+            )
+        if not os.path.isfile(path):
+            raise ValueError('no such file: {0}'.format(repr(path)))
+        schemas[prefix] = path
+    return schemas
+
+
+def _clean_response_cache(value):
+    """Check that value is one of "none", "memory", "file"."""
+    allowed_values = ['none', 'memory', 'file']
+    if value not in allowed_values:
+        raise ValueError('response_cache must be one of {0}'.format(
+            allowed_values
+        ))
+    return str(value)
+
+
+def _clean_size(value):
+    """Parse a positive number of bytes with an optional unit.
+
+    The allowed units are KB, MB and GB, which are powers of 1024.
+    """
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    text = _clean_unicode(value).strip().upper()
+    multiplier = 1
+    if text[-2:] in units:
+        multiplier = units[text[-2:]]
+        text = text[:-2]
+    size = int(text) * multiplier
+    if size <= 0:
+        raise ValueError('size must be positive')
+    return size
+
+
 def _clean_unicode(value):
     """Return the value as a unicode."""
     if isinstance(value, bytes):
@@ -2,6 +2,7 @@ import errno
 import importlib
 import logging
 import os
+import signal
 import sys
 
 from pyramid.paster import get_appsettings, setup_logging
@@ -15,7 +16,9 @@ from ..util import (
     parse_date,
     format_datestamp,
 )
-from ..importer.harvest import update
+from ..importer.harvest import create_worker_pool, update
+from ..importer.validation import create_validator
+from ..importer.watch import start_watching, watch_directory
 
 def usage(argv):
     usage_string = '''Usage: {0} <config_uri> [var=value]...
@@ -68,6 +71,11 @@ def write_timestamp(path, time):
         )
 
 
+def stop_watching(signum, frame):
+    # Stop watching like on Ctrl-C when the service is stopped.
+    raise KeyboardInterrupt()
+
+
 def main(argv=sys.argv):
     if len(argv) < 2:
         usage(argv)
@@ -115,17 +123,48 @@ def main(argv=sys.argv):
         )
         raise
 
+    validator = create_validator(settings)
+    if validator is not None:
+        # Fail before harvesting if some schema cannot be loaded.
+        validator.compile_all()
+
+    watcher = None
+    if settings['watch']:
+        # Start watching before the first import, so that files changed
+        # during it are updated afterwards.
+        watcher = start_watching(metadata_provider, settings)
+
     log.debug('Harvesting metadata...')
+    pool = create_worker_pool(Provider, settings)
     try:
-        update(metadata_provider, old_timestamp, purge, dry_run)
+        update(metadata_provider, old_timestamp, purge, dry_run,
+               settings['harvest_batch_size'],
+               settings['harvest_batch_interval'],
+               pool,
+               settings['force_update'],
+               validator)
+        if not dry_run:
+            write_timestamp(timestamp_file, new_timestamp)
+
+        if settings['watch']:
+            # Keep updating until interrupted.
+            signal.signal(signal.SIGTERM, stop_watching)
+            watch_directory(metadata_provider, settings, pool, validator,
+                            watcher)
     except HarvestError as error:
         log.critical(
             'Failed to harvest metadata: {0}'
             ''.format(error)
         )
         raise
-
-    if not dry_run:
-        write_timestamp(timestamp_file, new_timestamp)
+    except KeyboardInterrupt:
+        if not settings['watch']:
+            raise
+        log.info('Stopped watching.')
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if pool is not None:
+            pool.shutdown()
 
     log.info('Done.')
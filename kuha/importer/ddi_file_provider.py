@@ -1,9 +1,109 @@
 import os
+import json
 import logging
+from collections import namedtuple
 from datetime import datetime
 
 from lxml import etree
 
+
+FileInfo = namedtuple('FileInfo', ['size', 'mtime', 'ctime', 'inode'])
+ManifestChanges = namedtuple('ManifestChanges',
+                             ['added', 'removed', 'modified'])
+
+
+def scan_directory(directory):
+    """
+    Find XML files in a directory tree and stat them in a single pass.
+
+    Like `os.walk`, symbolic links to directories are not followed.
+
+    Parameters
+    ----------
+    directory: str
+        Path of the directory.
+
+    Return
+    ------
+    dict from str to FileInfo:
+        Status of the files keyed by their paths relative to the
+        directory.
+    """
+    files = {}
+    pending = [directory]
+    while pending:
+        path = pending.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+                elif entry.name.lower().endswith('.xml'):
+                    stat = entry.stat()
+                    relpath = os.path.relpath(entry.path, directory)
+                    files[relpath] = FileInfo(stat.st_size, stat.st_mtime,
+                                              stat.st_ctime, stat.st_ino)
+    return files
+
+
+def load_manifest(path):
+    """
+    Load the file status saved by `save_manifest`.
+
+    Return
+    ------
+    dict from str to FileInfo or NoneType:
+        The saved status, or `None` if the manifest does not exist or
+        cannot be read.
+    """
+    try:
+        with open(path, 'r') as file_:
+            data = json.load(file_)
+        return dict((relpath, FileInfo(*info))
+                    for relpath, info in data['files'].items())
+    except (IOError, OSError):
+        return None
+    except (ValueError, KeyError, TypeError) as error:
+        logging.warning('Ignoring invalid manifest {0}: {1}'
+                        ''.format(path, error))
+        return None
+
+
+def save_manifest(path, files):
+    """
+    Save the status of files atomically.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file_:
+        json.dump({'files': dict((relpath, list(info))
+                                 for relpath, info in files.items())},
+                  file_)
+    os.replace(temp_path, path)
+
+
+def compare_manifests(old, new):
+    """
+    Find files added, removed or modified between two scans.
+
+    A file is modified if its size, modification time or inode has
+    changed, so replaced files are detected even if the modification
+    time was preserved.
+
+    Return
+    ------
+    ManifestChanges:
+        Sets of relative paths.
+    """
+    added = set(new).difference(old)
+    removed = set(old).difference(new)
+    modified = set(
+        relpath for relpath in set(new).intersection(old)
+        if (new[relpath].size, new[relpath].mtime, new[relpath].inode) !=
+           (old[relpath].size, old[relpath].mtime, old[relpath].inode)
+    )
+    return ManifestChanges(added, removed, modified)
+
+
 class DdiFileProvider(object):
     """
     Metadata provider for DDI Codebook XML files.
@@ -24,10 +124,34 @@ class DdiFileProvider(object):
                     The domain name part of the OAI identifiers.
                 "ddi_directory": str
                     Path of the directory to scan for DDI files.
+            May contain the following keys:
+                "ddi_manifest_file": str
+                    Path of a file for saving the status of the DDI
+                    files between imports.
+                "ddi_crosswalk_files": str
+                    Whitespace-separated paths of JSON files with
+                    crosswalks to additional metadata formats. See
+                    `Crosswalk.load`.
         domain_name: str
         """
         self.oai_identifier_prefix = 'oai:{0}:'.format(settings['oai_domain_name'])
         self.directory = settings['ddi_directory']
+        self.manifest_file = settings.get('ddi_manifest_file') or None
+        # Status of the files from the last scan.
+        self.files = None
+        # Changes since the previous import, if a manifest is used.
+        self.changes = None
+
+        self.crosswalks = {DC_CROSSWALK.prefix: DC_CROSSWALK}
+        for path in settings.get('ddi_crosswalk_files', '').split():
+            crosswalk = Crosswalk.load(path)
+            self.crosswalks[crosswalk.prefix] = crosswalk
+        # Every format is converted from a single read of the file.
+        self.reader = DdiReader(set().union(
+            *(crosswalk.paths() for crosswalk in self.crosswalks.values())
+        ))
+        # (filename, status, texts) of the last file read.
+        self._last_read = None
 
     def formats(self):
         """
@@ -39,11 +163,10 @@ class DdiFileProvider(object):
             Mapping from metadata prefixes to (namespace, schema location)
             tuples.
         """
-        # Only OAI DC is available from this provider.
-        return {
-            'oai_dc': ('http://www.openarchives.org/OAI/2.0/oai_dc/',
-                       'http://www.openarchives.org/OAI/2.0/oai_dc.xsd'),
-        }
+        return dict(
+            (prefix, (crosswalk.namespace, crosswalk.schema))
+            for prefix, crosswalk in self.crosswalks.items()
+        )
 
     def identifiers(self):
         """
@@ -54,20 +177,50 @@ class DdiFileProvider(object):
         iterable of str:
             OAI identifiers of all items
         """
-        logging.debug('Scanning directory {0} for XML files...'
-                      ''.format(self.directory))
-        # List all xml files and turn the filenames into identifiers.
-        file_count = 0
-        for subdir, _, files in os.walk(self.directory):
-            for filename in files:
-                if filename.lower().endswith('.xml'):
-                    path = os.path.join(subdir, filename)
-                    yield self.make_identifier(path)
-                    file_count += 1
-        if file_count == 0:
+        self.scan()
+        # Turn the filenames into identifiers.
+        for relpath in sorted(self.files):
+            yield self.make_identifier(os.path.join(self.directory,
+                                                    relpath))
+        if not self.files:
             logging.warning('No XML files found in {0}'
                             ''.format(self.directory))
 
+    def scan(self):
+        """
+        Scan the directory for XML files.
+
+        The status of the files is kept for `has_changed`. If a manifest
+        file is configured, the files are compared with the previous
+        scan. The manifest is saved by `update_finished`.
+        """
+        logging.debug('Scanning directory {0} for XML files...'
+                      ''.format(self.directory))
+        self.files = scan_directory(self.directory)
+        if self.manifest_file is None:
+            return
+
+        old_files = load_manifest(self.manifest_file)
+        if old_files is not None:
+            self.changes = compare_manifests(old_files, self.files)
+            logging.info(
+                'Found {0} added, {1} removed and {2} modified files.'
+                ''.format(len(self.changes.added),
+                          len(self.changes.removed),
+                          len(self.changes.modified))
+            )
+
+    def update_finished(self):
+        """
+        Save the manifest after a successful update.
+
+        The importer calls this only if the update was not a dry run,
+        so the changes found by `scan` are reported again until they
+        have been imported.
+        """
+        if self.manifest_file is not None and self.files is not None:
+            save_manifest(self.manifest_file, self.files)
+
     def has_changed(self, identifier, since):
         """
         Check wheter the given item has been modified.
@@ -86,10 +239,17 @@ class DdiFileProvider(object):
             given time. Otherwise `False`.
         """
         filename = self.get_filename(identifier)
-        path = os.path.join(self.directory, filename)
-        mtime = os.path.getmtime(path)
-        ctime = os.path.getctime(path)
-        datestamp = datetime.utcfromtimestamp(max(mtime, ctime))
+        info = self.files.get(filename) if self.files is not None else None
+        if info is None:
+            # Not scanned in this process.
+            stat = os.stat(os.path.join(self.directory, filename))
+            info = FileInfo(stat.st_size, stat.st_mtime, stat.st_ctime,
+                            stat.st_ino)
+        elif self.changes is not None and (
+                filename in self.changes.added or
+                filename in self.changes.modified):
+            return True
+        datestamp = datetime.utcfromtimestamp(max(info.mtime, info.ctime))
         return datestamp >= since
 
     def get_sets(self, identifier):
@@ -125,24 +285,40 @@ class DdiFileProvider(object):
 
         Return
         ------
-        str or NoneType:
-            An XML fragment containing the metadata of the item in the
-            given format. If the format is not available for the item
-            return `None`.
+        lxml.etree._Element or NoneType:
+            The root element of the metadata of the item in the given
+            format. The importer serializes the element, and checks it
+            without parsing the XML again. If the format is not
+            available for the item return `None`.
 
         Raises
         ------
         Exception:
             If converting or reading the metadata fails.
         """
-        if metadata_prefix != 'oai_dc':
+        crosswalk = self.crosswalks.get(metadata_prefix)
+        if crosswalk is None:
             return None
+        texts = self.read(self.get_filename(identifier))
+        return crosswalk.convert(texts)
 
-        filename = self.get_filename(identifier)
+    def read(self, filename):
+        """
+        Collect the texts of a DDI file for all crosswalks.
+
+        The result for the last file is kept until the file changes, so
+        the records of an item in all formats are converted from a single
+        read of the file.
+        """
         path = os.path.join(self.directory, filename)
-        with open(path, 'r') as file_:
-            xmltree = etree.parse(file_)
-        return etree.tostring(convert_to_dc(xmltree))
+        stat = os.stat(path)
+        status = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if (self._last_read is not None and
+                self._last_read[:2] == (filename, status)):
+            return self._last_read[2]
+        texts = self.reader.read(path)
+        self._last_read = (filename, status, texts)
+        return texts
 
     def make_identifier(self, filename):
         """
@@ -152,6 +328,25 @@ class DdiFileProvider(object):
         filename = filename[len(self.directory) + 1:-4]
         return self.oai_identifier_prefix + filename
 
+    def watched_directory(self):
+        """
+        Return the directory to watch for changed DDI files.
+        """
+        return self.directory
+
+    def identifier_for_path(self, path):
+        """
+        Form the OAI identifier for a changed file.
+
+        Return `None` if the file is not a DDI file in the directory.
+        """
+        if not path.lower().endswith('.xml'):
+            return None
+        relpath = os.path.relpath(path, self.directory)
+        if relpath.startswith(os.pardir):
+            return None
+        return self.make_identifier(os.path.join(self.directory, relpath))
+
     def get_filename(self, identifier):
         """
         Extract the filename from an OAI identifier.
@@ -161,64 +356,225 @@ class DdiFileProvider(object):
         return identifier[len(self.oai_identifier_prefix):] + '.xml'
 
 
-def convert_to_dc(record):
-    # Namespaces.
-    nsmap = {
+class DdiReader(object):
+    """
+    Collect the text of the elements at the given paths of DDI files.
+
+    Files are parsed incrementally, and elements are discarded as soon
+    as they have been read. Only the elements on the given paths are
+    looked at, so large sections such as `dataDscr` take little time
+    and memory.
+
+    Parameters
+    ----------
+    paths: iterable of str
+        Element paths relative to the root element, e.g.
+        "stdyDscr/citation/titlStmt/titl".
+    """
+
+    def __init__(self, paths):
+        self.paths = frozenset(paths)
+        # Elements whose descendants may match a path.
+        ancestors = set()
+        for path in self.paths:
+            steps = path.split('/')
+            for i in range(1, len(steps)):
+                ancestors.add('/'.join(steps[:i]))
+        self._ancestors = frozenset(ancestors)
+
+    def read(self, source):
+        """
+        Read a DDI file.
+
+        Parameters
+        ----------
+        source: str or file
+            Path of the file, or a file object opened in binary mode.
+
+        Return
+        ------
+        dict from str to list of unicode or NoneType:
+            Text of the matching elements in document order, keyed by
+            the paths.
+        """
+        texts = dict((path, []) for path in self.paths)
+        ancestors = self._ancestors
+
+        # Path of each open element, or `None` if nothing inside it is
+        # read.
+        stack = []
+        for event, element in etree.iterparse(source,
+                                              events=('start', 'end')):
+            if event == 'start':
+                if not stack:
+                    path = ''
+                elif stack[-1] == '':
+                    path = element.tag
+                elif stack[-1] in ancestors:
+                    path = stack[-1] + '/' + element.tag
+                else:
+                    path = None
+                stack.append(path)
+                continue
+
+            path = stack.pop()
+            if path in texts:
+                texts[path].append(element.text)
+            if stack:
+                # Free the finished element and its preceding siblings.
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        return texts
+
+
+class Crosswalk(object):
+    """
+    Mapping from DDI elements to the fields of a metadata format.
+
+    The mapping is compiled once, so converting a record only creates
+    the output elements.
+
+    Parameters
+    ----------
+    prefix: unicode
+        The metadata prefix of the format.
+    namespace: unicode
+        The namespace of the format.
+    schema: unicode
+        The schema location of the format.
+    root: unicode
+        Qualified name of the root element, e.g. "oai_dc:dc".
+    namespaces: dict from unicode to unicode
+        Namespace prefixes used in the element names.
+    fields: list of (unicode, list of str)
+        Qualified names of the output elements and the DDI paths to
+        fill them from, in output order.
+
+    Raises
+    ------
+    ValueError:
+        If an element name has an unknown namespace prefix.
+    """
+
+    XSI_NAMESPACE = 'http://www.w3.org/2001/XMLSchema-instance'
+
+    def __init__(self, prefix, namespace, schema, root, namespaces,
+                 fields):
+        self.prefix = prefix
+        self.namespace = namespace
+        self.schema = schema
+        self.nsmap = dict(namespaces)
+        self.nsmap.setdefault('xsi', self.XSI_NAMESPACE)
+        self._root = self._tag(root)
+        self._schema_location = '{0} {1}'.format(namespace, schema)
+        self._fields = [(self._tag(name), list(paths))
+                        for name, paths in fields]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a crosswalk from a JSON file.
+
+        The file must contain an object with the keys "prefix",
+        "namespace", "schema", "root", "namespaces" and "fields", which
+        are passed to the constructor. See `DC_CROSSWALK` for an
+        example.
+
+        Raises
+        ------
+        ValueError:
+            If the file is not a valid crosswalk.
+        """
+        with open(path, 'r') as file_:
+            data = json.load(file_)
+        try:
+            return cls(data['prefix'], data['namespace'], data['schema'],
+                       data['root'], data['namespaces'], data['fields'])
+        except (KeyError, TypeError) as error:
+            raise ValueError('invalid crosswalk {0}: {1}'
+                             ''.format(path, error))
+
+    def _tag(self, name):
+        # Turn a qualified name into the Clark notation of lxml.
+        prefix, _, localname = name.rpartition(':')
+        if prefix not in self.nsmap:
+            raise ValueError('unknown namespace prefix in "{0}"'
+                             ''.format(name))
+        return '{{{0}}}{1}'.format(self.nsmap[prefix], localname)
+
+    def paths(self):
+        """
+        Return the set of DDI paths used by the crosswalk.
+        """
+        return set(path for _, paths in self._fields for path in paths)
+
+    def convert(self, texts):
+        """
+        Convert DDI element texts collected by `DdiReader` to this format.
+
+        Empty texts are skipped.
+
+        Parameters
+        ----------
+        texts: dict from str to list of unicode or NoneType
+            Text of the elements keyed by their paths.
+
+        Return
+        ------
+        lxml.etree._Element:
+            The root element of the record.
+        """
+        root = etree.Element(self._root, nsmap=self.nsmap)
+        root.set('{{{0}}}schemaLocation'.format(self.XSI_NAMESPACE),
+                 self._schema_location)
+        for tag, paths in self._fields:
+            for path in paths:
+                for text in texts.get(path, []):
+                    if text and not text.isspace():
+                        etree.SubElement(root, tag).text = text
+        return root
+
+
+# Mapping from DDI Version 2 to Dublin Core
+# (http://www.ddialliance.org/resources/tools/dc). The paths are
+# relative to the codeBook element.
+DC_CROSSWALK = Crosswalk(
+    prefix='oai_dc',
+    namespace='http://www.openarchives.org/OAI/2.0/oai_dc/',
+    schema='http://www.openarchives.org/OAI/2.0/oai_dc.xsd',
+    root='oai_dc:dc',
+    namespaces={
         'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
         'dc': 'http://purl.org/dc/elements/1.1/',
-        'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-    }
-
-    # Mapping from DDI Version 2 to Dublin Core
-    # (http://www.ddialliance.org/resources/tools/dc).
-    mapping = {
-        'title': ['stdyDscr/citation/titlStmt/titl'],
-        'creator': ['stdyDscr/citation/rspStmt/AuthEnty'],
-        'subject': [
+    },
+    fields=[
+        ('dc:title', ['stdyDscr/citation/titlStmt/titl']),
+        ('dc:creator', ['stdyDscr/citation/rspStmt/AuthEnty']),
+        ('dc:subject', [
             'stdyDscr/stdyInfo/subject/keyword',
             'stdyDscr/stdyInfo/subject/topcClas',
-        ],
-        'description': ['stdyDscr/stdyInfo/abstract/p'],
-        'publisher': ['stdyDscr/citation/prodStmt/producer'],
-        'contributor': ['stdyDscr/citation/rspStmt/othId/p'],
-        'date': ['stdyDscr/citation/prodStmt/prodDate'],
-        'type': ['stdyDscr/stdyInfo/sumDscr/dataKind'],
-        'format': ['fileDscr/fileTxt/fileType'],
-        'identifier': ['stdyDscr/citation/titlStmt/IDNo'],
-        'source': ['stdyDscr/method/dataColl/sources/dataSrc'],
-        'language': [],
-        'relation': [
+        ]),
+        ('dc:description', ['stdyDscr/stdyInfo/abstract/p']),
+        ('dc:publisher', ['stdyDscr/citation/prodStmt/producer']),
+        ('dc:contributor', ['stdyDscr/citation/rspStmt/othId/p']),
+        ('dc:date', ['stdyDscr/citation/prodStmt/prodDate']),
+        ('dc:type', ['stdyDscr/stdyInfo/sumDscr/dataKind']),
+        ('dc:format', ['fileDscr/fileTxt/fileType']),
+        ('dc:identifier', ['stdyDscr/citation/titlStmt/IDNo']),
+        ('dc:source', ['stdyDscr/method/dataColl/sources/dataSrc']),
+        ('dc:language', []),
+        ('dc:relation', [
             'stdyDscr/othrStdyMat/relMat',
             'stdyDscr/othrStdyMat/relStdy',
             'stdyDscr/othrStdyMat/relPubl',
-        ],
-        'coverage': [
+        ]),
+        ('dc:coverage', [
             'stdyDscr/stdyInfo/sumDscr/timePrd',
             'stdyDscr/stdyInfo/sumDscr/collDate',
             'stdyDscr/stdyInfo/sumDscr/nation',
             'stdyDscr/stdyInfo/sumDscr/geogCover',
-        ],
-        'rights': ['stdyDscr/citation/prodStmt/copyright'],
-    }
-
-    root = etree.Element('{{{oai_dc}}}dc'.format(**nsmap), nsmap=nsmap)
-    root.set('{{{xsi}}}schemaLocation'.format(**nsmap),
-        ('http://www.openarchives.org/OAI/2.0/oai_dc/ '
-         'http://www.openarchives.org/OAI/2.0/oai_dc.xsd')
-    )
-
-    def add_field(name, text):
-        """Add a field to the DC XML tree."""
-        if text is not None and len(text) > 0 and not text.isspace():
-            element = root.makeelement(
-                '{{{dc}}}{name}'.format(name=name, **nsmap)
-            )
-            element.text = text
-            root.append(element)
-
-    for dc_tag, ddi_paths in mapping.items():
-        for ddi_path in ddi_paths:
-            for element in record.findall(ddi_path):
-                add_field(dc_tag, element.text)
-
-    return root
+        ]),
+        ('dc:rights', ['stdyDscr/citation/prodStmt/copyright']),
+    ],
+)
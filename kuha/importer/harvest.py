@@ -1,9 +1,28 @@
+import collections
+import concurrent.futures
 import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from lxml import etree
 
 from .. import models
 from ..exception import HarvestError
+from ..oai.fragments import render_fragment
+from ..util import datestamp_now
+from .validation import create_validator
 
-def update(provider, since=None, purge=False, dry_run=False):
+def update(provider,
+           since=None,
+           purge=False,
+           dry_run=False,
+           batch_size=1,
+           batch_interval=None,
+           pool=None,
+           force=False,
+           validator=None):
     """Update metadata formats, items, records and sets.
 
     Parameters
@@ -27,20 +46,66 @@ def update(provider, since=None, purge=False, dry_run=False):
                 iterable of (set spec, set name) tuples.
 
             get_record(identifier: unicode, prefix: unicode):
-                    unicode or None
+                    unicode, lxml.etree._Element or None
                 Disseminate the metadata of the specified item in the
                 specified format. Return an XML fragment. If the item
                 cannot be disseminated in the specified format, return
-                None.
+                None. Providers which build the metadata as an element
+                tree may return the root element, which is then
+                checked without parsing the XML again.
+
+        Providers which can serve many items at once more cheaply,
+        e.g. with a single database query, may also have any of the
+        following methods, which are then used instead of the ones
+        above:
+
+            changed_since(since: datetime): iterable of unicode
+                Return the identifiers of the items which have changed
+                since the given time.
+
+            get_sets_many(identifiers: list of unicode):
+                    dict from unicode to iterable of (unicode, unicode)
+                Return the sets of the given items keyed by their
+                identifiers, like ``get_sets()``.
+
+            get_records_many(identifiers: list of unicode,
+                             prefix: unicode):
+                    dict from unicode to unicode or None
+                Disseminate the metadata of the given items in the
+                specified format, like ``get_record()``. Items which are
+                missing from the result are not available in the
+                format.
+
+        Providers may also have the following method:
+
+            update_finished()
+                Called when the update has finished, unless it is a
+                dry run or a ``HarvestError`` was raised. Providers
+                can save state for the next update here.
 
     since: datetime.datetime or None
-        Time of the last update in UTC, or `None`.
+        Time of the last update in UTC, or `None`. Only used for items
+        harvested by older versions, which have no harvest time.
     purge: bool
         If `True`, purge deleted formats, items and records from the
         database.
     dry_run: bool
         If `True`, fetch records as usual but do not actually change the
         database.
+    batch_size: int
+        Maximum number of records to update in one transaction.
+    batch_interval: float or None
+        Maximum number of seconds to keep a transaction open while
+        updating records, or ``None`` for no limit.
+    pool: concurrent.futures.Executor or None
+        Worker pool created with ``create_worker_pool()`` for calling
+        the provider in parallel, or ``None`` to call it serially.
+    force: bool
+        If `True`, update all records even if the items have not
+        changed since they were harvested.
+    validator: RecordValidator or None
+        Validator for the records, or ``None`` to store them without
+        validating them against the schemas of their formats.
 
     Raises
     ------
@@ -50,7 +115,67 @@ def update(provider, since=None, purge=False, dry_run=False):
     """
     prefixes = update_formats(provider, purge, dry_run)
     identifiers = update_items(provider, purge, dry_run)
-    update_records(provider, identifiers, prefixes, since, dry_run)
+    update_records(provider, identifiers, prefixes, since, dry_run,
+                   batch_size, batch_interval, pool, force, validator)
+    if not dry_run:
+        # Render all fragments again in a full update, in case the
+        # templates have changed.
+        update_fragments(rerender=force)
+        if getattr(type(provider), 'update_finished', None) is not None:
+            provider.update_finished()
+
+
+def update_changed(provider,
+                   identifiers,
+                   removed_identifiers,
+                   purge=False,
+                   dry_run=False,
+                   batch_size=1,
+                   batch_interval=None,
+                   pool=None,
+                   validator=None):
+    """Update the items which are known to have changed.
+
+    Unlike ``update()``, the provider is not asked for all identifiers,
+    so the cost depends only on the number of changed items. The
+    metadata formats are not updated.
+
+    Parameters
+    ----------
+    provider: object
+        The metadata provider. See ``update()``.
+    identifiers: iterable of unicode
+        Identifiers of the items which have been added or modified.
+    removed_identifiers: iterable of unicode
+        Identifiers of the items which have been removed.
+    purge: bool
+        If `True`, purge deleted items and records from the database.
+    dry_run: bool
+        If `True`, do not modify the database.
+    batch_size: int
+        Maximum number of records to update in one transaction.
+    batch_interval: float or None
+        Maximum number of seconds to keep a transaction open, or
+        ``None`` for no limit.
+    pool: concurrent.futures.Executor or None
+        Worker pool created with ``create_worker_pool()``.
+    validator: RecordValidator or None
+        Validator for the records. See ``update()``.
+
+    Raises
+    ------
+    HarvestError:
+        If the items cannot be updated.
+    """
+    prefixes = [format_.prefix
+                for format_ in models.Format.list(ignore_deleted=True)]
+    identifiers = update_changed_items(identifiers, removed_identifiers,
+                                       purge, dry_run)
+    update_records(provider, identifiers, prefixes, dry_run=dry_run,
+                   batch_size=batch_size, batch_interval=batch_interval,
+                   pool=pool, validator=validator, changed=True)
+    if not dry_run:
+        update_fragments()
 
 
 def update_formats(provider, purge=False, dry_run=False):
@@ -113,129 +238,803 @@ def update_items(provider, purge=False, dry_run=False):
     try:
         new_identifiers = frozenset(list(map(str, provider.identifiers())))
 
-        old_items = dict(
-            (item.identifier, item)
-            for item in models.Item.list(ignore_deleted=True)
-        )
+        # Compare the identifiers in bulk instead of loading the items.
+        old_items = models.Item.list_identifiers()
+        _reconcile_items(old_items, new_identifiers, old_items.keys(),
+                         purge, dry_run)
+    except Exception as e:
+        models.rollback()
+        log.exception('Failed to update items: {0}'.format(e))
+        raise HarvestError(str(e))
 
-        removed = 0
-        for identifier, item in old_items.items():
-            if identifier not in new_identifiers:
-                if not dry_run:
-                    item.mark_as_deleted()
-                log.debug('deleted {0}'.format(identifier))
-                removed += 1
+    return new_identifiers
 
-        added = 0
-        for identifier in new_identifiers:
-            if not dry_run:
-                models.Item.create_or_update(identifier)
-            if identifier not in old_items:
-                log.debug('added {0}'.format(identifier))
-                added += 1
 
-        if purge and not dry_run:
-            models.purge_deleted()
+def update_changed_items(identifiers, removed_identifiers, purge=False,
+                         dry_run=False):
+    """Add, undelete and delete the given items.
+
+    Parameters
+    ----------
+    identifiers: iterable of unicode
+        Identifiers of the items which exist in the provider.
+    removed_identifiers: iterable of unicode
+        Identifiers of the items which have been removed.
+    purge: bool
+        If `True`, purge deleted items and records from the database.
+    dry_run: bool
+        If `True`, do not modify the database.
+
+    Return
+    ------
+    list of unicode:
+        The sorted identifiers of the existing items.
+
+    Raises
+    ------
+    HarvestError:
+        If the items cannot be updated.
+    """
+    log = logging.getLogger(__name__)
+    identifiers = frozenset(identifiers)
+    removed_identifiers = frozenset(removed_identifiers) - identifiers
+
+    try:
+        old_items = models.Item.list_identifiers(
+            sorted(identifiers | removed_identifiers))
+        _reconcile_items(old_items, identifiers, removed_identifiers,
+                         purge, dry_run)
     except Exception as e:
         models.rollback()
         log.exception('Failed to update items: {0}'.format(e))
         raise HarvestError(str(e))
-    else:
-        if dry_run:
-            models.rollback()
-        else:
-            models.commit()
-        log.info(
-            'Removed {0} item{1} and added {2} item{3}.'
-            ''.format(
-                removed, '' if removed == 1 else 's',
-                added,   '' if added   == 1 else 's',
-            )
-        )
 
-        return new_identifiers
+    return sorted(identifiers)
 
 
-def update_sets(provider, identifier, dry_run=False):
+def _reconcile_items(old_items, new_identifiers, candidates, purge,
+                     dry_run):
+    # Create or undelete the new items, and delete the candidates
+    # which are not among them.
     log = logging.getLogger(__name__)
-    log.debug('Updating sets...')
+    removed_ids = sorted(
+        identifier for identifier in candidates
+        if old_items.get(identifier) is False
+        and identifier not in new_identifiers
+    )
+    created_ids = sorted(new_identifiers.difference(old_items))
+    undeleted_ids = sorted(
+        identifier for identifier in new_identifiers
+        if old_items.get(identifier) is True
+    )
+
+    for identifier in removed_ids:
+        log.debug('deleted {0}'.format(identifier))
+    for identifier in sorted(created_ids + undeleted_ids):
+        log.debug('added {0}'.format(identifier))
+    removed = len(removed_ids)
+    added = len(created_ids) + len(undeleted_ids)
 
-    # Remove the item from old sets.
-    item = None
     if not dry_run:
-        item = models.Item.get(identifier)
-        item.clear_sets()
+        models.Item.mark_many_as_deleted(removed_ids)
+        models.Item.undelete_many(undeleted_ids)
+        models.Item.create_many(created_ids)
+
+    if purge and not dry_run:
+        models.purge_deleted()
+
+    if dry_run:
+        models.rollback()
+    else:
+        models.commit()
+    log.info(
+        'Removed {0} item{1} and added {2} item{3}.'
+        ''.format(
+            removed, '' if removed == 1 else 's',
+            added,   '' if added   == 1 else 's',
+        )
+    )
+
+
+def update_sets(provider, identifier, dry_run=False, registry=None):
+    log = logging.getLogger(__name__)
+    log.debug('Updating sets...')
 
     sets = provider.get_sets(identifier)
-    if len(sets) == 0:
+    if dry_run:
         return
-    # Sort set specs by level.
-    sets.sort(key=lambda spec: spec[0].count(':'))
+
+    if registry is None:
+        registry = _SetRegistry()
     # TODO: make sure that sets contain the parent sets of all sets
-    for spec, name in sets:
-        if not dry_run:
-            set_ = models.Set.create_or_update(spec, name)
-            item.add_to_set(set_)
+    registry.update(sets)
+
+    # Only change the memberships which differ.
+    old_specs = models.Item.list_set_specs([identifier]).get(
+        identifier, set())
+    new_specs = set(spec for spec, _ in sets)
+    models.Item.change_sets(identifier,
+                            new_specs - old_specs,
+                            old_specs - new_specs)
+
+
+class _SetRegistry(object):
+    """Names of the sets in the database keyed by their specs.
+
+    The sets are loaded once, and then kept up to date with the sets
+    created and renamed by the importer, so that updating the sets of
+    an item does not query them. The registry has to be reset when
+    the changes are rolled back.
+    """
+
+    def __init__(self):
+        self._names = None
+
+    def reset(self):
+        """Forget the sets, so that they are loaded again."""
+        self._names = None
+
+    def update(self, sets):
+        """Create new sets and rename the sets whose names differ.
+
+        Parameters
+        ----------
+        sets: iterable of (unicode, unicode)
+            (set spec, set name) tuples.
+        """
+        if self._names is None:
+            self._names = models.Set.list_names()
+        new = {}
+        for spec, name in sets:
+            old_name = self._names.get(spec)
+            if old_name is None:
+                new[spec] = name
+            elif old_name != name:
+                models.Set.rename(spec, name)
+                self._names[spec] = name
+        models.Set.create_many(new.items())
+        self._names.update(new)
+
+
+# Provider of the current worker process or thread.
+_worker = threading.local()
+
+# Maximum number of items being fetched by workers at a time.
+_MAX_PENDING = 64
+
+# Minimum number of batches being fetched by workers at a time.
+_MIN_PENDING_BATCHES = 8
+
+# Number of items fetched at a time from providers which have the
+# methods of the batch protocol.
+_FETCH_BATCH_SIZE = 100
+
+_BATCH_METHODS = ('changed_since', 'get_sets_many', 'get_records_many')
+
+
+def create_worker_pool(provider_class, settings):
+    """Create a pool of workers for calling the metadata provider.
+
+    Each worker creates its own provider instance, and its own record
+    validator if ``validation_schemas`` are configured. Processes suit
+    providers which are limited by CPU, such as those converting
+    metadata, and threads suit providers which wait for I/O.
+
+    Parameters
+    ----------
+    provider_class: type
+        The metadata provider class.
+    settings: dict
+        The cleaned importer settings. The number of workers and their
+        type are read from ``harvest_workers`` and
+        ``harvest_worker_type``.
+
+    Return
+    ------
+    concurrent.futures.Executor or None:
+        The worker pool, or ``None`` if ``harvest_workers`` is 0.
+    """
+    workers = settings['harvest_workers']
+    if workers == 0:
+        return None
+    if settings['harvest_worker_type'] == 'process':
+        Executor = concurrent.futures.ProcessPoolExecutor
+    else:
+        Executor = concurrent.futures.ThreadPoolExecutor
+    return Executor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(provider_class, dict(settings)),
+    )
+
+
+def _init_worker(provider_class, settings):
+    if multiprocessing.parent_process() is not None:
+        # Forked after create_engine(), with the connections of the
+        # importer.
+        models.discard_inherited_connections()
+        # Forked after the importer may have installed its handler for
+        # stopping the watch mode. Workers are shut down by the
+        # importer, so they just terminate.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _worker.provider = provider_class(settings)
+    _worker.validator = create_validator(settings)
+
+
+class _FetchedItem(object):
+    """Results of the provider calls for one item.
+
+    The methods replay the results like the corresponding methods of
+    the provider, so fetched items can be used in place of it.
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.changed = True
+        self.sets = []
+        self.records = {}
+        # Results of validating the records in the worker, keyed by
+        # the prefix.
+        self.validation = {}
+        # Prefixes of the records which the worker found unchanged
+        # by their digests.
+        self.unchanged = set()
+        # Prefixes of the records which the worker has checked against
+        # their formats, so that they are not parsed again.
+        self.checked = set()
+
+    def has_changed(self, identifier, since):
+        if self.error is not None:
+            raise self.error
+        return self.changed
+
+    def get_sets(self, identifier):
+        if self.error is not None:
+            raise self.error
+        return self.sets
+
+    def get_record(self, identifier, prefix):
+        xml, error = self.records[prefix]
+        if error is not None:
+            raise error
+        return xml
+
+
+def _batch_method(provider, name):
+    # Return a method of the batch protocol, or None if the provider
+    # does not have it. The method is looked up in the class so that
+    # providers which handle any attribute are not mistaken for batch
+    # providers.
+    if getattr(type(provider), name, None) is None:
+        return None
+    return getattr(provider, name)
+
+
+def _is_batch_provider(provider):
+    # Return True if the provider has any method of the batch protocol.
+    return any(_batch_method(provider, name) is not None
+               for name in _BATCH_METHODS)
+
+
+def _check_changes(provider, items, changes):
+    # Return a fetched item for each (identifier, since) pair, with
+    # only `changed` or `error` set. `changes` caches the results of
+    # changed_since() keyed by the time.
+    fetched = [_FetchedItem() for _ in items]
+    changed_since = _batch_method(provider, 'changed_since')
+    for (identifier, since), item in zip(items, fetched):
+        if since is None:
+            continue
+        try:
+            if changed_since is None:
+                item.changed = provider.has_changed(identifier, since)
+            else:
+                if since not in changes:
+                    changes[since] = frozenset(changed_since(since))
+                item.changed = identifier in changes[since]
+        except Exception as e:
+            item.error = e
+    return fetched
+
+
+def _fetch_items(provider, items, prefixes, changes):
+    # Call the provider for a list of (identifier, since) pairs and
+    # return a fetched item for each. The batch methods of the
+    # provider are used if it has them, and the methods for single
+    # items otherwise.
+    fetched = _check_changes(provider, items, changes)
+    _fetch_changed(provider,
+                   [(identifier, item)
+                    for (identifier, _), item in zip(items, fetched)],
+                   prefixes)
+    return fetched
+
+
+def _fetch_changed(provider, items, prefixes):
+    # Fill in the sets and records of (identifier, fetched item) pairs
+    # whose items have changed and not failed.
+    def pending():
+        return [(identifier, item) for identifier, item in items
+                if item.changed and item.error is None]
+
+    get_sets_many = _batch_method(provider, 'get_sets_many')
+    todo = pending()
+    if get_sets_many is None:
+        for identifier, item in todo:
+            try:
+                item.sets = provider.get_sets(identifier)
+            except Exception as e:
+                item.error = e
+    elif todo:
+        try:
+            sets = get_sets_many([identifier for identifier, _ in todo])
+            for identifier, item in todo:
+                item.sets = list(sets.get(identifier, []))
+        except Exception as e:
+            for _, item in todo:
+                item.error = e
+
+    get_records_many = _batch_method(provider, 'get_records_many')
+    todo = pending()
+    for prefix in prefixes:
+        if get_records_many is None:
+            for identifier, item in todo:
+                try:
+                    item.records[prefix] = (
+                        provider.get_record(identifier, prefix), None
+                    )
+                except Exception as e:
+                    item.records[prefix] = (None, e)
+        elif todo:
+            try:
+                records = get_records_many(
+                    [identifier for identifier, _ in todo], prefix)
+                for identifier, item in todo:
+                    item.records[prefix] = (records.get(identifier), None)
+            except Exception as e:
+                for _, item in todo:
+                    item.records[prefix] = (None, e)
+
+
+def _fetch_in_worker(items, prefixes, validate=False, formats=None):
+    # Call the provider of this worker for a list of (identifier,
+    # digests) pairs of changed items, where `digests` are the digests
+    # of the stored records keyed by the prefix. The records which
+    # differ from the stored ones are checked against `formats`, which
+    # maps prefixes to (namespace, schema location) tuples, and
+    # validated if `validate` is True. Element trees are serialized
+    # here, because they cannot be pickled, so the records are checked
+    # here to spare the importer from parsing them again.
+    fetched = [_FetchedItem() for _ in items]
+    _fetch_changed(_worker.provider,
+                   [(identifier, item)
+                    for (identifier, _), item in zip(items, fetched)],
+                   prefixes)
+    validator = _worker.validator if validate else None
+    formats = formats or {}
+    for (_, digests), item in zip(items, fetched):
+        for prefix, (xml, error) in item.records.items():
+            xml, tree = _serialize(xml)
+            item.records[prefix] = (xml, error)
+            if xml is None:
+                continue
+            if digests.get(prefix) == models.Record.make_digest(xml):
+                item.unchanged.add(prefix)
+                continue
+            try:
+                if prefix in formats:
+                    if tree is None:
+                        # Parsed once for checking and validating.
+                        tree = etree.fromstring(xml)
+                    namespace, schema = formats[prefix]
+                    models.check_xml(xml, namespace, schema, tree)
+                    item.checked.add(prefix)
+                if validator is not None:
+                    item.validation[prefix] = validator.validate(
+                        prefix, xml, tree)
+            except Exception as e:
+                item.records[prefix] = (None, e)
+    return fetched
+
+
+def _serialize(xml):
+    # Return (xml, tree) for a record returned by a provider. If the
+    # provider returned an element, serialize it and return the
+    # element as the tree. Otherwise the tree is None.
+    if etree.iselement(xml):
+        return etree.tostring(xml, encoding='unicode'), xml
+    return xml, None
+
+
+def _fetch_batches(provider, items, prefixes):
+    # Yield (identifier, since, fetched item, digests) tuples in the
+    # order of the (identifier, since, digests) tuples, fetching them
+    # in batches in this thread.
+    changes = {}
+    for chunk in _chunks(items, _FETCH_BATCH_SIZE):
+        fetched = _fetch_items(provider, [i[:2] for i in chunk], prefixes,
+                               changes)
+        for (identifier, since, digests), item in zip(chunk, fetched):
+            yield identifier, since, item, digests
+
+
+def _fetch_in_pool(pool, provider, items, prefixes, size=1,
+                   validate=False, formats=None):
+    # Yield (identifier, since, fetched item, digests) tuples in the
+    # order of the (identifier, since, digests) tuples, sending `size`
+    # items to a worker at a time and keeping a limited number of items
+    # in progress. The workers check the records which differ from the
+    # stored ones against `formats`, and validate them if `validate`
+    # is True.
+    #
+    # Whether the items have changed is checked with `provider` in
+    # this process, since the state of the provider (such as the scan
+    # of a directory) is not shared with the workers, and
+    # changed_since() is called once for each time. Only the changed
+    # items are sent to the workers.
+    pending = collections.deque()
+    max_pending = max(_MAX_PENDING // size, _MIN_PENDING_BATCHES)
+    changes = {}
+
+    def next_results():
+        chunk, checked, future = pending.popleft()
+        changed = [item for item in checked
+                   if item.changed and item.error is None]
+        try:
+            fetched = future.result() if future is not None else []
+        except Exception as e:
+            # The worker failed or the results could not be pickled.
+            fetched = [_FetchedItem(error=e) for _ in changed]
+        results = iter(fetched)
+        for (identifier, since, digests), item in zip(chunk, checked):
+            if item.changed and item.error is None:
+                item = next(results)
+            yield identifier, since, item, digests
+
+    for chunk in _chunks(items, size):
+        checked = _check_changes(provider, [i[:2] for i in chunk], changes)
+        # Only the digests of the item are sent to the worker.
+        todo = [(identifier,
+                 dict((prefix, digests.get((identifier, prefix)))
+                      for prefix in prefixes))
+                for (identifier, _, digests), item in zip(chunk, checked)
+                if item.changed and item.error is None]
+        future = None
+        if todo:
+            future = pool.submit(_fetch_in_worker, todo, prefixes, validate,
+                                 formats)
+        pending.append((chunk, checked, future))
+        if len(pending) >= max_pending:
+            for result in next_results():
+                yield result
+    while pending:
+        for result in next_results():
+            yield result
+
+
+def _chunks(iterable, size=500):
+    # Split an iterable into lists of at most `size` values.
+    chunk = []
+    for value in iterable:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _with_harvest_times(identifiers, default):
+    # Yield (identifier, since) pairs, where `since` is the harvest
+    # time of the item or `default` if it has not been harvested.
+    for chunk in _chunks(identifiers):
+        times = models.Item.list_harvest_times(chunk)
+        for identifier in chunk:
+            yield identifier, times.get(identifier, default)
+
+
+def _with_digests(items, validated=False):
+    # Add the digests of the stored records to (identifier, since)
+    # pairs. If `validated` is True, records which have not been
+    # validated are left out, so that they are validated as if they had
+    # changed.
+    for chunk in _chunks(items):
+        digests = models.Record.list_digests([i[0] for i in chunk],
+                                             validated)
+        for identifier, since in chunk:
+            yield identifier, since, digests
+
+
+class _TransactionBatch(object):
+    """Group the changes of several items into one transaction.
+
+    Committing after each record keeps the database (esp. SQLite) from
+    being locked for a long time, but each commit waits for the disk.
+    The transaction is committed after the item which fills `size`
+    records or exceeds `interval` seconds, so the changes of an item
+    are always committed together.
+    """
+
+    def __init__(self, size, interval, dry_run, harvest_time,
+                 on_rollback=None):
+        self.size = size
+        self.interval = interval
+        self.dry_run = dry_run
+        self.harvest_time = harvest_time
+        self.on_rollback = on_rollback
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.harvested = []
+        self.started = time.monotonic()
+
+    def add(self):
+        """Count a processed record."""
+        self.count += 1
+
+    def item_done(self, identifier, harvested):
+        """Finish an item and commit if the batch is full.
+
+        If `harvested` is `True`, the item is marked as harvested when
+        the batch is committed.
+        """
+        if harvested:
+            self.harvested.append(identifier)
+        if (self.count >= self.size or
+                (self.interval is not None and
+                 time.monotonic() - self.started >= self.interval)):
+            self.end()
+
+    def end(self):
+        """Commit the records of the batch."""
+        if self.dry_run or (self.count == 0 and not self.harvested):
+            models.rollback()
+            if self.on_rollback is not None:
+                self.on_rollback()
+        else:
+            models.Item.mark_harvested(self.harvested, self.harvest_time)
+            models.commit()
+        self._reset()
 
 
 def update_records(provider,
                    identifiers,
                    prefixes,
                    since=None,
-                   dry_run=False):
+                   dry_run=False,
+                   batch_size=1,
+                   batch_interval=None,
+                   pool=None,
+                   force=False,
+                   validator=None,
+                   changed=False):
+    """Update the records of items.
+
+    Only items which have changed since they were last harvested are
+    updated. An item is marked as harvested when its sets and all of
+    its records have been updated successfully, so failed items are
+    retried in the next update.
+
+    If a worker pool is given, the provider is called in the workers
+    and the results are written to the database in this thread, in the
+    order of the identifiers. Only checking whether the items have
+    changed is done with the provider of this thread. Providers with
+    the batch methods described in ``update()`` are called for many
+    items at a time.
+
+    If a validator is given, records which differ from the stored ones
+    by their digests are validated against the schemas of their
+    formats, in the workers if there is a pool, and the results are
+    stored with the records. Invalid records are stored too, but they
+    are logged. Stored records which have not been validated yet are
+    validated even if they have not changed.
+
+    Parameters
+    ----------
+    provider: object
+        The metadata provider.
+    identifiers: iterable of unicode
+        Identifiers of the items.
+    prefixes: list of unicode
+        Prefixes of the metadata formats.
+    since: datetime.datetime or None
+        Time of the last update. If no item has a harvest time, items
+        which have not changed after this time are not updated.
+    dry_run: bool
+        If `True`, do not modify the database.
+    batch_size: int
+        Maximum number of records to update in one transaction.
+    batch_interval: float or None
+        Maximum number of seconds to keep a transaction open, or
+        ``None`` for no limit.
+    pool: concurrent.futures.Executor or None
+        Worker pool created with ``create_worker_pool()``.
+    force: bool
+        If `True`, update all items.
+    validator: RecordValidator or None
+        Validator for the records, or ``None`` to not validate them.
+    changed: bool
+        If `True`, the items are known to have changed, so the provider
+        is not asked whether they have.
+    """
     log = logging.getLogger(__name__)
-    if since is not None:
-        log.info('Updating records modified since {0} UTC...'
-                 ''.format(since))
-    else:
+    harvest_time = datestamp_now()
+    if force:
         log.info('Updating all records...')
+    else:
+        log.info('Updating changed records...')
+    if force or changed:
+        items = ((identifier, None) for identifier in identifiers)
+    else:
+        if since is not None and models.Item.any_harvested():
+            # The time of the last update is only needed for
+            # databases created by older versions.
+            since = None
+        items = _with_harvest_times(identifiers, since)
 
+    # The digests are looked up before fetching, so that workers can
+    # skip validating unchanged records.
+    items = _with_digests(items, validator is not None)
+    batches = _is_batch_provider(provider)
+    if pool is not None:
+        # The workers check the records against the formats.
+        formats = dict(
+            (format_.prefix, (format_.namespace, format_.schema))
+            for format_ in models.Format.list(ignore_deleted=True)
+        )
+        items = _fetch_in_pool(pool, provider, items, prefixes,
+                               _FETCH_BATCH_SIZE if batches else 1,
+                               validator is not None, formats)
+    elif batches:
+        items = _fetch_batches(provider, items, prefixes)
+    else:
+        items = ((identifier, item_since, provider, digests)
+                 for identifier, item_since, digests in items)
+
+    # The sets are loaded once for all items.
+    registry = _SetRegistry()
+    batch = _TransactionBatch(batch_size, batch_interval, dry_run,
+                              harvest_time, registry.reset)
     updated = 0
-    for identifier in identifiers:
+    unchanged = 0
+    invalid = 0
+    for identifier, item_since, source, digests in items:
         try:
-            if (since is not None and
-                    not provider.has_changed(identifier, since)):
+            if (item_since is not None and
+                    not source.has_changed(identifier, item_since)):
                 log.debug('Skipping item "{0}"'.format(identifier))
+                if since is not None:
+                    # Give unchanged items of an old database a
+                    # harvest time of their own.
+                    batch.item_done(identifier, True)
                 continue
             log.debug('Updating item "{0}"'.format(identifier))
 
-            update_sets(provider, identifier, dry_run)
+            with models.savepoint():
+                update_sets(source, identifier, dry_run, registry)
         except Exception as e:
+            # Sets created by the item may have been rolled back.
+            registry.reset()
             log.exception(
                 'Failed to update item "{0}": {1}'
                 ''.format(identifier, e))
             continue
 
+        failed = False
         for prefix in prefixes:
             try:
-                xml = provider.get_record(identifier, prefix)
-                if xml is None:
-                    if not dry_run:
-                        models.Record.mark_as_deleted(identifier, prefix)
-                else:
-                    if not dry_run:
+                xml, tree = _serialize(source.get_record(identifier, prefix))
+                if xml is not None and _is_unchanged(
+                        source, digests, identifier, prefix, xml):
+                    log.debug('Format "{0}" of item "{1}" has not changed'
+                              ''.format(prefix, identifier))
+                    unchanged += 1
+                    continue
+                valid = None
+                if xml is not None and validator is not None:
+                    valid, message = _validate(source, validator, prefix,
+                                               xml, tree)
+                    if valid is False:
+                        invalid += 1
+                        log.warning(
+                            'Format "{0}" of item "{1}" is not valid: {2}'
+                            ''.format(prefix, identifier, message))
+                # Roll back only this record if it fails, not the
+                # whole batch.
+                with models.savepoint():
+                    if xml is None:
+                        if not dry_run:
+                            models.Record.mark_as_deleted(
+                                identifier, prefix
+                            )
+                    elif not dry_run:
                         models.Record.create_or_update(
-                            identifier, prefix, xml
+                            identifier, prefix, xml, tree=tree, valid=valid,
+                            checked=_is_checked(source, prefix)
                         )
+                if xml is not None:
                     updated += 1
             except Exception as e:
-                models.rollback()
+                failed = True
                 log.exception(
                     'Failed to disseminate format "{0}" '
                     'for item "{1}": {2}'
                     ''.format(prefix, identifier, e))
             else:
-                # Commit after each record so that the (esp. SQLite)
-                # database does not get locked for a long time.
-                if dry_run:
-                    models.rollback()
-                else:
-                    models.commit()
+                batch.add()
                 log.debug('Processed item "{0}"'.format(identifier))
 
-    # End the transaction in case no records were updated.
-    models.rollback()
+        batch.item_done(identifier, not failed)
+
+    batch.end()
 
     # TODO: log number of added records
     log.info('Updated {0} record{1}.'
              ''.format(updated, '' if updated == 1 else 's'))
+    if unchanged > 0:
+        log.info('Skipped {0} unchanged record{1}.'
+                 ''.format(unchanged, '' if unchanged == 1 else 's'))
+    if invalid > 0:
+        log.warning('Found {0} invalid record{1}.'
+                    ''.format(invalid, '' if invalid == 1 else 's'))
+
+
+def _is_unchanged(source, digests, identifier, prefix, xml):
+    # Return True if the record has the digest of the stored one. The
+    # records fetched by workers have been compared there already.
+    if isinstance(source, _FetchedItem) and prefix in source.unchanged:
+        return True
+    return digests.get((identifier, prefix)) == models.Record.make_digest(
+        xml)
+
+
+def _is_checked(source, prefix):
+    # Return True if a worker has checked the record against its
+    # format.
+    return isinstance(source, _FetchedItem) and prefix in source.checked
+
+
+def _validate(source, validator, prefix, xml, tree):
+    # Return the (valid, message) result of validating a record. The
+    # records fetched by workers have been validated there already.
+    if isinstance(source, _FetchedItem) and prefix in source.validation:
+        return source.validation[prefix]
+    return validator.validate(prefix, xml, tree)
+
+
+def update_fragments(rerender=False, batch_size=100):
+    """Render the fragments of records which do not have one.
+
+    Rendering errors are logged but not raised, since records without
+    a fragment are rendered when responding to requests instead.
+
+    Parameters
+    ----------
+    rerender: bool
+        If `True`, render the fragments of all records.
+    batch_size: int
+        Number of records to render in one transaction.
+    """
+    log = logging.getLogger(__name__)
+    log.debug('Rendering record fragments...')
+
+    rendered = 0
+    try:
+        if rerender:
+            models.Record.clear_fragments()
+            models.commit()
+        while True:
+            records = models.Record.list_without_fragment(batch_size)
+            if not records:
+                break
+            for record in records:
+                record.fragment = render_fragment(record)
+            rendered += len(records)
+            models.commit()
+    except Exception as e:
+        models.rollback()
+        log.exception('Failed to render record fragments: {0}'.format(e))
+
+    log.info('Rendered {0} record fragment{1}.'
+             ''.format(rendered, '' if rendered == 1 else 's'))
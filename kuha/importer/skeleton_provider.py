@@ -1,6 +1,12 @@
 class SkeletonProvider(object):
     """
     A skeleton of a metadata provider.
+
+    Providers which can fetch many items at once may also implement the
+    optional batch methods `changed_since`, `get_sets_many` and
+    `get_records_many` described in `kuha.importer.harvest.update`.
+    Providers which keep state between updates may implement
+    `update_finished`, which is described there too.
     """
 
     def __init__(self, settings):
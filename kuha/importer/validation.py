@@ -0,0 +1,122 @@
+from lxml import etree
+
+from ..exception import ConfigurationError
+
+
+class RecordValidator(object):
+    """Validate records against the XML schemas of their formats.
+
+    Each schema is compiled when it is first needed, and the compiled
+    schema is used for all following records of the format. Compiled
+    schemas should not be shared between threads, so each worker of
+    the importer has a validator of its own.
+
+    Parameters
+    ----------
+    schemas: dict from unicode to unicode
+        Paths of the XSD files keyed by metadata prefixes. Records of
+        other formats are not validated.
+    """
+
+    def __init__(self, schemas):
+        self.paths = dict(schemas)
+        self._schemas = {}
+
+    def schema(self, prefix):
+        """Return the compiled schema of a metadata format.
+
+        Parameters
+        ----------
+        prefix: unicode
+            The metadata prefix.
+
+        Return
+        ------
+        lxml.etree.XMLSchema or NoneType:
+            The schema, or `None` if the format has no schema.
+
+        Raises
+        ------
+        ConfigurationError:
+            If the schema cannot be loaded.
+        """
+        if prefix not in self._schemas:
+            path = self.paths.get(prefix)
+            if path is None:
+                return None
+            try:
+                self._schemas[prefix] = etree.XMLSchema(file=path)
+            except (IOError, etree.Error) as error:
+                raise ConfigurationError(
+                    'invalid schema for format "{0}": {1}'
+                    ''.format(prefix, error)
+                )
+        return self._schemas[prefix]
+
+    def compile_all(self):
+        """Compile the schemas of all formats.
+
+        Raises
+        ------
+        ConfigurationError:
+            If some schema cannot be loaded.
+        """
+        for prefix in self.paths:
+            self.schema(prefix)
+
+    def validate(self, prefix, xml, tree=None):
+        """Validate a record.
+
+        Parameters
+        ----------
+        prefix: unicode
+            The metadata prefix of the record.
+        xml: unicode
+            The XML data.
+        tree: lxml.etree._Element or None
+            The parsed XML data, if available. It is validated instead
+            of parsing the data again.
+
+        Return
+        ------
+        (bool or NoneType, unicode or NoneType):
+            Whether the record is valid, or `None` if the format has no
+            schema, and a description of the first error if the record
+            is not valid.
+
+        Raises
+        ------
+        ConfigurationError:
+            If the schema cannot be loaded.
+        """
+        schema = self.schema(prefix)
+        if schema is None:
+            return None, None
+        if tree is None:
+            try:
+                tree = etree.fromstring(xml)
+            except (ValueError, etree.XMLSyntaxError) as error:
+                return False, str(error)
+        if schema.validate(tree):
+            return True, None
+        return False, str(schema.error_log.last_error)
+
+
+def create_validator(settings):
+    """Create a record validator from the importer settings.
+
+    Parameters
+    ----------
+    settings: dict
+        The cleaned importer settings. The schemas are read from
+        ``validation_schemas``.
+
+    Return
+    ------
+    RecordValidator or NoneType:
+        The validator, or `None` if no schemas are configured.
+    """
+    schemas = settings.get('validation_schemas')
+    if not schemas:
+        return None
+    return RecordValidator(schemas)
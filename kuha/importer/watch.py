@@ -0,0 +1,445 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from .. import models
+from ..exception import ConfigurationError, HarvestError
+from .harvest import update, update_changed
+
+
+# Flags of inotify(7).
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Header of struct inotify_event: wd, mask, cookie and len.
+_EVENT = struct.Struct('iIII')
+
+# Changes are collected for at most this many times the delay, so that
+# files which are written continuously do not postpone updates forever.
+_MAX_DELAY_FACTOR = 10
+
+
+def _load_libc():
+    # Return the C library if it has inotify functions, otherwise None.
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher(object):
+    """Watch a directory tree with inotify.
+
+    Each directory of the tree is watched separately, and directories
+    created later are added to the watch.
+
+    Parameters
+    ----------
+    directory: str
+        Path of the directory.
+
+    Raises
+    ------
+    OSError:
+        If inotify is not available or the directory cannot be
+        watched, e.g. because the limit of watches has been reached.
+    """
+
+    _mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE |
+             IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF |
+             IN_ONLYDIR)
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._libc = _load_libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # Watched directories keyed by watch descriptors.
+        self._paths = {}
+        try:
+            self._add_tree(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, path):
+        # Watch a directory and its subdirectories. Return the paths of
+        # the files in them.
+        files = []
+        for subdir, _, filenames in os.walk(path):
+            self._add_watch(subdir)
+            files.extend(os.path.join(subdir, name) for name in filenames)
+        return files
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                          self._mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # Removed before it could be watched.
+                return
+            raise OSError(error, os.strerror(error), path)
+        self._paths[wd] = path
+
+    def read(self, timeout=None):
+        """Wait for changes.
+
+        Parameters
+        ----------
+        timeout: float or None
+            Maximum number of seconds to wait, or ``None`` to wait
+            until something changes.
+
+        Return
+        ------
+        (set of str, bool):
+            Paths of the changed files, and whether the whole directory
+            must be scanned again because the changed files are not
+            known.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        paths = set()
+        rescan = False
+        while True:
+            remaining = (None if deadline is None else
+                         max(0, deadline - time.monotonic()))
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if ready:
+                try:
+                    data = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    data = b''
+                rescan = self._parse(data, paths) or rescan
+            if (paths or rescan or
+                    (deadline is not None and time.monotonic() >= deadline)):
+                return paths, rescan
+
+    def _parse(self, data, paths):
+        # Add the changed files in the events to `paths`. Return True
+        # if the directory must be scanned again.
+        rescan = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost.
+                rescan = True
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            directory = self._paths.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if directory == self.directory:
+                    rescan = True
+                continue
+
+            path = os.path.join(directory, name)
+            if not mask & IN_ISDIR:
+                paths.add(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been added before the directory was
+                # watched.
+                paths.update(self._add_tree(path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                # The removed files are not known.
+                rescan = True
+        return rescan
+
+    def close(self):
+        """Stop watching."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher(object):
+    """Watch a directory tree by scanning it periodically.
+
+    Parameters
+    ----------
+    directory: str
+        Path of the directory.
+    interval: float
+        Number of seconds between scans.
+    """
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self._files = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        # Return the status of all files keyed by their paths.
+        files = {}
+        pending = [self.directory]
+        while pending:
+            path = pending.pop()
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                # Removed during the scan.
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    else:
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_size, stat.st_mtime_ns,
+                                             stat.st_ctime_ns, stat.st_ino)
+                except OSError:
+                    continue
+        return files
+
+    def read(self, timeout=None):
+        """Wait for changes.
+
+        See ``InotifyWatcher.read()``. The directory never needs to be
+        scanned again.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if deadline is not None and deadline < self._next_scan:
+                time.sleep(max(0, deadline - now))
+                return set(), False
+            time.sleep(max(0, self._next_scan - now))
+            self._next_scan = time.monotonic() + self.interval
+
+            files = self._scan()
+            paths = set(
+                path for path in set(files).union(self._files)
+                if files.get(path) != self._files.get(path)
+            )
+            self._files = files
+            if paths:
+                return paths, False
+
+    def close(self):
+        """Stop watching."""
+        pass
+
+
+def create_watcher(directory, method='auto', poll_interval=5):
+    """Create a watcher for a directory tree.
+
+    Parameters
+    ----------
+    directory: str
+        Path of the directory.
+    method: str
+        "inotify", "poll", or "auto" for inotify if it is available and
+        polling otherwise.
+    poll_interval: float
+        Number of seconds between scans when polling.
+
+    Return
+    ------
+    InotifyWatcher or PollingWatcher:
+        The watcher.
+    """
+    log = logging.getLogger(__name__)
+    if method != 'poll':
+        try:
+            return InotifyWatcher(directory)
+        except OSError as error:
+            if method == 'inotify':
+                raise
+            log.info('Cannot use inotify ({0}), polling instead.'
+                     ''.format(error))
+    return PollingWatcher(directory, poll_interval)
+
+
+def wait_for_changes(watcher, delay):
+    """Wait until files change and then stay unchanged for a while.
+
+    Files are often written in several steps or in groups, so waiting
+    for them to settle lets them be updated together.
+
+    Parameters
+    ----------
+    watcher: InotifyWatcher or PollingWatcher
+        The watcher.
+    delay: float
+        Number of seconds without changes to wait for.
+
+    Return
+    ------
+    (set of str, bool):
+        Paths of the changed files, and whether the whole directory
+        must be scanned again.
+    """
+    paths = set()
+    rescan = False
+    while not (paths or rescan):
+        paths, rescan = watcher.read()
+
+    started = time.monotonic()
+    max_delay = delay * _MAX_DELAY_FACTOR
+    while time.monotonic() - started < max_delay:
+        more_paths, more_rescan = watcher.read(delay)
+        if not (more_paths or more_rescan):
+            break
+        paths.update(more_paths)
+        rescan = rescan or more_rescan
+    return paths, rescan
+
+
+def start_watching(provider, settings):
+    """Start watching the directory of a metadata provider.
+
+    The provider must have the following methods in addition to those
+    used in ``harvest.update()``:
+
+        watched_directory(): str
+            Path of the directory to watch.
+
+        identifier_for_path(path: str): unicode or None
+            Return the OAI identifier of the item stored in the file,
+            or `None` if the file does not contain an item.
+
+    Parameters
+    ----------
+    provider: object
+        The metadata provider.
+    settings: dict
+        The cleaned importer settings.
+
+    Return
+    ------
+    InotifyWatcher or PollingWatcher:
+        The watcher, which collects the changes until they are read.
+
+    Raises
+    ------
+    ConfigurationError:
+        If the provider does not support watching.
+    """
+    log = logging.getLogger(__name__)
+    if not (hasattr(provider, 'watched_directory') and
+            hasattr(provider, 'identifier_for_path')):
+        raise ConfigurationError(
+            'the metadata provider does not support watching'
+        )
+
+    directory = provider.watched_directory()
+    watcher = create_watcher(directory,
+                             settings['watch_method'],
+                             settings['watch_poll_interval'])
+    log.info('Watching {0} for changes...'.format(directory))
+    return watcher
+
+
+def watch_directory(provider, settings, pool=None, validator=None,
+                    watcher=None):
+    """Update the database whenever the metadata files change.
+
+    Only the items of the changed files are updated. If the changed
+    files are not known, e.g. because a directory was removed, all
+    items are updated like in a regular import. This function runs
+    until it is interrupted.
+
+    Parameters
+    ----------
+    provider: object
+        The metadata provider. See ``start_watching()``.
+    settings: dict
+        The cleaned importer settings.
+    pool: concurrent.futures.Executor or None
+        Worker pool created with ``create_worker_pool()``.
+    validator: RecordValidator or None
+        Validator for the records. See ``harvest.update()``.
+    watcher: InotifyWatcher, PollingWatcher or None
+        Watcher created with ``start_watching()`` before the initial
+        import, so that files changed during the import are updated
+        too, or ``None`` to start watching now. The watcher is closed
+        when this function returns.
+
+    Raises
+    ------
+    ConfigurationError:
+        If the provider does not support watching.
+    """
+    log = logging.getLogger(__name__)
+    if watcher is None:
+        watcher = start_watching(provider, settings)
+
+    purge = settings['deleted_records'] == 'no'
+    options = dict(
+        purge=purge,
+        dry_run=settings['dry_run'],
+        batch_size=settings['harvest_batch_size'],
+        batch_interval=settings['harvest_batch_interval'],
+        pool=pool,
+        validator=validator,
+    )
+
+    try:
+        while True:
+            # Do not keep the database locked while waiting.
+            models.rollback()
+            paths, rescan = wait_for_changes(watcher,
+                                             settings['watch_delay'])
+            try:
+                if rescan:
+                    log.info('Updating all items...')
+                    update(provider, **options)
+                    continue
+
+                identifiers = set()
+                removed = set()
+                for path in paths:
+                    identifier = provider.identifier_for_path(path)
+                    if identifier is None:
+                        continue
+                    if os.path.isfile(path):
+                        identifiers.add(identifier)
+                    else:
+                        removed.add(identifier)
+                if identifiers or removed:
+                    log.info('Updating {0} changed item{1}...'.format(
+                        len(identifiers) + len(removed),
+                        '' if len(identifiers) + len(removed) == 1 else 's',
+                    ))
+                    update_changed(provider, identifiers, removed,
+                                   **options)
+            except HarvestError as error:
+                log.error('Failed to harvest metadata: {0}'.format(error))
+    finally:
+        watcher.close()
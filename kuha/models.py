@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import re
 
@@ -25,12 +26,115 @@ class _CreateMixin(object):
         return obj
 
 
+# Maximum number of values bound in one statement. SQLite limits the
+# number of parameters to 999 in older versions.
+_BATCH_SIZE = 500
+
+
+def _batches(values, size=_BATCH_SIZE):
+    # Split an iterable into lists of at most `size` values.
+    batch = []
+    for value in values:
+        batch.append(value)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _get(cls, key):
+    # Find an object by its primary key, or return None. The session
+    # only keeps weak references to loaded objects, so the objects
+    # found are kept until the end of the transaction. Records of the
+    # same format and item are then created without querying them
+    # again.
+    session = DBSession()
+    objects = session.info.setdefault(_LOADED_OBJECTS, {})
+    obj = objects.get((cls, key))
+    if obj is not None:
+        state = sa.inspect(obj)
+        if state.persistent or state.pending:
+            return obj
+    obj = session.get(cls, key)
+    if obj is not None:
+        objects[(cls, key)] = obj
+    return obj
+
+
 def create_engine(settings):
     """Connect to the database."""
     engine = sa.engine_from_config(settings, 'sqlalchemy.')
+    if engine.dialect.name == 'sqlite':
+        _fix_sqlite_transactions(engine)
     DBSession.configure(bind=engine)
     _Base.metadata.bind = engine
     _Base.metadata.create_all(engine)
+    create_missing_columns(engine)
+    create_missing_indexes(engine)
+
+
+def _fix_sqlite_transactions(engine):
+    # The sqlite3 module begins transactions only before data
+    # modifying statements, so a SAVEPOINT may begin and RELEASE
+    # commit the whole transaction. Let SQLAlchemy begin transactions
+    # instead.
+    @sa.event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @sa.event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+def create_missing_columns(engine):
+    """Add columns which do not exist in the database.
+
+    `create_all` does not alter existing tables, so columns added in
+    later versions have to be added separately for existing databases.
+    Only nullable columns without defaults can be added this way.
+
+    Parameters
+    ----------
+    engine: sqlalchemy.engine.Engine
+        The database engine.
+    """
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        # Inspect on the same connection. A second connection would
+        # share the connection of an in-memory SQLite database, which
+        # is already in a transaction.
+        inspector = sa.inspect(connection)
+        for table in _Base.metadata.sorted_tables:
+            existing = set(column['name'] for column
+                           in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = sa.schema.CreateColumn(column).compile(
+                    dialect=engine.dialect)
+                connection.execute(sa.text(
+                    'ALTER TABLE {0} ADD COLUMN {1}'
+                    ''.format(preparer.format_table(table), definition)
+                ))
+
+
+def create_missing_indexes(engine):
+    """Create indexes which do not exist in the database.
+
+    `create_all` only creates the indexes of new tables, so indexes
+    added in later versions have to be created separately for existing
+    databases.
+
+    Parameters
+    ----------
+    engine: sqlalchemy.engine.Engine
+        The database engine.
+    """
+    for table in _Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 
 def ensure_oai_dc_exists():
@@ -63,6 +167,35 @@ def rollback():
     transaction.abort()
 
 
+def savepoint():
+    """Begin a savepoint in the ongoing database transaction.
+
+    Return
+    ------
+    sqlalchemy.orm.SessionTransaction:
+        Context manager which releases the savepoint on exit, or rolls
+        back to it if an exception is raised.
+    """
+    return DBSession.begin_nested()
+
+
+def discard_inherited_connections():
+    """Forget the database connections inherited by a forked process.
+
+    A process forked while the parent has connections open must not
+    use them, nor close or roll them back, since the parent is still
+    using them. The session of the thread and the connection pool are
+    dropped without touching the connections, so the child opens new
+    connections if it uses the database.
+    """
+    engine = DBSession.session_factory.kw.get('bind')
+    if isinstance(engine, sa.engine.Engine):
+        engine.dispose(close=False)
+    # Unlike DBSession.remove(), this does not roll back the
+    # connection of the session.
+    DBSession.registry.clear()
+
+
 item_set_association = sa.Table(
     'item_set_association',
     _Base.metadata,
@@ -76,6 +209,12 @@ item_set_association = sa.Table(
         sa.String,
         sa.ForeignKey('items.identifier')
     ),
+    # for listing the records of a set
+    sa.Index('ix_item_set_association_set_item',
+             'set_spec', 'item_identifier'),
+    # for loading the set specs of records
+    sa.Index('ix_item_set_association_item_set',
+             'item_identifier', 'set_spec'),
 )
 
 
@@ -96,9 +235,18 @@ class Set(_Base, _CreateMixin):
         self.spec = spec
         self.name = name
 
+    @classmethod
+    def create(cls, *args, **kwargs):
+        # Override create() to update the database datestamp.
+        obj = super(Set, cls).create(*args, **kwargs)
+        Datestamp.update()
+        return obj
+
     def update(self, name):
         """Change the name of this set."""
-        self.name = name
+        if self.name != name:
+            self.name = name
+            Datestamp.update()
 
     @classmethod
     def create_or_update(cls, spec, name):
@@ -114,13 +262,75 @@ class Set(_Base, _CreateMixin):
         except orm.exc.NoResultFound:
             return cls.create(spec, name)
         else:
-            set_.name = name
+            set_.update(name)
             return set_
 
     @classmethod
     def list(cls):
         return DBSession.query(cls).all()
 
+    @classmethod
+    def list_names(cls):
+        """Return the names of all sets keyed by their specs.
+
+        Only the specs and names are loaded, so the result stays valid
+        after the transaction ends.
+
+        Return
+        ------
+        dict from unicode to unicode:
+            Names of the sets keyed by the set specs.
+        """
+        return dict(DBSession.query(cls.spec, cls.name))
+
+    @classmethod
+    def create_many(cls, sets):
+        """Add sets to the database in bulk.
+
+        The sets are inserted with batched statements bypassing the
+        session, so the specs must not exist in the database.
+
+        Parameters
+        ----------
+        sets: iterable of (unicode, unicode)
+            (set spec, set name) tuples of the new sets.
+
+        Raises
+        ------
+        ValueError:
+            If some set spec is not valid.
+        """
+        sets = list(sets)
+        for spec, _ in sets:
+            if cls._spec_pattern.match(spec) is None:
+                raise ValueError('invalid set spec: {0}'.format(spec))
+        if not sets:
+            return
+        for batch in _batches(sets):
+            DBSession.execute(
+                cls.__table__.insert(),
+                [{'spec': spec, 'name': name} for spec, name in batch],
+            )
+        zope.sqlalchemy.mark_changed(DBSession())
+        Datestamp.update()
+
+    @classmethod
+    def rename(cls, spec, name):
+        """Change the name of an existing set.
+
+        Parameters
+        ----------
+        spec: unicode
+            The set spec.
+        name: unicode
+            The new name of the set.
+        """
+        DBSession.query(cls).filter_by(spec=spec).update(
+            {'name': name},
+            synchronize_session='fetch'
+        )
+        Datestamp.update()
+
 
 class Format(_Base, _CreateMixin):
     """The SQLAlchemy model class for an OAI metadata format."""
@@ -142,6 +352,13 @@ class Format(_Base, _CreateMixin):
         self.schema = schema
         self.deleted = False
 
+    @classmethod
+    def create(cls, *args, **kwargs):
+        # Override create() to update the database datestamp.
+        obj = super(Format, cls).create(*args, **kwargs)
+        Datestamp.update()
+        return obj
+
     @classmethod
     def exists(cls, prefix, ignore_deleted=False):
         """Check wheter a metadata format is supported.
@@ -207,6 +424,9 @@ class Format(_Base, _CreateMixin):
             # associated records might no longer be valid. Mark
             # them as deleted.
             self.mark_as_deleted()
+        elif self.deleted:
+            # The format is restored.
+            Datestamp.update()
 
         self.namespace = namespace
         self.schema = schema
@@ -242,6 +462,7 @@ class Format(_Base, _CreateMixin):
         """Mark this format and associated records as deleted."""
         Record.mark_as_deleted(prefix=self.prefix)
         self.deleted = True
+        Datestamp.update()
 
 
 class Item(_Base, _CreateMixin):
@@ -249,6 +470,10 @@ class Item(_Base, _CreateMixin):
     __tablename__ = 'items'
     identifier = sa.Column(sa.String, primary_key=True)
     deleted = sa.Column(sa.Boolean, nullable=False)
+    # Start time of the last import which updated the sets and all
+    # records of this item successfully, or NULL if there has been
+    # none since the item was added.
+    harvested = sa.Column(sa.DateTime)
 
     sets = orm.relationship('Set', secondary=item_set_association)
 
@@ -256,15 +481,81 @@ class Item(_Base, _CreateMixin):
         self.identifier = identifier
         self.deleted = False
 
-    def clear_sets(self):
-        self.sets = []
+    @classmethod
+    def list_set_specs(cls, identifiers):
+        """Fetch the specs of the sets which contain many items.
 
-    def add_to_set(self, set_):
-        self.sets.append(set_)
+        Parameters
+        ----------
+        identifiers: list of unicode
+            OAI identifier URIs of the items.
+
+        Return
+        ------
+        dict from unicode to set of unicode:
+            Set specs keyed by identifiers. Items which are not in any
+            set are not included.
+        """
+        columns = item_set_association.c
+        specs = {}
+        for batch in _batches(identifiers):
+            rows = DBSession.execute(
+                sa.select(columns.item_identifier, columns.set_spec)
+                  .where(columns.item_identifier.in_(batch))
+            )
+            for identifier, spec in rows:
+                specs.setdefault(identifier, set()).add(spec)
+        return specs
+
+    @classmethod
+    def change_sets(cls, identifier, added, removed):
+        """Add an item to sets and remove it from others in bulk.
+
+        Only the given memberships are inserted and deleted, with
+        statements bypassing the session, so ``sets`` of an item loaded
+        earlier in the transaction is not updated. If anything changes,
+        the record fragments of the item are cleared, since the set
+        specs are part of them, and the datestamp is updated.
+
+        Parameters
+        ----------
+        identifier: unicode
+            OAI identifier URI of the item.
+        added: iterable of unicode
+            Specs of the sets to add the item to.
+        removed: iterable of unicode
+            Specs of the sets to remove the item from.
+        """
+        table = item_set_association
+        added = sorted(added)
+        removed = sorted(removed)
+        if not added and not removed:
+            return
+        for batch in _batches(added):
+            DBSession.execute(
+                table.insert(),
+                [{'set_spec': spec, 'item_identifier': identifier}
+                 for spec in batch],
+            )
+        for batch in _batches(removed):
+            DBSession.execute(
+                table.delete()
+                     .where(table.c.item_identifier == identifier)
+                     .where(table.c.set_spec.in_(batch))
+            )
+        # The transaction manager does not see statements executed
+        # directly, so they would not be committed.
+        zope.sqlalchemy.mark_changed(DBSession())
+        Record.clear_fragments(identifier)
+        Datestamp.update()
 
     @classmethod
     def get(cls, identifier):
-        return DBSession.query(cls).filter_by(identifier=identifier).one()
+        item = _get(cls, identifier)
+        if item is None:
+            raise orm.exc.NoResultFound(
+                'non-existent identifier: "{0}"'.format(identifier))
+        return item
 
     @classmethod
     def create_or_update(cls, identifier):
@@ -280,6 +571,8 @@ class Item(_Base, _CreateMixin):
         except orm.exc.NoResultFound:
             return cls.create(identifier)
         else:
+            if item.deleted:
+                item.harvested = None
             item.deleted = False
             return item
 
@@ -332,6 +625,135 @@ class Item(_Base, _CreateMixin):
         """Mark this item and associated records as deleted."""
         Record.mark_as_deleted(identifier=self.identifier)
         self.deleted = True
+        self.harvested = None
+
+    @classmethod
+    def list_identifiers(cls, identifiers=None):
+        """Return the identifiers of all items.
+
+        Only the identifiers and deletion flags are loaded, so this is
+        much cheaper than ``list()`` for large repositories.
+
+        Parameters
+        ----------
+        identifiers: list of unicode or None
+            If given, only look up the items with these identifiers.
+
+        Return
+        ------
+        dict:
+            Mapping from identifiers to the deletion flags of the items.
+        """
+        if identifiers is None:
+            return dict(DBSession.query(cls.identifier, cls.deleted))
+        items = {}
+        for batch in _batches(identifiers):
+            items.update(DBSession.query(cls.identifier, cls.deleted)
+                                  .filter(cls.identifier.in_(batch)))
+        return items
+
+    @classmethod
+    def create_many(cls, identifiers):
+        """Add items to the database in bulk.
+
+        The items are inserted with batched statements bypassing the
+        session, so the identifiers must not exist in the database.
+
+        Parameters
+        ----------
+        identifiers: iterable of unicode
+            OAI identifier URIs of the new items.
+        """
+        for batch in _batches(identifiers):
+            DBSession.execute(
+                cls.__table__.insert(),
+                [{'identifier': i, 'deleted': False} for i in batch],
+            )
+            # The transaction manager does not see statements executed
+            # directly, so they would not be committed.
+            zope.sqlalchemy.mark_changed(DBSession())
+
+    @classmethod
+    def undelete_many(cls, identifiers):
+        """Mark deleted items as existing again.
+
+        Parameters
+        ----------
+        identifiers: iterable of unicode
+            OAI identifier URIs of the items.
+        """
+        for batch in _batches(identifiers):
+            DBSession.query(cls).filter(cls.identifier.in_(batch)).update(
+                {'deleted': False, 'harvested': None},
+                synchronize_session='fetch'
+            )
+
+    @classmethod
+    def mark_many_as_deleted(cls, identifiers):
+        """Mark items and associated records as deleted.
+
+        Parameters
+        ----------
+        identifiers: iterable of unicode
+            OAI identifier URIs of the items.
+        """
+        for batch in _batches(identifiers):
+            Record.mark_as_deleted(identifiers=batch)
+            DBSession.query(cls).filter(cls.identifier.in_(batch)).update(
+                {'deleted': True, 'harvested': None},
+                synchronize_session='fetch'
+            )
+
+    @classmethod
+    def list_harvest_times(cls, identifiers):
+        """Fetch the harvest times of many items.
+
+        Parameters
+        ----------
+        identifiers: list of unicode
+            OAI identifier URIs of the items.
+
+        Return
+        ------
+        dict from unicode to datetime.datetime:
+            Harvest times keyed by identifiers. Items which have not
+            been harvested are not included.
+        """
+        times = {}
+        for batch in _batches(identifiers):
+            rows = (DBSession.query(cls.identifier, cls.harvested)
+                             .filter(cls.identifier.in_(batch))
+                             .filter(cls.harvested.isnot(None)))
+            times.update(rows)
+        return times
+
+    @classmethod
+    def any_harvested(cls):
+        """Check whether any item has a harvest time.
+
+        Databases created by older versions have no harvest times
+        until the next import.
+        """
+        query = DBSession.query(cls.identifier).filter(
+            cls.harvested.isnot(None))
+        return query.first() is not None
+
+    @classmethod
+    def mark_harvested(cls, identifiers, time):
+        """Set the harvest time of items.
+
+        Parameters
+        ----------
+        identifiers: iterable of unicode
+            OAI identifier URIs of the items.
+        time: datetime.datetime
+            Start time of the import.
+        """
+        for batch in _batches(identifiers):
+            DBSession.query(cls).filter(cls.identifier.in_(batch)).update(
+                {'harvested': time},
+                synchronize_session='fetch'
+            )
 
 
 class Record(_Base, _CreateMixin):
@@ -350,23 +772,39 @@ class Record(_Base, _CreateMixin):
     datestamp = sa.Column(sa.DateTime, nullable=False)
     xml = sa.Column(sa.Text)
     deleted = sa.Column(sa.Boolean, nullable=False)
+    # The rendered record element in UTF-8, or NULL if it has not been
+    # rendered after the record was changed.
+    fragment = sa.Column(sa.LargeBinary)
+    # Digest of the XML data for detecting changes without loading it,
+    # or NULL for records stored by older versions.
+    digest = sa.Column(sa.String)
+    # Whether the XML data is valid according to the XML schema of the
+    # format, or NULL if it has not been validated.
+    valid = sa.Column(sa.Boolean)
+
+    # Indexes for listing records ordered by identifier.
+    __table_args__ = (
+        sa.Index('ix_records_prefix_deleted_identifier',
+                 'prefix', 'deleted', 'identifier'),
+        sa.Index('ix_records_prefix_datestamp_identifier',
+                 'prefix', 'datestamp', 'identifier'),
+    )
 
-    def __init__(self, identifier, prefix, xml, datestamp=None):
-        try:
-            format_ = (DBSession.query(Format)
-                                .filter_by(prefix=prefix)
-                                .one())
-        except orm.exc.NoResultFound:
+    # Set specs loaded by load_set_specs().
+    _set_specs = None
+
+    def __init__(self, identifier, prefix, xml, datestamp=None, tree=None,
+                 valid=None, checked=False):
+        # The format and the item are usually loaded in the session
+        # already, so they are looked up without a query.
+        format_ = _get(Format, prefix)
+        if format_ is None:
             raise ValueError(
                 'non-existent metadata prefix: "{0}"'
                 ''.format(prefix)
             )
 
-        try:
-            item = (DBSession.query(Item)
-                             .filter_by(identifier=identifier)
-                             .one())
-        except orm.exc.NoResultFound:
+        if _get(Item, identifier) is None:
             raise ValueError(
                 'non-existent identifier: "{0}"'
                 ''.format(identifier)
@@ -378,9 +816,63 @@ class Record(_Base, _CreateMixin):
                           else datestamp_now())
         self.xml = xml
         self.deleted = False
+        self.digest = self.make_digest(xml)
+        self.valid = valid
+
+        if self.xml is not None and not checked:
+            self._check_xml(self.xml, format_, tree)
+
+    @staticmethod
+    def make_digest(xml):
+        """Compute the digest of XML data.
+
+        Parameters
+        ----------
+        xml: unicode or bytes or None
+            The XML data.
 
-        if self.xml is not None:
-            self._check_xml(self.xml, format_)
+        Return
+        ------
+        unicode or None:
+            Hexadecimal SHA-1 digest of the data, or ``None`` if there
+            is no data.
+        """
+        if xml is None:
+            return None
+        if not isinstance(xml, bytes):
+            xml = xml.encode('utf-8')
+        return hashlib.sha1(xml).hexdigest()
+
+    @classmethod
+    def list_digests(cls, identifiers, validated=False):
+        """Fetch the digests of the records of many items.
+
+        Parameters
+        ----------
+        identifiers: list of unicode
+            Identifiers of the items.
+        validated: bool
+            If `True`, records which have not been validated are not
+            included either.
+
+        Return
+        ------
+        dict from (unicode, unicode) to unicode:
+            Digests of the records which are not deleted, keyed by
+            (identifier, prefix) tuples. Records without a digest are
+            not included.
+        """
+        digests = {}
+        for batch in _batches(identifiers):
+            rows = (DBSession.query(cls.identifier, cls.prefix, cls.digest)
+                             .filter(cls.identifier.in_(batch))
+                             .filter(cls.deleted.is_(False))
+                             .filter(cls.digest.isnot(None)))
+            if validated:
+                rows = rows.filter(cls.valid.isnot(None))
+            for identifier, prefix, digest in rows:
+                digests[(identifier, prefix)] = digest
+        return digests
 
     @classmethod
     def earliest_datestamp(cls, ignore_deleted=False):
@@ -418,7 +910,9 @@ class Record(_Base, _CreateMixin):
              set_=None,
              ignore_deleted=False,
              offset=None,
-             limit=None):
+             end_offset=None,
+             limit=None,
+             headers_only=False):
         """Return records that fulfill the conditions.
 
         Parameters
@@ -437,16 +931,123 @@ class Record(_Base, _CreateMixin):
             If `True`, exclude deleted records from the result.
         offset: unicode or None
             Minimum allowed identifier.
+        end_offset: unicode or None
+            Identifiers must be less than this.
         limit: int or None
             Maxmimum number of results.
+        headers_only: bool
+            If `True`, do not load the XML data of the records. Accessing
+            the ``xml`` attribute of the returned records raises an
+            exception.
 
         Return
         ------
         list of Record:
             The matching records. If no records match, an empty list is
-            returned.
+            returned. Set specs of the records are fetched with a single
+            query.
+        """
+        query = cls._query(identifier, metadata_prefix, from_date,
+                           until_date, set_, ignore_deleted, offset,
+                           end_offset, headers_only)
+        if limit is not None:
+            if limit < 0:
+                raise ValueError('negative limit: %d' % limit)
+            query = query.limit(limit)
+
+        records = query.all()
+        cls.load_set_specs(records)
+        return records
+
+    @classmethod
+    def iterate(cls, batch_size=100, **kwargs):
+        """Iterate over records that fulfill the conditions.
+
+        Unlike ``list()``, the records are fetched from the database in
+        batches while iterating, so the result set is never held in
+        memory at once. Set specs are fetched with one query per batch.
+
+        Parameters
+        ----------
+        batch_size: int
+            Number of records to fetch at a time.
+        **kwargs:
+            The same conditions as for ``list()``, except ``limit``.
+            Additionally, if ``fragments`` is `True`, the XML data and
+            set specs are only loaded for records without a fragment,
+            with one query per batch.
+
+        Return
+        ------
+        iterator of Record:
+            The matching records ordered by identifier.
+        """
+        fragments = kwargs.get('fragments', False)
+
+        def load(batch):
+            if fragments:
+                batch = [r for r in batch if r.fragment is None]
+                cls.load_xml(batch)
+            cls.load_set_specs(batch)
+
+        batch = []
+        for record in cls._query(**kwargs).yield_per(batch_size):
+            batch.append(record)
+            if len(batch) == batch_size:
+                load(batch)
+                for r in batch:
+                    yield r
+                batch = []
+        load(batch)
+        for r in batch:
+            yield r
+
+    @classmethod
+    def identifier_at(cls, position, **kwargs):
+        """Find the identifier of a record by its position.
+
+        Parameters
+        ----------
+        position: int
+            Position of the record among the records that fulfill the
+            conditions, ordered by identifier. The first record is at
+            position 0.
+        **kwargs:
+            The same conditions as for ``list()``, except ``limit``.
+
+        Return
+        ------
+        unicode or None:
+            The identifier, or ``None`` if there are not enough records.
         """
+        query = (cls._query(**kwargs).with_entities(cls.identifier)
+                                     .offset(position)
+                                     .limit(1))
+        return query.scalar()
+
+    @classmethod
+    def _query(cls,
+               identifier=None,
+               metadata_prefix=None,
+               from_date=None,
+               until_date=None,
+               set_=None,
+               ignore_deleted=False,
+               offset=None,
+               end_offset=None,
+               headers_only=False,
+               fragments=False):
+        # Build the query for list(), iterate() and identifier_at().
         query = DBSession.query(cls)
+        if headers_only:
+            query = query.options(orm.defer(cls.xml, raiseload=True),
+                                  orm.defer(cls.fragment, raiseload=True))
+        elif fragments:
+            # The XML data is loaded in iterate() for the records
+            # without a fragment.
+            query = query.options(orm.defer(cls.xml))
+        else:
+            query = query.options(orm.defer(cls.fragment))
 
         if identifier is not None:
             query = query.filter_by(identifier=identifier)
@@ -466,33 +1067,57 @@ class Record(_Base, _CreateMixin):
 
         if offset is not None:
             query = query.filter(cls.identifier >= offset)
-        if limit is not None:
-            if limit < 0:
-                raise ValueError('negative limit: %d' % limit)
-            query = query.limit(limit)
-
-        return query.all()
+        if end_offset is not None:
+            query = query.filter(cls.identifier < end_offset)
+        return query
 
     @classmethod
     def create(cls, *args, **kwargs):
         # Override create() to update the database datestamp.
         obj = super(Record, cls).create(*args, **kwargs)
-        Datestamp.update()
+        Datestamp.update(earliest=obj.datestamp)
         return obj
 
-    def update(self, xml):
-        """Change the XML data of this record."""
-        if self.deleted or self.xml != xml:
-            # Check the data.
-            format_ = (DBSession.query(Format)
-                                .filter_by(prefix=self.prefix)
-                                .one())
-            self._check_xml(xml, format_)
+    def update(self, xml, tree=None, valid=None, checked=False):
+        """Change the XML data of this record.
+
+        Parameters
+        ----------
+        xml: unicode
+            The XML data.
+        tree: lxml.etree._Element or None
+            The parsed XML data, if available. It is checked instead of
+            parsing the data again.
+        valid: bool or None
+            Result of validating the data against the XML schema of the
+            format, or `None` if it has not been validated. If the data
+            has not changed, the stored result is kept unless this is
+            given.
+        checked: bool
+            If `True`, the data has been checked with ``check_xml()``
+            already, so it is neither parsed nor checked again.
+        """
+        digest = self.make_digest(xml)
+        if self.digest is None and not self.deleted and self.xml == xml:
+            # Stored by an older version without a digest.
+            self.digest = digest
+            if valid is not None:
+                self.valid = valid
+        elif self.deleted or self.digest != digest:
+            if not checked:
+                self._check_xml(xml, _get(Format, self.prefix), tree)
 
             self.xml = xml
+            self.digest = digest
+            self.valid = valid
             self.deleted = False
             self.datestamp = datestamp_now()
+            self.fragment = None
             Datestamp.update()
+        elif valid is not None:
+            # Validated without changing the data, e.g. stored before
+            # the validation was enabled. The responses do not change.
+            self.valid = valid
 
     @property
     def set_specs(self):
@@ -501,38 +1126,85 @@ class Record(_Base, _CreateMixin):
         Sets which are parent sets of sets that contain the record are
         excluded from the result.
         """
-        result = []
-        # Fetch all set specs.
-        specs = (DBSession.query(Set.spec).join(Item.sets)
-                          .filter(Item.identifier==self.identifier)
-                          .all())
-        specs = [s for (s,) in specs]
-        # Sort to descending order by level.
-        specs.sort(key=lambda x: -x.count(':'))
-        # A set containing the specs of sets whose subsets have already
-        # been processed.
-        processed = set()
-        for spec in specs:
-            if spec not in processed:
-                result.append(spec)
-                # Mark all parent sets of the set as processed.
-                i = 0
-                try:
-                    while True:
-                        i = spec.index(':', i)
-                        processed.add(spec[:i])
-                        i += 1
-                except ValueError:
-                    pass
-        return result
-
-    @classmethod
-    def create_or_update(cls, identifier, prefix, xml):
+        if self._set_specs is None:
+            self.load_set_specs([self])
+        return self._set_specs
+
+    @classmethod
+    def load_xml(cls, records):
+        """Fetch the deferred XML data of many records with a single
+        query.
+
+        Parameters
+        ----------
+        records: list of Record
+            The records whose XML data is loaded.
+        """
+        if not records:
+            return
+        keys = dict(((r.identifier, r.prefix), r) for r in records)
+        rows = (DBSession.query(cls.identifier, cls.prefix, cls.xml)
+                         .filter(cls.identifier.in_(
+                             set(r.identifier for r in records)))
+                         .filter(cls.prefix.in_(
+                             set(r.prefix for r in records)))
+                         .all())
+        for identifier, prefix, xml in rows:
+            record = keys.get((identifier, prefix))
+            if record is not None:
+                orm.attributes.set_committed_value(record, 'xml', xml)
+
+    @classmethod
+    def load_set_specs(cls, records):
+        """Fetch the set specs of many records with a single query.
+
+        The result is stored in the records so that accessing
+        ``set_specs`` does not query the database again.
+
+        Parameters
+        ----------
+        records: list of Record
+            The records whose set specs are loaded.
+        """
+        if not records:
+            return
+        identifiers = set(r.identifier for r in records)
+        specs = dict((identifier, []) for identifier in identifiers)
+        rows = (DBSession.query(Item.identifier, Set.spec)
+                         .join(Item.sets)
+                         .filter(Item.identifier.in_(identifiers))
+                         .all())
+        for identifier, spec in rows:
+            specs[identifier].append(spec)
+        for record in records:
+            record._set_specs = _leaf_set_specs(specs[record.identifier])
+
+    @classmethod
+    def create_or_update(cls, identifier, prefix, xml, tree=None,
+                         valid=None, checked=False):
         """Add a Record to the database or update an existing one.
 
         Try to find the Record by the identifier and prefix. If no Record
         is found, create a new one.
 
+        Parameters
+        ----------
+        identifier: unicode
+            Identifier of the item.
+        prefix: unicode
+            Prefix of the metadata format.
+        xml: unicode
+            The XML data.
+        tree: lxml.etree._Element or None
+            The parsed XML data, if available. It is checked instead of
+            parsing the data again.
+        valid: bool or None
+            Result of validating the data against the XML schema of the
+            format, or `None` if it has not been validated.
+        checked: bool
+            If `True`, the data has been checked with ``check_xml()``
+            already, e.g. in another process.
+
         Return
         ------
         Record:
@@ -544,60 +1216,186 @@ class Record(_Base, _CreateMixin):
             If some value is not valid.
         """
         try:
+            # The old data is compared by its digest, so it is not
+            # loaded unless necessary.
             record = (DBSession.query(cls)
+                               .options(orm.defer(cls.xml),
+                                        orm.defer(cls.fragment))
                                .filter_by(identifier=identifier,
                                           prefix=prefix)
                                .one())
         except orm.exc.NoResultFound:
-            return cls.create(identifier, prefix, xml)
+            return cls.create(identifier, prefix, xml, tree=tree,
+                              valid=valid, checked=checked)
         else:
-            record.update(xml)
+            record.update(xml, tree, valid, checked)
             return record
 
     @classmethod
-    def mark_as_deleted(cls, identifier=None, prefix=None):
-        """Mark records matching the identifier and prefix as deleted."""
+    def mark_as_deleted(cls, identifier=None, prefix=None, identifiers=None):
+        """Mark records matching the identifier and prefix as deleted.
+
+        If ``identifiers`` is given, only the records of the listed
+        items are marked.
+        """
         query = DBSession.query(cls)
         if identifier is not None:
             query = query.filter_by(identifier=identifier)
+        if identifiers is not None:
+            query = query.filter(cls.identifier.in_(identifiers))
         if prefix is not None:
             query = query.filter_by(prefix=prefix)
         query = query.filter(cls.deleted.is_(False))
         updated = query.update(
-            {'deleted': True, 'datestamp': datestamp_now()},
+            {'deleted': True, 'datestamp': datestamp_now(), 'fragment': None},
             synchronize_session='fetch'
         )
         if updated > 0:
             Datestamp.update()
 
-    def _check_xml(self, xml, format_):
-        # Check that the xml is well-formed.
-        tree = etree.fromstring(xml)
-
-        if etree.QName(tree.tag).namespace != format_.namespace:
-            raise ValueError('wrong xml namespace')
+    @classmethod
+    def clear_fragments(cls, identifier=None):
+        """Mark the fragments of records as outdated.
 
-        # Check that the xml has the correct schema location.
-        xml_schemas = tree.get(
-            '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'
+        Parameters
+        ----------
+        identifier: unicode or None
+            Identifier of the item whose records are affected. If
+            ``None``, clear the fragments of all records.
+        """
+        query = DBSession.query(cls)
+        if identifier is not None:
+            query = query.filter_by(identifier=identifier)
+        query.filter(cls.fragment.isnot(None)).update(
+            {'fragment': None},
+            synchronize_session='fetch'
         )
-        if xml_schemas is None:
-            raise ValueError('no schema location')
 
-        for s in xml_schemas.split():
-            if s == format_.schema:
-                break
-        else:
-            raise ValueError('wrong schema location')
+    @classmethod
+    def list_without_fragment(cls, limit):
+        """Fetch records which need their fragment rendered.
+
+        Parameters
+        ----------
+        limit: int
+            Maximum number of records to fetch.
+
+        Return
+        ------
+        list of Record:
+            Records without a fragment, with their set specs loaded.
+        """
+        records = (DBSession.query(cls)
+                            .filter(cls.fragment.is_(None))
+                            .order_by(cls.identifier, cls.prefix)
+                            .limit(limit)
+                            .all())
+        cls.load_set_specs(records)
+        return records
+
+    def _check_xml(self, xml, format_, tree=None):
+        check_xml(xml, format_.namespace, format_.schema, tree)
+
+
+def check_xml(xml, namespace, schema, tree=None):
+    """Check the XML data of a record against its metadata format.
+
+    The importer calls this in the worker processes, where the data has
+    been parsed, so that records do not have to be parsed again when
+    they are stored.
+
+    Parameters
+    ----------
+    xml: unicode
+        The XML data.
+    namespace: unicode
+        The namespace of the format.
+    schema: unicode
+        The schema location of the format.
+    tree: lxml.etree._Element or None
+        The parsed XML data, if available. Otherwise the data is parsed.
+
+    Raises
+    ------
+    lxml.etree.XMLSyntaxError:
+        If the data is not well-formed.
+    ValueError:
+        If the root element does not have the namespace or the schema
+        location of the format.
+    """
+    # Check that the xml is well-formed, unless it has been parsed
+    # already.
+    if tree is None:
+        tree = etree.fromstring(xml)
+
+    if etree.QName(tree.tag).namespace != namespace:
+        raise ValueError('wrong xml namespace')
+
+    # Check that the xml has the correct schema location.
+    xml_schemas = tree.get(
+        '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'
+    )
+    if xml_schemas is None:
+        raise ValueError('no schema location')
+
+    for s in xml_schemas.split():
+        if s == schema:
+            break
+    else:
+        raise ValueError('wrong schema location')
+
+
+def _leaf_set_specs(specs):
+    """Exclude parent sets from a list of set specs.
+
+    Parameters
+    ----------
+    specs: list of unicode
+        Specs of sets which contain an item.
+
+    Return
+    ------
+    list of unicode:
+        The specs which are not parent sets of other specs in the list.
+    """
+    result = []
+    # Sort to descending order by level.
+    specs = sorted(specs, key=lambda x: -x.count(':'))
+    # A set containing the specs of sets whose subsets have already
+    # been processed.
+    processed = set()
+    for spec in specs:
+        if spec not in processed:
+            result.append(spec)
+            # Mark all parent sets of the set as processed.
+            i = 0
+            try:
+                while True:
+                    i = spec.index(':', i)
+                    processed.add(spec[:i])
+                    i += 1
+            except ValueError:
+                pass
+    return result
 
 
 class Datestamp(_Base, _CreateMixin):
     """The SQLAlchemy model class for the datestamp of the database."""
     __tablename__ = 'datestamp'
     datestamp = sa.Column(sa.DateTime, primary_key=True)
-
-    def __init__(self, datestamp):
+    # Lower limit for the datestamps of all records. The datestamps of
+    # existing records only increase, so this is only moved back when
+    # a record with an earlier datestamp is created.
+    earliest = sa.Column(sa.DateTime)
+    # Number of times the datestamp has been written. Unlike the
+    # datestamp, it tells apart changes made within the same second.
+    # NULL until the first write by a version which counts them.
+    version = sa.Column(sa.Integer)
+
+    def __init__(self, datestamp, earliest=None):
         self.datestamp = datestamp
+        self.earliest = earliest
+        self.version = 1
 
     @classmethod
     def get(cls):
@@ -616,14 +1414,140 @@ class Datestamp(_Base, _CreateMixin):
         return None
 
     @classmethod
-    def update(cls):
-        """Set the database datestamp to the current time."""
+    def get_with_version(cls):
+        """Fetch the database modification datestamp and version.
+
+        Return
+        ------
+        tuple of (datetime.datetime or None, int or None):
+            The datestamp of the latest database modification and the
+            number of modifications, which changes even when the
+            datestamp does not. Both are ``None`` if the database has
+            never been modified.
+        """
+        result = DBSession.query(cls.datestamp, cls.version).first()
+        if result is None:
+            return None, None
+        datestamp, version = result
+        return datestamp, version
+
+    @classmethod
+    def get_with_earliest(cls):
+        """Fetch the database modification datestamp and the earliest
+        record datestamp.
+
+        Return
+        ------
+        tuple of (datetime.datetime or None, datetime.datetime or None):
+            The datestamp of the latest database modification and
+            a lower limit for the datestamps of the records. The
+            latter is ``None`` if there are no records in the database.
+        """
+        result = DBSession.query(cls.datestamp, cls.earliest).first()
+        if result is None:
+            return None, None
+        datestamp, earliest = result
+        if earliest is None:
+            # The database was created before the earliest datestamp
+            # was stored.
+            earliest = Record.earliest_datestamp()
+        return datestamp, earliest
+
+    @classmethod
+    def update(cls, earliest=None):
+        """Set the database datestamp to the current time.
+
+        The datestamp is only written when the transaction is committed
+        or the datestamp is queried, so a transaction which changes many
+        records writes it once. Each write also increments the version,
+        which identifies the contents of the database even if it is
+        changed many times in a second.
+
+        Parameters
+        ----------
+        earliest: datetime.datetime or None
+            The datestamp of a new record. The stored earliest
+            datestamp is moved back to it if necessary.
+        """
+        session = DBSession()
+        pending = session.info.get(_PENDING_DATESTAMP)
+        if pending is not None and pending[1] is not None and (
+                earliest is None or pending[1] < earliest):
+            earliest = pending[1]
+        session.info[_PENDING_DATESTAMP] = (datestamp_now(), earliest)
+        # Make sure that the transaction is committed even if nothing
+        # else has been flushed.
+        zope.sqlalchemy.mark_changed(session)
+
+    @classmethod
+    def write_pending(cls, session=None):
+        """Write the datestamp set by ``update()`` in this transaction.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session or None
+            The session, or ``None`` for the current session.
+        """
+        if session is None:
+            session = DBSession()
+        pending = session.info.pop(_PENDING_DATESTAMP, None)
+        if pending is None:
+            return
+        now, earliest = pending
+
         try:
-            datestamp = DBSession.query(cls).one()
-            datestamp.datestamp = datestamp_now()
+            datestamp = session.query(cls).one()
         except orm.exc.NoResultFound:
-            DBSession.add(cls(datestamp_now()))
+            datestamp = None
         except orm.exc.MultipleResultsFound:
             logging.getLogger(__name__).warning('Multiple datestamps')
-            DBSession.query(cls).delete(synchronize_session='fetch')
-            DBSession.add(cls(datestamp_now()))
+            session.query(cls).delete(synchronize_session='fetch')
+            datestamp = None
+
+        # Find the earliest datestamp before changing the row, so that
+        # the query does not flush it twice.
+        stored = datestamp.earliest if datestamp is not None else None
+        if stored is None:
+            stored = Record.earliest_datestamp()
+        if earliest is None or (stored is not None and stored < earliest):
+            earliest = stored
+
+        if datestamp is None:
+            session.add(cls(now, earliest))
+        else:
+            datestamp.datestamp = now
+            datestamp.earliest = earliest
+            datestamp.version = (datestamp.version or 0) + 1
+
+
+# Key of the datestamp update waiting for the commit in the info of the
+# session. The value is a (datestamp, earliest) tuple.
+_PENDING_DATESTAMP = 'kuha.pending_datestamp'
+
+# Key of the objects found by _get() in the info of the session.
+_LOADED_OBJECTS = 'kuha.loaded_objects'
+
+
+@sa.event.listens_for(DBSession, 'before_commit')
+def _write_pending_datestamp(session):
+    # Releasing a savepoint also triggers this event.
+    if not session.in_nested_transaction():
+        Datestamp.write_pending(session)
+
+
+@sa.event.listens_for(DBSession, 'do_orm_execute')
+def _write_datestamp_before_statement(orm_execute_state):
+    # Statements in the same transaction see the pending datestamp.
+    if (_PENDING_DATESTAMP in orm_execute_state.session.info and
+            Datestamp.__mapper__ in orm_execute_state.all_mappers):
+        Datestamp.write_pending(orm_execute_state.session)
+
+
+@sa.event.listens_for(DBSession, 'after_transaction_end')
+def _discard_transaction_state(session, transaction):
+    # The datestamp update is lost with the changes if the transaction
+    # is rolled back, and loaded objects may be changed by others after
+    # the transaction.
+    if transaction.parent is None:
+        session.info.pop(_PENDING_DATESTAMP, None)
+        session.info.pop(_LOADED_OBJECTS, None)
@@ -5,6 +5,8 @@ from pyramid.paster import setup_logging
 
 from ..config import clean_oai_settings
 from ..models import create_engine, ensure_oai_dc_exists
+from .cache import create_response_cache
+from .streaming import StreamingRendererFactory
 
 def main(global_config, **app_config):
     """ This function returns a Pyramid WSGI application.
@@ -19,8 +21,20 @@ def main(global_config, **app_config):
     ensure_oai_dc_exists()
 
     config = Configurator(settings=settings)
+    config.registry.response_cache = create_response_cache(settings)
     config.include('pyramid_tm')
     config.include('pyramid_chameleon')
+    config.add_renderer('listidentifiers_stream', StreamingRendererFactory(
+        'templates/listidentifiers.pt',
+        'templates/header.pt',
+        'ListIdentifiers',
+    ))
+    config.add_renderer('listrecords_stream', StreamingRendererFactory(
+        'templates/listrecords.pt',
+        'templates/record.pt',
+        'ListRecords',
+        fragments=True,
+    ))
     config.add_route('oai', '/oai', request_method=('GET', 'POST'))
     config.scan()
     return config.make_wsgi_app()
@@ -0,0 +1,223 @@
+import collections
+import os
+import tempfile
+import threading
+
+
+class MemoryCache(object):
+    """Response cache in the memory of the process.
+
+    The least recently used responses are evicted when the total size
+    of the cached responses exceeds ``max_size``.
+
+    Parameters
+    ----------
+    max_size: int
+        Maximum total size of the cached responses in bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached response.
+
+        Parameters
+        ----------
+        key: str
+            The key of the response.
+
+        Return
+        ------
+        bytes or None:
+            The cached response, or ``None`` if it is not in the cache.
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Add a response to the cache.
+
+        Parameters
+        ----------
+        key: str
+            The key of the response.
+        value: bytes
+            The response body.
+        """
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class FileCache(object):
+    """Response cache in a directory.
+
+    The directory can be shared by several worker processes. Each
+    response is stored in its own file, and the modification time of
+    the file is updated when it is used. The least recently used
+    responses are evicted when the total size of the files exceeds
+    ``max_size``.
+
+    Parameters
+    ----------
+    directory: str
+        Path of the cache directory. It is created if it does not exist.
+    max_size: int
+        Maximum total size of the cached responses in bytes.
+    """
+
+    # Prefix of partially written files.
+    _temp_prefix = '.tmp-'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Get a cached response.
+
+        Parameters
+        ----------
+        key: str
+            The key of the response. Must be usable as a file name.
+
+        Return
+        ------
+        bytes or None:
+            The cached response, or ``None`` if it is not in the cache.
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as file_:
+                value = file_.read()
+            os.utime(path)
+        except OSError:
+            # Not cached, or evicted by another process.
+            return None
+        return value
+
+    def set(self, key, value):
+        """Add a response to the cache.
+
+        Parameters
+        ----------
+        key: str
+            The key of the response. Must be usable as a file name.
+        value: bytes
+            The response body.
+        """
+        if len(value) > self.max_size:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                         prefix=self._temp_prefix)
+        try:
+            with os.fdopen(fd, 'wb') as file_:
+                file_.write(value)
+            # Readers never see partially written files.
+            os.replace(temp_path, os.path.join(self.directory, key))
+        except OSError:
+            os.remove(temp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        # Remove the least recently used files until the total size is
+        # within the limit.
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(self._temp_prefix):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process.
+                pass
+            total -= size
+
+
+def create_response_cache(settings):
+    """Create the response cache configured in the settings.
+
+    Parameters
+    ----------
+    settings: dict
+        The cleaned OAI app settings.
+
+    Return
+    ------
+    MemoryCache or FileCache or None:
+        The response cache, or ``None`` if caching is disabled.
+    """
+    kind = settings['response_cache']
+    if kind == 'memory':
+        return MemoryCache(settings['response_cache_size'])
+    elif kind == 'file':
+        return FileCache(settings['response_cache_directory'],
+                         settings['response_cache_size'])
+    return None
+
+
+def store_iterated(app_iter, cache, key):
+    """Store a response body in the cache while it is being sent.
+
+    Parameters
+    ----------
+    app_iter: iterable of bytes
+        The response body.
+    cache: MemoryCache or FileCache
+        The response cache.
+    key: str
+        The key of the response.
+
+    Return
+    ------
+    iterator of bytes:
+        Iterator over ``app_iter``. The body is stored in the cache
+        only if it is iterated to the end.
+    """
+    chunks = []
+    size = 0
+    try:
+        for chunk in app_iter:
+            if chunks is not None:
+                size += len(chunk)
+                if size > cache.max_size:
+                    # Too large to be cached.
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+    finally:
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+    if chunks is not None:
+        cache.set(key, b''.join(chunks))
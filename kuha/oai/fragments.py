@@ -0,0 +1,35 @@
+import os
+
+from chameleon.zpt.template import PageTemplateFile
+
+from ..util import format_datestamp
+
+
+_record_template = None
+
+
+def render_fragment(record):
+    """Render the ``<record>`` element of a ListRecords response.
+
+    The fragment is rendered from the same template as the records of
+    ListRecords responses, so it can be used in place of the template.
+
+    Parameters
+    ----------
+    record: Record
+        The record. Its set specs must be loaded.
+
+    Return
+    ------
+    bytes:
+        The record element encoded in UTF-8.
+    """
+    global _record_template
+    if _record_template is None:
+        _record_template = PageTemplateFile(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            'templates',
+            'record.pt',
+        ))
+    text = _record_template(record=record, format_date=format_datestamp)
+    return text.encode('utf-8')
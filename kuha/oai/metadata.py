@@ -0,0 +1,110 @@
+from collections import namedtuple
+
+from ..models import Format, Set
+
+
+FormatInfo = namedtuple('FormatInfo', ['prefix', 'namespace', 'schema',
+                                       'deleted'])
+SetInfo = namedtuple('SetInfo', ['spec', 'name'])
+
+
+class RepositoryMetadata(object):
+    """Metadata formats and sets of the repository.
+
+    The formats and sets only change during imports, which also update
+    the database datestamp. The loaded values are kept in the
+    application registry and reused until the datestamp or the
+    version of the database changes. The version also changes within
+    the same second.
+
+    Parameters
+    ----------
+    datestamp: datetime.datetime or None
+        The database datestamp at the time of loading.
+    version: int or None
+        The database version at the time of loading.
+    """
+
+    def __init__(self, datestamp, version=None):
+        self.datestamp = datestamp
+        self.version = version
+        self.formats = [
+            FormatInfo(f.prefix, f.namespace, f.schema, f.deleted)
+            for f in Format.list()
+        ]
+        self.sets = [SetInfo(s.spec, s.name) for s in Set.list()]
+        self._prefixes = dict((f.prefix, f) for f in self.formats)
+        self._specs = frozenset(s.spec for s in self.sets)
+
+    def format_exists(self, prefix, ignore_deleted=False):
+        """Check whether a metadata format is supported.
+
+        Parameters
+        ----------
+        prefix: unicode
+            A metadata prefix.
+        ignore_deleted: bool
+            If `True`, consider deleted formats as not existing.
+
+        Return
+        ------
+        bool:
+            ``True`` if the metadata format is supported, ``False``
+            otherwise.
+        """
+        format_ = self._prefixes.get(prefix)
+        if format_ is None:
+            return False
+        return not (ignore_deleted and format_.deleted)
+
+    def list_formats(self, ignore_deleted=False):
+        """Return all supported metadata formats.
+
+        Parameters
+        ----------
+        ignore_deleted: bool
+            If `True`, exclude deleted formats from the result.
+
+        Return
+        ------
+        list of FormatInfo:
+            The supported metadata formats.
+        """
+        return [f for f in self.formats
+                if not (ignore_deleted and f.deleted)]
+
+    def has_sets(self):
+        """Check whether the repository supports sets."""
+        return len(self.sets) > 0
+
+    def set_exists(self, spec):
+        """Check whether a set exists."""
+        return spec in self._specs
+
+
+def get_metadata(request):
+    """Get the metadata formats and sets of the repository.
+
+    Parameters
+    ----------
+    request: pyramid.request.Request
+        The request being handled. The database datestamp and version
+        are read from its ``datestamp`` and ``database_version``
+        attributes.
+
+    Return
+    ------
+    RepositoryMetadata:
+        The formats and sets at the current database datestamp.
+    """
+    datestamp = request.datestamp
+    version = request.database_version
+    metadata = getattr(request.registry, '_kuha_metadata', None)
+    if (metadata is None or datestamp is None
+            or (metadata.datestamp, metadata.version) !=
+               (datestamp, version)):
+        # The database has never been modified or has been modified
+        # after the metadata was loaded.
+        metadata = RepositoryMetadata(datestamp, version)
+        request.registry._kuha_metadata = metadata
+    return metadata
@@ -0,0 +1,72 @@
+from pyramid.renderers import get_renderer
+
+from ..models import rollback
+
+
+class StreamingRendererFactory(object):
+    """Renderer factory for incrementally rendered list responses.
+
+    The response document is rendered from ``template`` without any
+    items and split in two right before the resumption token (or the
+    end of the ``container`` element). The items are rendered one at a
+    time with ``item_template`` between the two parts. The renderer
+    returns an iterator, so the items are fetched and rendered while
+    the response is being sent instead of all at once.
+
+    Parameters
+    ----------
+    template: str
+        Name of the template for the whole response.
+    item_template: str
+        Name of the template for a single item. The item is passed to
+        the template as ``record``.
+    container: str
+        Tag name of the element which contains the items.
+    fragments: bool
+        If `True`, items which have a pre-rendered ``fragment`` are
+        output as is instead of rendering ``item_template``.
+    """
+
+    def __init__(self, template, item_template, container, fragments=False):
+        self.template = template
+        self.item_template = item_template
+        self.container = container
+        self.fragments = fragments
+
+    def __call__(self, info):
+        package = info.package
+
+        def render(value, system):
+            template = get_renderer(self.template, package)
+            item_template = get_renderer(self.item_template, package)
+
+            items = value['records']
+            values = dict(value, records=[])
+            document = template(dict(values), dict(system))
+
+            if value['token'] is not None:
+                split = document.index('<resumptionToken')
+            else:
+                split = document.rindex('</{0}>'.format(self.container))
+            head, tail = document[:split], document[split:]
+
+            return self._generate(head, tail, items, item_template,
+                                  dict(system, **values))
+
+        return render
+
+    def _generate(self, head, tail, items, item_template, values):
+        try:
+            yield head.encode('utf-8')
+            for item in items:
+                if self.fragments and item.fragment is not None:
+                    yield bytes(item.fragment)
+                    continue
+                text = item_template({'record': item}, dict(values))
+                yield text.encode('utf-8')
+            yield tail.encode('utf-8')
+        finally:
+            # The transaction of the request has already been committed
+            # when the response body is iterated, so fetching the items
+            # started a new transaction.
+            rollback()
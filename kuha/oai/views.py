@@ -1,9 +1,13 @@
 import datetime
+import hashlib
 import json
 import functools
 
 from pyramid.view import view_config
-from pyramid.renderers import get_renderer
+from pyramid.renderers import get_renderer, render
+from pyramid.response import Response
+from webob.datetime_utils import parse_date as parse_http_date
+from webob.etag import ETagMatcher
 
 from .. import exception
 from ..util import (
@@ -18,13 +22,24 @@ from ..models import (
     Record,
     Format,
     Datestamp,
-    Set,
 )
+from .cache import store_iterated
+from .metadata import get_metadata
 
 
 def oai_view(wrapped):
     """Augment the return value of a function with common template
-    parameters and add time property to the request parameter."""
+    parameters and add time property to the request parameter.
+
+    If the function returns a response object, it is passed through
+    unchanged.
+
+    The response gets an entity tag and a modification time derived
+    from the database datestamp and version. If the request has matching
+    conditional headers, the function is not called and a 304 response
+    is returned instead. If a response cache is configured, the entity
+    tag is also used as the cache key.
+    """
 
     def wrapper(context, request=None):
         if request is None:
@@ -33,12 +48,32 @@ def oai_view(wrapped):
 
         # Get the datestamp before any database queries.
         setattr(request, 'time', datestamp_now())
+        datestamp, version = Datestamp.get_with_version()
+        setattr(request, 'datestamp', datestamp)
+        setattr(request, 'database_version', version)
+
+        validators = _get_validators(request)
+        if validators is not None:
+            etag, last_modified = validators
+            request.response.etag = (etag, False)
+            request.response.last_modified = last_modified
+            if _is_not_modified(request, etag, last_modified):
+                request.response.status_int = 304
+                del request.response.content_type
+                return request.response
+
+            cached = _get_cached_response(request, etag)
+            if cached is not None:
+                return cached
 
         if wrapped.__code__.co_argcount == 1:
             result = wrapped(request)
         else:
             result = wrapped(context, request)
 
+        if isinstance(result, Response):
+            return result
+
         # time of the response
         result['time'] = request.time
         # function for formatting datestamps
@@ -69,24 +104,43 @@ def invalid_verb_view(request):
 
 
 @view_config(route_name='oai',
-             request_param='verb=Identify',
-             renderer='templates/identify.pt')
+             request_param='verb=Identify')
 @oai_view
 def handle_identify(request):
     _check_params(request.params)
 
-    ignore_deleted = _get_ignore_deleted(request)
-    earliest = Record.earliest_datestamp(ignore_deleted)
-
-    # Current time is a lower bound when there are no records.
-    context = {'earliest': earliest or request.time}
-    for value in ['repository_name',
-                  'admin_emails',
-                  'deleted_records',
-                  'repository_descriptions',
-                 ]:
-        context[value] = request.registry.settings[value]
-    return context
+    # Everything except the response date stays the same until the
+    # database is modified, so the rendered response is cached.
+    datestamp, earliest = Datestamp.get_with_earliest()
+    key = (datestamp, request.database_version, earliest, request.path_url)
+    cached = getattr(request.registry, '_kuha_identify', None)
+    if cached is None or cached[0] != key or datestamp is None:
+        # Current time is a lower bound when there are no records.
+        context = {
+            'earliest': earliest or request.time,
+            'time': request.time,
+            'format_date': format_datestamp,
+        }
+        for value in ['repository_name',
+                      'admin_emails',
+                      'deleted_records',
+                      'repository_descriptions',
+                     ]:
+            context[value] = request.registry.settings[value]
+        body = render('templates/identify.pt', context, request=request)
+
+        # Split the body around the response date.
+        start = body.index('<responseDate>') + len('<responseDate>')
+        end = body.index('</responseDate>', start)
+        cached = (key, body[:start], body[end:])
+        request.registry._kuha_identify = cached
+
+    _, head, tail = cached
+    response = request.response
+    response.content_type = 'text/xml'
+    response.charset = 'UTF-8'
+    response.text = head + format_datestamp(request.time) + tail
+    return response
 
 
 @view_config(route_name='oai',
@@ -94,16 +148,13 @@ def handle_identify(request):
              renderer='templates/listsets.pt')
 @oai_view
 def handle_list_sets(request):
-    try:
-        if _get_resumption_token(request):
-            # Resumption tokens are not used for ListSets.
-            raise exception.InvalidResumptionToken()
-    except exception.ExpiredResumptionToken:
+    if _get_resumption_token(request):
+        # Resumption tokens are not used for ListSets.
         raise exception.InvalidResumptionToken()
 
     _check_params(request.params)
 
-    sets = Set.list()
+    sets = get_metadata(request).sets
     if len(sets) == 0:
         raise exception.NoSetHierarchy()
     else:
@@ -119,7 +170,10 @@ def handle_list_metadata_formats(request):
 
     ignore_deleted = _get_ignore_deleted(request)
     identifier = _get_identifier(request.params, ignore_deleted)
-    formats = Format.list(identifier, ignore_deleted)
+    if identifier is None:
+        formats = get_metadata(request).list_formats(ignore_deleted)
+    else:
+        formats = Format.list(identifier, ignore_deleted)
 
     if identifier is not None and not formats:
         raise exception.NoMetadataFormats(identifier)
@@ -133,10 +187,10 @@ def handle_list_metadata_formats(request):
 
 @view_config(route_name='oai',
              request_param='verb=ListIdentifiers',
-             renderer='templates/listidentifiers.pt')
+             renderer='listidentifiers_stream')
 @view_config(route_name='oai',
              request_param='verb=ListRecords',
-             renderer='templates/listrecords.pt')
+             renderer='listrecords_stream')
 @oai_view
 def handle_list_items(request):
     limit = request.registry.settings['item_list_limit']
@@ -153,14 +207,36 @@ def handle_list_items(request):
                     'until',
                     'set']
         allowed = []
+        # The date of the token was checked by _get_resumption_token().
+        snapshot, _ = parse_date(token_params['date'])
     else:
-      required = ['metadataPrefix']
-      allowed = ['from', 'until', 'set']
+        required = ['metadataPrefix']
+        allowed = ['from', 'until', 'set']
+        # Records modified after the first request of a list request
+        # sequence are left out from all of its responses, so that
+        # imports do not affect ongoing harvests.
+        snapshot = request.time
+
+    # Only the headers are needed for ListIdentifiers.
+    headers_only = (request.params['verb'] == 'ListIdentifiers')
 
     try:
         _check_params(params, required=required, allowed=allowed)
         ignore_deleted = _get_ignore_deleted(request)
-        records, next_offset = _get_records(params, ignore_deleted, limit)
+        records, next_offset = _get_records(
+            params, ignore_deleted, limit, get_metadata(request),
+            headers_only=headers_only,
+            snapshot=snapshot,
+        )
+    except (exception.CannotDisseminateFormat,
+            exception.NoSetHierarchy,
+            exception.NoRecordsMatch):
+        if has_token:
+            # The format, sets or the remaining records have been removed
+            # after the token was issued, so the list request sequence
+            # cannot be completed.
+            raise exception.ExpiredResumptionToken()
+        raise
     except exception.OaiException:
         if has_token:
             # Raise a BadResumptionToken instead since the parameters were
@@ -171,7 +247,7 @@ def handle_list_items(request):
     if next_offset is not None:
         # Need to send a resumption token.
         new_token = _create_resumption_token(
-            params, next_offset, request.time)
+            params, next_offset, snapshot)
     elif token_params is not None:
         # Send an empty resumption token with the last set of results.
         new_token = ''
@@ -182,15 +258,18 @@ def handle_list_items(request):
     return {'records': records, 'token': new_token}
 
 
-def _create_resumption_token(params, offset, time):
+def _create_resumption_token(params, offset, snapshot):
     """Create a resumption token for a ListRecords or ListIdentifiers
     request.
+
+    The token contains the identifier of the next record and the
+    time of the first request in the list request sequence.
     """
     return json.dumps({
         'verb': params['verb'],
         'metadataPrefix': params['metadataPrefix'],
         'offset': offset,
-        'date': format_datestamp(time),
+        'date': format_datestamp(snapshot),
         'from': params.get('from', None),
         'until': params.get('until', None),
         'set': params.get('set', None),
@@ -207,7 +286,9 @@ def handle_get_record(request):
 
     ignore_deleted = _get_ignore_deleted(request)
     identifier = _get_identifier(request.params, ignore_deleted)
-    prefix = _get_metadata_prefix(request.params, ignore_deleted)
+    prefix = _get_metadata_prefix(request.params,
+                                  ignore_deleted,
+                                  get_metadata(request))
 
     records = Record.list(
         identifier=identifier,
@@ -222,6 +303,141 @@ def handle_get_record(request):
     return {'record': records[0]}
 
 
+def _get_validators(request):
+    """Compute the HTTP cache validators for a response.
+
+    The response to a request only depends on the request parameters,
+    the settings, the code and templates of the application, and the
+    contents of the database. The database version changes whenever
+    the contents change. The start time of the application stands in
+    for the code and templates, which may change when it is restarted.
+
+    Parameters
+    ----------
+    request: pyramid.request.Request
+        The request being handled.
+
+    Return
+    ------
+    tuple of (str, datetime.datetime) or None:
+        A weak entity tag and the modification time of the response,
+        or ``None`` if the database has never been modified.
+    """
+    if request.datestamp is None:
+        # The current time is used in place of the datestamp.
+        return None
+
+    registry = request.registry
+    app_state = getattr(registry, '_kuha_app_state', None)
+    if app_state is None:
+        # The settings do not change while the application is running.
+        settings = repr(sorted(
+            (key, repr(value)) for key, value in registry.settings.items()
+        ))
+        app_state = (hashlib.sha1(settings.encode('utf-8')).hexdigest(),
+                     request.time)
+        registry._kuha_app_state = app_state
+    settings_digest, started = app_state
+
+    key = json.dumps([
+        settings_digest,
+        format_datestamp(started),
+        format_datestamp(request.datestamp),
+        request.database_version,
+        request.path_url,
+        sorted(request.params.items()),
+    ])
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return etag, max(request.datestamp, started)
+
+
+def _get_cached_response(request, key):
+    """Get a response from the response cache.
+
+    If the response is not cached, arrange it to be stored when it has
+    been rendered.
+
+    Parameters
+    ----------
+    request: pyramid.request.Request
+        The request being handled.
+    key: str
+        The cache key of the response.
+
+    Return
+    ------
+    pyramid.response.Response or None:
+        The cached response with the response date of this request, or
+        ``None`` if the response is not cached.
+    """
+    cache = getattr(request.registry, 'response_cache', None)
+    if cache is None or hasattr(request, 'cache_key'):
+        # No cache, or already looked up when the original view raised
+        # an OaiException.
+        return None
+
+    body = cache.get(key)
+    if body is None:
+        request.cache_key = key
+        request.add_response_callback(_store_response)
+        return None
+
+    start = body.index(b'<responseDate>') + len(b'<responseDate>')
+    end = body.index(b'</responseDate>', start)
+    response = request.response
+    response.content_type = 'text/xml'
+    response.charset = 'UTF-8'
+    response.body = (body[:start]
+                     + format_datestamp(request.time).encode('utf-8')
+                     + body[end:])
+    return response
+
+
+def _store_response(request, response):
+    """Store a rendered response in the response cache."""
+    if response.status_int != 200:
+        return
+    cache = request.registry.response_cache
+    if isinstance(response.app_iter, list):
+        cache.set(request.cache_key, b''.join(response.app_iter))
+    else:
+        # Streamed responses are stored once they have been sent.
+        response.app_iter = store_iterated(response.app_iter,
+                                           cache,
+                                           request.cache_key)
+
+
+def _is_not_modified(request, etag, last_modified):
+    """Check the conditional headers of a request.
+
+    Parameters
+    ----------
+    request: pyramid.request.Request
+        The request being handled.
+    etag: str
+        The entity tag of the response.
+    last_modified: datetime.datetime
+        The modification time of the response.
+
+    Return
+    ------
+    bool:
+        ``True`` if the client has an up to date copy of the response.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is present.
+        # Weak comparison, since the entity tags are weak.
+        return etag in ETagMatcher.parse(if_none_match, strong=False)
+    since = parse_http_date(request.headers.get('If-Modified-Since'))
+    if since is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return last_modified <= since
+    return False
+
+
 def _check_params(params, required=[], allowed=[]):
     """Check that request parameters are valid.
 
@@ -280,8 +496,8 @@ def _check_params(params, required=[], allowed=[]):
 def _get_resumption_token(request):
     """Check whether the request parameters contain a resumption token.
 
-    Also check that the resumption token is not expired and that it has the
-    correct verb. Other parameters in the resumption token are not checked.
+    Also check that the resumption token has a valid date and the correct
+    verb. Other parameters in the resumption token are not checked.
 
     Parameters
     ----------
@@ -296,8 +512,6 @@ def _get_resumption_token(request):
         tokens.
     InvalidResumptionToken:
         If the params contain an invalid resumption token.
-    ExpiredResumptionToken:
-        If the resumption token has expired.
 
     Return
     ------
@@ -326,47 +540,50 @@ def _get_resumption_token(request):
         raise exception.InvalidResumptionToken()
 
     # Check date.
-    _check_resumption_token_date(parsed)
+    _check_resumption_token_date(parsed, request.time)
 
     return parsed
 
 
-def _check_resumption_token_date(token):
+def _check_resumption_token_date(token, time):
     """Check that a resumption token's date is valid.
 
+    The date is the time of the first request in the list request
+    sequence. Records modified after it are not listed, so the token
+    remains valid regardless of later modifications to the database.
+
     Arguments
     ---------
     token: dict from str to str
         The parsed resumption token.
+    time: datetime.datetime
+        The time of the request.
 
     Raises
     ------
     InvalidResumptionToken:
-        If the date is in invalid format.
-    ExpiredResumptionToken:
-        If the resumption token has expired.
+        If the date is in invalid format or in the future.
     """
     try:
         date, _ = parse_date(token['date'])
     except:
         raise exception.InvalidResumptionToken()
-    latest = Datestamp.get()
-    if (latest is not None) and (latest >= date):
-        raise exception.ExpiredResumptionToken()
+    if date > time:
+        raise exception.InvalidResumptionToken()
 
 
 def _get_ignore_deleted(request):
     return request.registry.settings['deleted_records'] == 'no'
 
 
-def _get_metadata_prefix(params, ignore_deleted):
+def _get_metadata_prefix(params, ignore_deleted, metadata):
     """Check that metadata prefix in request parameters is supported.
 
     If the metadata prefix is not supported, raise
     ``UnsupportedMetadataFormat``. Otherwise return the prefix.
     """
     prefix = params['metadataPrefix']
-    if not Format.exists(prefix, ignore_deleted):
+    if not metadata.format_exists(prefix, ignore_deleted):
         raise exception.UnsupportedMetadataFormat(prefix)
     return prefix
 
@@ -398,7 +615,12 @@ def _get_identifier(params, ignore_deleted):
     return identifier
 
 
-def _get_records(params, ignore_deleted, limit):
+def _get_records(params,
+                 ignore_deleted,
+                 limit,
+                 metadata,
+                 headers_only=False,
+                 snapshot=None):
     """Fetch records from the model.
 
     Parameters
@@ -409,11 +631,18 @@ def _get_records(params, ignore_deleted, limit):
         If `True`, filter out deleted records.
     limit: int
         Maximum number of records to fetch.
+    metadata: RepositoryMetadata
+        The formats and sets of the repository.
+    headers_only: bool
+        If `True`, do not fetch the XML data of the records.
+    snapshot: datetime.datetime or None
+        If given, exclude records modified after this time.
 
     Return
     ------
-    list of object:
-        The fetched records.
+    iterator of object:
+        The fetched records. The records are fetched from the database
+        while iterating.
     str or None:
         The identifier of the next record, if there are more records left.
         Otherwise ``None``.
@@ -429,36 +658,43 @@ def _get_records(params, ignore_deleted, limit):
     UnsupportedMetadataFormat:
         If the ``metadataPrefix`` parameter is not supported.
     """
-    prefix = _get_metadata_prefix(params, ignore_deleted)
+    prefix = _get_metadata_prefix(params, ignore_deleted, metadata)
 
     from_date, until_date = _parse_from_and_until(
         params.get('from'), params.get('until'),
     )
+    if snapshot is not None:
+        until_date = (snapshot if until_date is None
+                      else min(until_date, snapshot))
 
-    if params.get('set') is not None and len(Set.list()) == 0:
-        raise exception.NoSetHierarchy()
+    if params.get('set') is not None:
+        if not metadata.has_sets():
+            raise exception.NoSetHierarchy()
+        if not metadata.set_exists(params['set']):
+            raise exception.NoRecordsMatch()
 
-    records = Record.list(
+    conditions = dict(
         metadata_prefix=prefix,
         from_date=from_date,
         until_date=until_date,
         set_=params.get('set'),
         ignore_deleted=ignore_deleted,
         offset=params.get('offset'),
-
-        # Try to fetch one extra record to see wheter there are records
-        # left, i.e. wheter we need to send a resumption token.
-        limit=limit + 1,
     )
 
-    if not records:
+    if Record.identifier_at(0, **conditions) is None:
         raise exception.NoRecordsMatch()
 
-    if len(records) == limit + 1:
-        # More records left.
-        return records[:-1], records[-1].identifier
-    # Got all records.
-    return records, None
+    # The first record after the page, if there are records left.
+    next_offset = Record.identifier_at(limit, **conditions)
+
+    records = Record.iterate(
+        end_offset=next_offset,
+        headers_only=headers_only,
+        fragments=not headers_only,
+        **conditions
+    )
+    return records, next_offset
 
 
 def _parse_from_and_until(from_date_str, until_date_str):
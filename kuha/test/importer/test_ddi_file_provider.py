@@ -0,0 +1,246 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import mock
+from lxml import etree
+
+from ...importer import ddi_file_provider
+from ...importer.ddi_file_provider import DdiFileProvider
+
+
+class TestDdiFileProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.manifest = os.path.join(self.directory, 'manifest.json')
+        self.ddi_directory = os.path.join(self.directory, 'ddi')
+        os.makedirs(os.path.join(self.ddi_directory, 'sub'))
+
+    def write(self, relpath, content=b'<codeBook/>', mtime=1000000000):
+        path = os.path.join(self.ddi_directory, relpath)
+        with open(path, 'wb') as file_:
+            file_.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def make_provider(self, manifest=True):
+        settings = {
+            'oai_domain_name': 'example.org',
+            'ddi_directory': self.ddi_directory,
+        }
+        if manifest:
+            settings['ddi_manifest_file'] = self.manifest
+        return DdiFileProvider(settings)
+
+    def test_scan_directory(self):
+        self.write('a.xml')
+        self.write(os.path.join('sub', 'b.XML'), b'<x/>')
+        self.write('c.txt')
+        files = ddi_file_provider.scan_directory(self.ddi_directory)
+        self.assertCountEqual(files, ['a.xml', os.path.join('sub', 'b.XML')])
+        self.assertEqual(files['a.xml'].size, len(b'<codeBook/>'))
+        self.assertEqual(files['a.xml'].mtime, 1000000000)
+
+    def test_identifiers(self):
+        self.write('b.xml')
+        self.write(os.path.join('sub', 'a.xml'))
+        provider = self.make_provider(manifest=False)
+        self.assertEqual(list(provider.identifiers()), [
+            'oai:example.org:b',
+            'oai:example.org:sub/a',
+        ])
+        self.assertIsNone(provider.changes)
+        self.assertFalse(os.path.exists(self.manifest))
+
+    def test_first_scan(self):
+        """Without a saved manifest, changes should not be reported."""
+        self.write('a.xml')
+        provider = self.make_provider()
+        list(provider.identifiers())
+        self.assertIsNone(provider.changes)
+        provider.update_finished()
+        self.assertEqual(ddi_file_provider.load_manifest(self.manifest),
+                         provider.files)
+
+    def test_manifest_saved_after_update(self):
+        """Changes should be reported until an update has finished."""
+        self.write('a.xml')
+        provider = self.make_provider()
+        list(provider.identifiers())
+        provider.update_finished()
+
+        self.write('b.xml')
+        list(self.make_provider().identifiers())
+        provider = self.make_provider()
+        list(provider.identifiers())
+        self.assertEqual(provider.changes.added, {'b.xml'})
+        provider.update_finished()
+
+        provider = self.make_provider()
+        list(provider.identifiers())
+        self.assertEqual(provider.changes.added, set())
+
+    def test_changes(self):
+        self.write('same.xml')
+        self.write('removed.xml')
+        self.write('modified.xml')
+        provider = self.make_provider()
+        list(provider.identifiers())
+        provider.update_finished()
+
+        os.remove(os.path.join(self.ddi_directory, 'removed.xml'))
+        # Replaced with the original modification time.
+        self.write('modified.xml', b'<codeBook>new</codeBook>')
+        self.write('added.xml')
+        provider = self.make_provider()
+        list(provider.identifiers())
+        self.assertEqual(provider.changes, ddi_file_provider.ManifestChanges(
+            added={'added.xml'},
+            removed={'removed.xml'},
+            modified={'modified.xml'},
+        ))
+
+        since = datetime(2100, 1, 1)
+        self.assertTrue(provider.has_changed('oai:example.org:added', since))
+        self.assertTrue(
+            provider.has_changed('oai:example.org:modified', since))
+        self.assertFalse(provider.has_changed('oai:example.org:same', since))
+
+    def test_has_changed(self):
+        self.write('a.xml')
+        provider = self.make_provider()
+        list(provider.identifiers())
+        identifier = 'oai:example.org:a'
+        self.assertTrue(provider.has_changed(identifier, datetime(2000, 1, 1)))
+        self.assertFalse(
+            provider.has_changed(identifier, datetime(2100, 1, 1)))
+
+    def test_has_changed_without_scan(self):
+        self.write('a.xml')
+        provider = self.make_provider()
+        self.assertTrue(
+            provider.has_changed('oai:example.org:a', datetime(2000, 1, 1)))
+
+    def test_invalid_manifest(self):
+        with open(self.manifest, 'w') as file_:
+            file_.write('not json')
+        self.write('a.xml')
+        provider = self.make_provider()
+        list(provider.identifiers())
+        self.assertIsNone(provider.changes)
+        provider.update_finished()
+        self.assertIn('a.xml', ddi_file_provider.load_manifest(self.manifest))
+
+    def test_get_record(self):
+        self.write('a.xml', b'''<codeBook>
+          <docDscr><citation><titlStmt><titl>Wrong</titl></titlStmt>
+          </citation></docDscr>
+          <stdyDscr>
+            <citation>
+              <titlStmt><titl>Title</titl><IDNo>1234</IDNo></titlStmt>
+              <rspStmt><AuthEnty>First</AuthEnty><AuthEnty>Second</AuthEnty>
+              </rspStmt>
+            </citation>
+            <stdyInfo><abstract><p>Abstract <b>bold</b></p></abstract>
+            </stdyInfo>
+          </stdyDscr>
+          <fileDscr><fileTxt><fileType>CSV</fileType></fileTxt></fileDscr>
+          <dataDscr><var name="x"><labl>Variable</labl></var></dataDscr>
+        </codeBook>''')
+        provider = self.make_provider(manifest=False)
+        dc = provider.get_record('oai:example.org:a', 'oai_dc')
+        self.assertEqual(
+            [(etree.QName(e).localname, e.text) for e in dc],
+            [
+                ('title', 'Title'),
+                ('creator', 'First'),
+                ('creator', 'Second'),
+                ('description', 'Abstract '),
+                ('format', 'CSV'),
+                ('identifier', '1234'),
+            ]
+        )
+        self.assertIsNone(provider.get_record('oai:example.org:a', 'ddi'))
+
+    def test_crosswalk_files(self):
+        crosswalk = os.path.join(self.directory, 'crosswalk.json')
+        with open(crosswalk, 'w') as file_:
+            json.dump({
+                'prefix': 'title',
+                'namespace': 'urn:title',
+                'schema': 'http://example.org/title.xsd',
+                'root': 't:record',
+                'namespaces': {'t': 'urn:title'},
+                'fields': [['t:name', ['stdyDscr/citation/titlStmt/titl']]],
+            }, file_)
+        self.write('a.xml', b'''<codeBook><stdyDscr><citation>
+            <titlStmt><titl>Title</titl></titlStmt>
+            </citation></stdyDscr></codeBook>''')
+        provider = DdiFileProvider({
+            'oai_domain_name': 'example.org',
+            'ddi_directory': self.ddi_directory,
+            'ddi_crosswalk_files': crosswalk,
+        })
+        self.assertEqual(provider.formats()['title'],
+                         ('urn:title', 'http://example.org/title.xsd'))
+        self.assertIn('oai_dc', provider.formats())
+
+        with mock.patch.object(provider.reader, 'read',
+                               wraps=provider.reader.read) as read:
+            dc = provider.get_record('oai:example.org:a', 'oai_dc')
+            record = provider.get_record('oai:example.org:a', 'title')
+        self.assertEqual(read.call_count, 1)
+        self.assertIn(b'Title</dc:title>', etree.tostring(dc))
+        self.assertEqual(
+            etree.tostring(record),
+            b'<t:record xmlns:t="urn:title" '
+            b'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            b'xsi:schemaLocation="urn:title http://example.org/title.xsd">'
+            b'<t:name>Title</t:name></t:record>'
+        )
+
+
+class TestCrosswalk(unittest.TestCase):
+
+    def test_unknown_namespace(self):
+        self.assertRaises(ValueError, ddi_file_provider.Crosswalk,
+                          'x', 'urn:x', 'x.xsd', 'x:root', {},
+                          [])
+
+    def test_paths(self):
+        self.assertIn('fileDscr/fileTxt/fileType',
+                      ddi_file_provider.DC_CROSSWALK.paths())
+
+
+class TestDdiReader(unittest.TestCase):
+
+    def test_skip_unmapped_elements(self):
+        """Elements outside the paths should be discarded while parsing."""
+        source = io.BytesIO(
+            b'<codeBook><dataDscr>' +
+            b'<var><labl>x</labl></var>' * 1000 +
+            b'</dataDscr><stdyDscr><a><b>1</b><b/><c>2</c></a></stdyDscr>'
+            b'</codeBook>'
+        )
+        roots = []
+        original_iterparse = etree.iterparse
+
+        def iterparse(*args, **kwargs):
+            for event, element in original_iterparse(*args, **kwargs):
+                if not roots:
+                    roots.append(element)
+                yield event, element
+
+        with mock.patch.object(ddi_file_provider.etree, 'iterparse',
+                               iterparse):
+            reader = ddi_file_provider.DdiReader(
+                ['stdyDscr/a/b', 'stdyDscr/d'])
+            texts = reader.read(source)
+        self.assertEqual(texts, {'stdyDscr/a/b': ['1', None],
+                                 'stdyDscr/d': []})
+        self.assertLessEqual(len(list(roots[0].iter())), 3)
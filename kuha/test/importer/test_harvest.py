@@ -1,13 +1,20 @@
+import contextlib
 import unittest
 from datetime import datetime
 import logging
+import signal
 
 import mock
+from lxml import etree
 
 from ..test_models import ModelTestCase
+from ... import models
+from ...models import Item
 from ..util import LogCapture
 from ...exception import HarvestError
 from ...importer import harvest
+from ...importer.validation import RecordValidator
+from .test_validation import OAI_DC_SCHEMA, VALID_DC, INVALID_DC
 
 def make_item(identifier):
     item = mock.Mock()
@@ -21,6 +28,16 @@ def make_format(prefix):
     return format_
 
 
+@contextlib.contextmanager
+def mock_models():
+    """Mock the models of a database without harvested items."""
+    with mock.patch.object(harvest, 'models') as models:
+        models.Item.any_harvested.return_value = False
+        models.Item.list_harvest_times.return_value = {}
+        models.Record.list_digests.return_value = {}
+        yield models
+
+
 class TestUpdateFormats(ModelTestCase):
 
     def test_successful_update(self):
@@ -102,37 +119,38 @@ class TestUpdateFormats(ModelTestCase):
 class TestUpdateItems(ModelTestCase):
 
     def test_successful_update(self):
-        identifiers = ['asd', 'U', 'a:b']
+        identifiers = ['asd', 'U', 'a:b', 'old']
         provider = mock.Mock()
         provider.identifiers.return_value = identifiers
-        item_mocks = [make_item('1234'), make_item('asd')]
 
         with LogCapture(harvest) as log:
             with mock.patch.object(harvest, 'models') as models:
-                models.Item.list.return_value = item_mocks
+                models.Item.list_identifiers.return_value = {
+                    '1234': False,
+                    'asd': False,
+                    'old': True,
+                    'gone': True,
+                }
                 new_ids = harvest.update_items(provider, purge=True)
 
         self.assertCountEqual(new_ids, identifiers)
         provider.identifiers.assert_called_once_with()
-        item_mocks[0].mark_as_deleted.assert_called_once_with()
-        self.assertEqual(item_mocks[1].mark_as_deleted.mock_calls, [])
-        self.assertCountEqual(
-            models.Item.create_or_update.mock_calls,
-            [mock.call(i) for i in ['asd', 'U', 'a:b']]
-        )
+        models.Item.mark_many_as_deleted.assert_called_once_with(['1234'])
+        models.Item.undelete_many.assert_called_once_with(['old'])
+        models.Item.create_many.assert_called_once_with(['U', 'a:b'])
         models.purge_deleted.assert_called_once_with()
         models.commit.assert_called_once_with()
-        log.assert_emitted('Removed 1 item and added 2 items.')
+        log.assert_emitted('Removed 1 item and added 3 items.')
 
     def test_no_identifiers(self):
         provider = mock.Mock()
         provider.identifiers.return_value = []
-        item_mock = make_item('id')
 
         with mock.patch.object(harvest, 'models') as models:
-            models.Item.list.return_value = [item_mock]
+            models.Item.list_identifiers.return_value = {'id': False}
             harvest.update_items(provider, purge=False)
-        item_mock.mark_as_deleted.assert_called_once_with()
+        models.Item.mark_many_as_deleted.assert_called_once_with(['id'])
+        models.Item.create_many.assert_called_once_with([])
 
     def test_provider_fails(self):
         provider = mock.Mock()
@@ -149,12 +167,9 @@ class TestUpdateItems(ModelTestCase):
         ]
 
         with mock.patch.object(harvest, 'models') as models:
-            models.Item.list.return_value = []
+            models.Item.list_identifiers.return_value = {}
             new_ids = harvest.update_items(provider, purge=False)
-        self.assertCountEqual(
-            models.Item.create_or_update.mock_calls,
-            [mock.call(i) for i in ['i1', 'i2', 'i3']]
-        )
+        models.Item.create_many.assert_called_once_with(['i1', 'i2', 'i3'])
         self.assertCountEqual(new_ids, ['i1', 'i2', 'i3'])
 
     def test_invalid_identifiers(self):
@@ -167,7 +182,7 @@ class TestUpdateItems(ModelTestCase):
         ]
 
         with mock.patch.object(harvest, 'models') as models:
-            models.Item.list.return_value = []
+            models.Item.list_identifiers.return_value = {}
             with self.assertRaises(HarvestError) as cm:
                 harvest.update_items(provider)
         self.assertIn('conversion failed', str(cm.exception))
@@ -175,20 +190,118 @@ class TestUpdateItems(ModelTestCase):
     def test_dry_run(self):
         provider = mock.Mock()
         provider.identifiers.return_value = ['asd']
-        item_mock = make_item('1234')
 
         with LogCapture(harvest) as log:
             with mock.patch.object(harvest, 'models') as models:
-                models.Item.list.return_value = [item_mock]
+                models.Item.list_identifiers.return_value = {'1234': False}
                 harvest.update_items(provider, purge=True, dry_run=True)
 
-        self.assertEqual(models.Item.create_or_update.mock_calls, [])
+        self.assertEqual(models.Item.create_many.mock_calls, [])
+        self.assertEqual(models.Item.undelete_many.mock_calls, [])
+        self.assertEqual(models.Item.mark_many_as_deleted.mock_calls, [])
         self.assertEqual(models.purge_deleted.mock_calls, [])
         self.assertEqual(models.commit.mock_calls, [])
-        self.assertEqual(item_mock.mark_as_deleted.mock_calls, [])
 
         log.assert_emitted('Removed 1 item and added 1 item.')
 
+    def test_database(self):
+        """The items should be reconciled in the database."""
+        Item.create('kept')
+        Item.create('removed')
+        Item.create('restored').deleted = True
+        provider = mock.Mock()
+        provider.identifiers.return_value = ['kept', 'restored', 'new']
+
+        with mock.patch.object(harvest.models, 'commit'):
+            harvest.update_items(provider)
+
+        self.assertEqual(Item.list_identifiers(), {
+            'kept': False,
+            'removed': True,
+            'restored': False,
+            'new': False,
+        })
+
+
+class TestUpdate(ModelTestCase):
+
+    def run_update(self, provider, dry_run=False):
+        with mock.patch.multiple(harvest,
+                                 update_formats=mock.DEFAULT,
+                                 update_items=mock.DEFAULT,
+                                 update_records=mock.DEFAULT,
+                                 update_fragments=mock.DEFAULT):
+            harvest.update(provider, dry_run=dry_run)
+
+    def make_provider(self):
+        class Provider(WorkerProvider):
+            finished = 0
+
+            def update_finished(self):
+                self.finished += 1
+        return Provider({})
+
+    def test_update_finished(self):
+        provider = self.make_provider()
+        self.run_update(provider)
+        self.assertEqual(provider.finished, 1)
+
+    def test_dry_run_not_finished(self):
+        provider = self.make_provider()
+        self.run_update(provider, dry_run=True)
+        self.assertEqual(provider.finished, 0)
+
+    def test_update_finished_optional(self):
+        self.run_update(WorkerProvider({}))
+
+
+class TestUpdateChanged(ModelTestCase):
+
+    def test_update_changed_items(self):
+        """Only the given items should be reconciled."""
+        Item.create('kept')
+        Item.create('modified')
+        Item.create('removed')
+        Item.create('restored').deleted = True
+
+        with mock.patch.object(harvest.models, 'commit'):
+            identifiers = harvest.update_changed_items(
+                ['new', 'modified', 'restored'], ['removed', 'missing'])
+
+        self.assertEqual(identifiers, ['modified', 'new', 'restored'])
+        self.assertEqual(Item.list_identifiers(), {
+            'kept': False,
+            'modified': False,
+            'removed': True,
+            'restored': False,
+            'new': False,
+        })
+
+    def test_update_changed(self):
+        provider = mock.Mock()
+        provider.get_sets.return_value = []
+        format_ = make_format('oai_dc')
+
+        with mock_models() as models:
+            models.Format.list.return_value = [format_]
+            models.Item.list_identifiers.return_value = {
+                'a': False, 'c': False,
+            }
+            models.Record.list_without_fragment.return_value = []
+            with LogCapture(harvest) as log:
+                harvest.update_changed(provider, ['b', 'a'], ['c'])
+
+        self.assertFalse(provider.identifiers.called)
+        self.assertFalse(provider.has_changed.called)
+        models.Item.mark_many_as_deleted.assert_called_once_with(['c'])
+        self.assertEqual(provider.get_record.mock_calls, [
+            mock.call('a', 'oai_dc'),
+            mock.call('b', 'oai_dc'),
+        ])
+        self.assertFalse(models.Record.clear_fragments.called)
+        log.assert_emitted('Updating changed records...')
+        self.assertNotIn('Updating all records...', log.messages)
+
 
 class TestUpdateRecords(ModelTestCase):
 
@@ -204,7 +317,7 @@ class TestUpdateRecords(ModelTestCase):
         )
 
         with LogCapture(harvest) as log:
-            with mock.patch.object(harvest, 'models') as models:
+            with mock_models() as models:
                 with mock.patch.object(harvest, 'update_sets') as (
                         update_sets_mock):
                     harvest.update_records(
@@ -218,18 +331,20 @@ class TestUpdateRecords(ModelTestCase):
         )
         self.assertCountEqual(
             update_sets_mock.mock_calls,
-            [mock.call(provider, id_, False)
+            [mock.call(provider, id_, False, mock.ANY)
              for id_ in ['item0', 'item1', 'item3']],
         )
         self.assertCountEqual(
             models.Record.create_or_update.mock_calls,
-            [mock.call(id_, prefix, '<xml ... />')
+            [mock.call(id_, prefix, '<xml ... />', tree=None, valid=None,
+                       checked=False)
              for id_ in ['item0', 'item1', 'item3']
              for prefix in ['ead', 'oai_dc']]
         )
+        # The records of each item are committed together.
         self.assertEqual(
             models.commit.mock_calls,
-            [mock.call() for _ in range(6)]
+            [mock.call() for _ in range(3)]
         )
         log.assert_emitted('Skipping item "item2"')
         log.assert_emitted('Updated 6 records.')
@@ -241,7 +356,7 @@ class TestUpdateRecords(ModelTestCase):
         provider.get_record.return_value = '<oai_dc:dc>...</oai_dc:dc>'
 
         with mock.patch.object(harvest, 'update_sets'):
-            with mock.patch.object(harvest, 'models') as models:
+            with mock_models() as models:
                 harvest.update_records(
                     provider, items, prefixes, since=None)
 
@@ -252,7 +367,7 @@ class TestUpdateRecords(ModelTestCase):
     def test_no_records(self):
         provider = mock.Mock()
         time = datetime(2014, 2, 4, 10, 54, 27)
-        with mock.patch.object(harvest, 'models') as models:
+        with mock_models() as models:
             harvest.update_records(provider, [], ['ead'], since=time)
         self.assertEqual(provider.has_changed.mock_calls, [])
         self.assertEqual(provider.get_record.mock_calls, [])
@@ -271,12 +386,12 @@ class TestUpdateRecords(ModelTestCase):
         provider.get_record.side_effect = get_record
 
         with mock.patch.object(harvest, 'update_sets'):
-            with mock.patch.object(harvest, 'models') as models:
+            with mock_models() as models:
                 with LogCapture(harvest) as log:
                     harvest.update_records(provider, items, ['ead'])
 
         models.Record.create_or_update.assert_called_once_with(
-            'id2', 'ead', xml)
+            'id2', 'ead', xml, tree=None, valid=None, checked=False)
         log.assert_emitted(
             'Failed to disseminate format "ead" for item "id1"')
         log.assert_emitted('crosswalk error')
@@ -286,7 +401,7 @@ class TestUpdateRecords(ModelTestCase):
         provider.get_record.return_value = None
 
         with mock.patch.object(harvest, 'update_sets'):
-            with mock.patch.object(harvest, 'models') as models:
+            with mock_models() as models:
                 harvest.update_records(
                     provider, ['some_item'], ['oai_dc'])
 
@@ -303,13 +418,13 @@ class TestUpdateRecords(ModelTestCase):
         with mock.patch.object(harvest, 'update_sets') as (
                 update_sets_mock):
             update_sets_mock.side_effect = ValueError('invalid set spec')
-            with mock.patch.object(harvest, 'models') as models:
+            with mock_models() as models:
                 with LogCapture(harvest) as log:
                     harvest.update_records(provider, items, ['oai_dc'])
 
         self.assertCountEqual(
             update_sets_mock.mock_calls,
-            [mock.call(provider, id_, False)
+            [mock.call(provider, id_, False, mock.ANY)
              for id_ in ['item1', 'item2']],
         )
         log.assert_emitted('Failed to update item "item1"')
@@ -329,13 +444,13 @@ class TestUpdateRecords(ModelTestCase):
         provider.get_record.side_effect = get_record
         provider.get_sets.return_value = []
 
-        with mock.patch.object(harvest, 'models') as models:
+        with mock_models() as models:
             harvest.update_records(provider, ['pelle'], formats)
 
         models.Record.mark_as_deleted.assert_called_once_with(
             'pelle', 'ead')
         models.Record.create_or_update.assert_called_once_with(
-            'pelle', 'ddi', 'data')
+            'pelle', 'ddi', 'data', tree=None, valid=None, checked=False)
 
     def test_dry_run(self):
         time = datetime(2014, 2, 4, 10, 54, 27)
@@ -345,7 +460,7 @@ class TestUpdateRecords(ModelTestCase):
         provider.has_changed.return_value = True
 
         with LogCapture(harvest) as log:
-            with mock.patch.object(harvest, 'models') as models:
+            with mock_models() as models:
                 with mock.patch.object(harvest, 'update_sets') as (
                         update_sets_mock):
                     harvest.update_records(
@@ -356,63 +471,739 @@ class TestUpdateRecords(ModelTestCase):
                         dry_run=True,
                     )
 
-        update_sets_mock.assert_called_once_with(provider, 'item1', True)
+        update_sets_mock.assert_called_once_with(
+            provider, 'item1', True, mock.ANY)
         self.assertEqual(models.Record.create_or_update.mock_calls, [])
         self.assertEqual(models.commit.mock_calls, [])
 
         log.assert_emitted('Updated 1 record.')
 
+    def test_batch_size(self):
+        provider = mock.Mock()
+        provider.get_record.return_value = '<xml ... />'
+
+        with mock.patch.object(harvest, 'update_sets'):
+            with mock_models() as models:
+                harvest.update_records(
+                    provider,
+                    ['item{0}'.format(i) for i in range(5)],
+                    ['oai_dc'],
+                    batch_size=2,
+                )
+
+        # Two full batches and the rest.
+        self.assertEqual(models.commit.mock_calls,
+                         [mock.call() for _ in range(3)])
+
+    def test_batch_interval(self):
+        provider = mock.Mock()
+        provider.get_record.return_value = '<xml ... />'
+        clock = mock.Mock(side_effect=[0, 1, 5, 6, 7, 8])
+
+        with mock.patch.object(harvest, 'update_sets'), \
+                mock.patch.object(harvest.time, 'monotonic', clock):
+            with mock_models() as models:
+                harvest.update_records(
+                    provider,
+                    ['item1', 'item2', 'item3'],
+                    ['oai_dc'],
+                    batch_size=100,
+                    batch_interval=5,
+                )
+
+        # Committed when the interval has passed, and at the end.
+        self.assertEqual(models.commit.mock_calls,
+                         [mock.call() for _ in range(2)])
+
+    def test_failed_record_rolled_back(self):
+        """A failing record should not affect the rest of its batch."""
+        models.Format.create('oai_dc', 'urn:dc', 'dc.xsd')
+        for identifier in ['item1', 'item2', 'item3']:
+            Item.create(identifier)
+        provider = mock.Mock()
+        provider.get_record.return_value = (
+            '<dc xmlns="urn:dc" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'xsi:schemaLocation="urn:dc dc.xsd"/>'
+        )
+
+        def update_sets(provider, identifier, dry_run, registry):
+            models.Set.create(identifier, 'Set')
+            if identifier == 'item2':
+                raise ValueError('invalid set')
+
+        with mock.patch.object(harvest, 'update_sets', update_sets), \
+                mock.patch.object(harvest.models, 'commit') as commit:
+            with LogCapture(harvest) as log:
+                harvest.update_records(
+                    provider,
+                    ['item1', 'item2', 'item3'],
+                    ['oai_dc'],
+                    batch_size=10,
+                )
+
+        commit.assert_called_once_with()
+        log.assert_emitted('Failed to update item "item2"')
+        self.assertEqual(
+            [r.identifier for r in models.Record.list()],
+            ['item1', 'item3'],
+        )
+        self.assertEqual(len(models.Set.list()), 2)
+
+    def test_unchanged_records_skipped(self):
+        """Records whose digest matches should not be updated."""
+        models.Format.create('oai_dc', 'urn:dc', 'dc.xsd')
+        xml = ('<dc xmlns="urn:dc" '
+               'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xsi:schemaLocation="urn:dc dc.xsd">{0}</dc>')
+        for identifier in ['item1', 'item2']:
+            Item.create(identifier)
+            models.Record.create(identifier, 'oai_dc', xml.format('old'))
+        provider = mock.Mock()
+        provider.get_sets.return_value = []
+        provider.get_record.side_effect = lambda identifier, prefix: (
+            xml.format('new' if identifier == 'item2' else 'old'))
+
+        with mock.patch.object(harvest.models, 'commit'), \
+                mock.patch.object(models.Record, 'create_or_update',
+                                  wraps=models.Record.create_or_update) \
+                as update_mock:
+            with LogCapture(harvest) as log:
+                harvest.update_records(
+                    provider, ['item1', 'item2'], ['oai_dc'])
+
+        update_mock.assert_called_once_with(
+            'item2', 'oai_dc', xml.format('new'), tree=None, valid=None,
+            checked=False)
+        log.assert_emitted('Updated 1 record.')
+        log.assert_emitted('Skipped 1 unchanged record.')
+
+    def test_element_records(self):
+        """Elements should be stored without parsing them again."""
+        models.Format.create('oai_dc', 'urn:dc', 'dc.xsd')
+        Item.create('item1')
+        xml = ('<dc xmlns="urn:dc" '
+               'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xsi:schemaLocation="urn:dc dc.xsd">title</dc>')
+        provider = mock.Mock()
+        provider.get_sets.return_value = []
+        provider.get_record.return_value = etree.fromstring(xml)
+
+        with mock.patch.object(harvest.models, 'commit'), \
+                mock.patch.object(models.etree, 'fromstring') as parse:
+            harvest.update_records(provider, ['item1'], ['oai_dc'])
+
+        self.assertEqual(parse.mock_calls, [])
+        [record] = models.Record.list()
+        self.assertEqual(record.xml, xml)
+
+    def test_validation(self):
+        """Invalid records should be stored and logged."""
+        models.Format.create('oai_dc',
+                             'http://www.openarchives.org/OAI/2.0/oai_dc/',
+                             'http://www.openarchives.org/OAI/2.0/oai_dc.xsd')
+        for identifier in ['item1', 'item2']:
+            Item.create(identifier)
+        provider = mock.Mock()
+        provider.get_sets.return_value = []
+        provider.get_record.side_effect = lambda identifier, prefix: (
+            VALID_DC if identifier == 'item1' else INVALID_DC)
+        validator = RecordValidator({'oai_dc': OAI_DC_SCHEMA})
+
+        with mock.patch.object(harvest.models, 'commit'):
+            with LogCapture(harvest) as log:
+                harvest.update_records(provider, ['item1', 'item2'],
+                                       ['oai_dc'], validator=validator)
+
+        self.assertEqual(
+            [(r.identifier, r.valid) for r in models.Record.list()],
+            [('item1', True), ('item2', False)],
+        )
+        log.assert_emitted('Format "oai_dc" of item "item2" is not valid')
+        log.assert_emitted('Found 1 invalid record.')
+
+    def test_unvalidated_records_validated(self):
+        """Records stored without validating them should be validated
+        even if they have not changed."""
+        models.Format.create('oai_dc',
+                             'http://www.openarchives.org/OAI/2.0/oai_dc/',
+                             'http://www.openarchives.org/OAI/2.0/oai_dc.xsd')
+        Item.create('item1')
+        time = datetime(2013, 1, 1, 0, 0, 0)
+        models.Record.create('item1', 'oai_dc', INVALID_DC, time)
+        provider = mock.Mock()
+        provider.get_sets.return_value = []
+        provider.get_record.return_value = INVALID_DC
+        validator = RecordValidator({'oai_dc': OAI_DC_SCHEMA})
+
+        with mock.patch.object(harvest.models, 'commit'):
+            with LogCapture(harvest) as log:
+                harvest.update_records(provider, ['item1'], ['oai_dc'],
+                                       validator=validator)
+
+        [record] = models.Record.list()
+        self.assertIs(record.valid, False)
+        self.assertEqual(record.datestamp, time)
+        log.assert_emitted('Found 1 invalid record.')
+
+
+class TestHarvestTimes(ModelTestCase):
+
+    def setUp(self):
+        super(TestHarvestTimes, self).setUp()
+        models.Format.create('oai_dc', 'urn:dc', 'dc.xsd')
+        for identifier in ['item1', 'item2']:
+            Item.create(identifier)
+        self.provider = mock.Mock()
+        self.provider.get_sets.return_value = []
+        self.provider.has_changed.return_value = True
+        self.provider.get_record.return_value = (
+            '<dc xmlns="urn:dc" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'xsi:schemaLocation="urn:dc dc.xsd"/>'
+        )
+        self.time = datetime(2014, 1, 1, 0, 0, 0)
+        self.old_time = datetime(2013, 1, 1, 0, 0, 0)
+
+    def update_records(self, since=None, force=False):
+        with mock.patch.object(harvest.models, 'commit'), \
+                mock.patch.object(harvest, 'datestamp_now',
+                                  return_value=self.time):
+            harvest.update_records(self.provider, ['item1', 'item2'],
+                                   ['oai_dc'], since, force=force)
+
+    def test_failed_item_not_marked(self):
+        def get_record(identifier, prefix):
+            if identifier == 'item2':
+                raise ValueError('crosswalk error')
+            return self.provider.get_record.return_value
+        self.provider.get_record.side_effect = get_record
+
+        self.update_records()
+        self.assertEqual(
+            Item.list_harvest_times(['item1', 'item2']),
+            {'item1': self.time},
+        )
+
+    def test_changed_since_harvest_time(self):
+        """Items should be checked for changes since their own harvest
+        time, and items without one should be updated."""
+        Item.mark_harvested(['item1'], self.old_time)
+        self.update_records(since=datetime(2013, 6, 1, 0, 0, 0))
+        self.provider.has_changed.assert_called_once_with(
+            'item1', self.old_time)
+        self.assertEqual(
+            Item.list_harvest_times(['item1', 'item2']),
+            {'item1': self.time, 'item2': self.time},
+        )
+
+    def test_old_database(self):
+        """The time of the last update should be used if no item has
+        been harvested."""
+        self.update_records(since=self.old_time)
+        self.assertCountEqual(
+            self.provider.has_changed.mock_calls,
+            [mock.call('item1', self.old_time),
+             mock.call('item2', self.old_time)],
+        )
+
+    def test_old_database_unchanged(self):
+        """Unchanged items of an old database should get a harvest
+        time."""
+        self.provider.has_changed.return_value = False
+        self.update_records(since=self.old_time)
+        self.assertEqual(self.provider.get_record.mock_calls, [])
+        self.assertEqual(
+            Item.list_harvest_times(['item1', 'item2']),
+            {'item1': self.time, 'item2': self.time},
+        )
+
+    def test_force(self):
+        Item.mark_harvested(['item1'], self.old_time)
+        self.update_records(since=self.old_time, force=True)
+        self.assertEqual(self.provider.has_changed.mock_calls, [])
+        self.assertEqual(len(models.Record.list()), 2)
+
 
 class TestUpdateSets(ModelTestCase):
 
+    def setUp(self):
+        super(TestUpdateSets, self).setUp()
+        Item.create('item')
+        self.provider = mock.Mock()
+
+    def update_sets(self, sets, registry=None):
+        self.provider.get_sets.return_value = sets
+        harvest.update_sets(self.provider, 'item', registry=registry)
+
     def test_valid_sets(self):
-        provider = mock.Mock()
-        provider.get_sets.return_value = [
+        self.update_sets([
             ('a:b', 'Set B'),
             ('a',   'Set A'),
             ('a:b:c','Set C'),
-        ]
-
-        with mock.patch.object(harvest, 'models') as models:
-            harvest.update_sets(provider, 'oai:example.org:item')
-
-        models.Item.get.assert_called_once_with('oai:example.org:item')
-        item = models.Item.get.return_value
-        item.clear_sets.assert_called_once_with()
+        ])
         self.assertEqual(
-            models.Set.create_or_update.mock_calls,
-            [mock.call('a', 'Set A'),
-             mock.call('a:b', 'Set B'),
-             mock.call('a:b:c', 'Set C')]
+            models.Set.list_names(),
+            {'a': 'Set A', 'a:b': 'Set B', 'a:b:c': 'Set C'},
         )
-        set_ = models.Set.create_or_update.return_value
+        self.assertEqual(models.Item.list_set_specs(['item']),
+                         {'item': {'a', 'a:b', 'a:b:c'}})
+
+    def test_changed_sets(self):
+        """Only the changed memberships should be written."""
+        self.update_sets([('a', 'Set A'), ('b', 'Set B')])
+        with mock.patch.object(models.Item, 'change_sets',
+                               wraps=models.Item.change_sets) as change:
+            self.update_sets([('b', 'New B'), ('c', 'Set C')])
+        change.assert_called_once_with('item', {'c'}, {'a'})
         self.assertEqual(
-            item.add_to_set.mock_calls,
-            [mock.call(set_) for _ in range(3)]
+            models.Set.list_names(),
+            {'a': 'Set A', 'b': 'New B', 'c': 'Set C'},
         )
+        self.assertEqual(models.Item.list_set_specs(['item']),
+                         {'item': {'b', 'c'}})
 
     def test_no_sets(self):
-        provider = mock.Mock()
-        provider.get_sets.return_value = []
-        with mock.patch.object(harvest, 'models') as models:
-            harvest.update_sets(provider, 'item')
-        item = models.Item.get.return_value
-        item.clear_sets.assert_called_once_with()
-        self.assertEqual(item.add_to_set.mock_calls, [])
+        self.update_sets([])
+        self.assertEqual(models.Set.list(), [])
+        self.assertEqual(models.Item.list_set_specs(['item']), {})
 
     def test_dry_run(self):
-        provider = mock.Mock()
-        provider.get_sets.return_value = [('a', 'Set Name')]
+        self.provider.get_sets.return_value = [('a', 'Set Name')]
+        with mock.patch.object(harvest, 'models') as models_mock:
+            harvest.update_sets(self.provider, 'item', dry_run=True)
+        self.assertEqual(models_mock.mock_calls, [])
+
+    def test_sets_not_changed(self):
+        self.update_sets([('a', 'Set A')])
+        with mock.patch.object(models.Record, 'clear_fragments') as clear:
+            self.update_sets([('a', 'Set A')])
+        self.assertEqual(clear.mock_calls, [])
+
+    def test_registry(self):
+        """The sets should be loaded only once."""
+        registry = harvest._SetRegistry()
+        with mock.patch.object(models.Set, 'list_names',
+                               wraps=models.Set.list_names) as list_names:
+            self.update_sets([('a', 'Set A')], registry)
+            Item.create('other')
+            self.provider.get_sets.return_value = [('a', 'Set A'),
+                                                   ('b', 'Set B')]
+            harvest.update_sets(self.provider, 'other', registry=registry)
+            list_names.assert_called_once_with()
+
+            registry.reset()
+            self.update_sets([('b', 'Set B')], registry)
+            self.assertEqual(list_names.call_count, 2)
+        self.assertEqual(models.Item.list_set_specs(['item', 'other']),
+                         {'item': {'b'}, 'other': {'a', 'b'}})
+
+
+class TestUpdateFragments(ModelTestCase):
+
+    def setUp(self):
+        super(TestUpdateFragments, self).setUp()
+        self.records = [mock.Mock(fragment=None) for _ in range(3)]
+
+    def update_fragments(self, **kwargs):
+        with mock.patch.object(harvest, 'models') as models, \
+                mock.patch.object(harvest, 'render_fragment') as render:
+            models.Record.list_without_fragment.side_effect = [
+                self.records[:2], self.records[2:], [],
+            ]
+            render.side_effect = lambda record: b'<record/>'
+            with LogCapture(harvest) as log:
+                harvest.update_fragments(batch_size=2, **kwargs)
+        return models, log
+
+    def test_render(self):
+        models, log = self.update_fragments()
+        self.assertEqual(models.Record.clear_fragments.mock_calls, [])
+        self.assertEqual(
+            models.Record.list_without_fragment.mock_calls,
+            [mock.call(2)] * 3
+        )
+        for record in self.records:
+            self.assertEqual(record.fragment, b'<record/>')
+        self.assertEqual(models.commit.mock_calls, [mock.call()] * 2)
+        log.assert_emitted('Rendered 3 record fragments.')
+
+    def test_rerender(self):
+        models, log = self.update_fragments(rerender=True)
+        models.Record.clear_fragments.assert_called_once_with()
+        self.assertEqual(models.commit.mock_calls, [mock.call()] * 3)
+        log.assert_emitted('Rendered 3 record fragments.')
+
+    def test_render_fails(self):
+        """Failures should be logged, and the import should go on."""
+        with mock.patch.object(harvest, 'models') as models, \
+                mock.patch.object(harvest, 'render_fragment') as render:
+            models.Record.list_without_fragment.return_value = self.records
+            render.side_effect = ValueError('Bad template')
+            with LogCapture(harvest) as log:
+                harvest.update_fragments()
+        models.rollback.assert_called_once_with()
+        self.assertEqual(models.commit.mock_calls, [])
+        log.assert_emitted(
+            'Failed to render record fragments: Bad template')
+        log.assert_emitted('Rendered 0 record fragments.')
+
+
+class WorkerProvider(object):
+    """Metadata provider for worker pool tests."""
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def has_changed(self, identifier, since):
+        return identifier != 'unchanged'
+
+    def get_sets(self, identifier):
+        if identifier == 'bad_sets':
+            raise ValueError('invalid set spec')
+        return []
+
+    def get_record(self, identifier, prefix):
+        if identifier == 'bad_record':
+            raise ValueError('crosswalk error')
+        return '{0} {1}'.format(identifier, prefix)
+
+
+class TestWorkerPool(ModelTestCase):
+
+    def settings(self, workers, worker_type):
+        return {
+            'harvest_workers': workers,
+            'harvest_worker_type': worker_type,
+        }
+
+    def test_no_workers(self):
+        self.assertIsNone(harvest.create_worker_pool(
+            WorkerProvider, self.settings(0, 'process')))
+
+    def check_update(self, worker_type):
+        identifiers = ['item{0}'.format(i) for i in range(100)]
+        identifiers += ['unchanged', 'bad_sets', 'bad_record']
+        pool = harvest.create_worker_pool(
+            WorkerProvider, self.settings(2, worker_type))
+        self.addCleanup(pool.shutdown)
+
+        with mock_models() as models:
+            with LogCapture(harvest) as log:
+                harvest.update_records(
+                    WorkerProvider({}),
+                    identifiers,
+                    ['oai_dc', 'ddi'],
+                    since=datetime(2014, 1, 1),
+                    pool=pool,
+                )
+
+        # The records are written in order.
+        self.assertEqual(
+            models.Record.create_or_update.mock_calls,
+            [mock.call(id_, prefix, '{0} {1}'.format(id_, prefix),
+                       tree=None, valid=None, checked=False)
+             for id_ in identifiers[:100]
+             for prefix in ['oai_dc', 'ddi']]
+        )
+        log.assert_emitted('Skipping item "unchanged"')
+        log.assert_emitted('Failed to update item "bad_sets"')
+        log.assert_emitted('invalid set spec')
+        log.assert_emitted(
+            'Failed to disseminate format "ddi" for item "bad_record"')
+        log.assert_emitted('Updated 200 records.')
+
+    def test_threads(self):
+        self.check_update('thread')
+
+    def test_processes(self):
+        self.check_update('process')
+
+    def test_validation(self):
+        """Records should be validated in the workers."""
+        class Provider(WorkerProvider):
+            def get_record(self, identifier, prefix):
+                return VALID_DC if identifier == 'item0' else INVALID_DC
+
+        settings = self.settings(2, 'thread')
+        settings['validation_schemas'] = {'oai_dc': OAI_DC_SCHEMA}
+        pool = harvest.create_worker_pool(Provider, settings)
+        self.addCleanup(pool.shutdown)
+        validator = mock.Mock()
+
+        with mock_models() as models:
+            harvest.update_records(Provider({}), ['item0', 'item1'],
+                                   ['oai_dc'], pool=pool,
+                                   validator=validator)
+
+        self.assertEqual(validator.mock_calls, [])
+        self.assertEqual(models.Record.create_or_update.mock_calls, [
+            mock.call('item0', 'oai_dc', VALID_DC, tree=None, valid=True,
+                      checked=False),
+            mock.call('item1', 'oai_dc', INVALID_DC, tree=None, valid=False,
+                      checked=False),
+        ])
+
+    def test_records_checked_in_workers(self):
+        """Workers should check the records, so that they are not
+        parsed again when they are stored."""
+        models.Format.create('oai_dc', 'urn:dc', 'dc.xsd')
+        for identifier in ['good', 'bad']:
+            Item.create(identifier)
+        xml = ('<dc xmlns="{0}" '
+               'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xsi:schemaLocation="urn:dc dc.xsd">title</dc>')
+
+        class Provider(WorkerProvider):
+            def get_record(self, identifier, prefix):
+                return xml.format('urn:dc' if identifier == 'good'
+                                  else 'urn:other')
+
+        pool = harvest.create_worker_pool(
+            Provider, self.settings(2, 'thread'))
+        self.addCleanup(pool.shutdown)
+
+        with mock.patch.object(harvest.models, 'commit'), \
+                mock.patch.object(models.Record, '_check_xml') as check, \
+                LogCapture(harvest) as log:
+            harvest.update_records(Provider({}), ['good', 'bad'],
+                                   ['oai_dc'], pool=pool)
+
+        self.assertEqual(check.mock_calls, [])
+        self.assertEqual([r.identifier for r in models.Record.list()],
+                         ['good'])
+        log.assert_emitted(
+            'Failed to disseminate format "oai_dc" for item "bad"')
+        log.assert_emitted('wrong xml namespace')
+
+    def test_unchanged_not_validated(self):
+        """Workers should not validate records which have not changed."""
+        class Provider(WorkerProvider):
+            def get_record(self, identifier, prefix):
+                return VALID_DC
+
+        make_digest = models.Record.make_digest
+        validator = mock.Mock()
+        validator.validate.return_value = (True, None)
+        with mock.patch.object(harvest, 'create_validator',
+                               return_value=validator):
+            pool = harvest.create_worker_pool(
+                Provider, self.settings(2, 'thread'))
+            self.addCleanup(pool.shutdown)
+            with mock_models() as mocked:
+                mocked.Record.make_digest.side_effect = make_digest
+                mocked.Record.list_digests.return_value = {
+                    ('same', 'oai_dc'): make_digest(VALID_DC),
+                }
+                harvest.update_records(Provider({}), ['same', 'new'],
+                                       ['oai_dc'], pool=pool,
+                                       validator=mock.Mock())
+
+        validator.validate.assert_called_once_with(
+            'oai_dc', VALID_DC, None)
+        mocked.Record.create_or_update.assert_called_once_with(
+            'new', 'oai_dc', VALID_DC, tree=None, valid=True, checked=False)
+
+    def test_process_discards_connections(self):
+        """Forked workers should not use the connections of the
+        importer."""
+        with mock.patch.object(harvest.multiprocessing, 'parent_process'), \
+                mock.patch.object(harvest.signal, 'signal'), \
+                mock.patch.object(harvest, 'models') as models:
+            harvest._init_worker(WorkerProvider, {})
+        models.discard_inherited_connections.assert_called_once_with()
+
+    def test_process_resets_sigterm(self):
+        """Forked workers should not inherit the SIGTERM handler of the
+        watch mode."""
+        with mock.patch.object(harvest.multiprocessing, 'parent_process'), \
+                mock.patch.object(harvest.signal, 'signal') as signal_mock, \
+                mock.patch.object(harvest, 'models'):
+            harvest._init_worker(WorkerProvider, {})
+        signal_mock.assert_called_once_with(harvest.signal.SIGTERM,
+                                            harvest.signal.SIG_DFL)
+
+    def test_sigterm_in_process_worker(self):
+        def handler(signum, frame):
+            raise KeyboardInterrupt()
+        old = signal.signal(signal.SIGTERM, handler)
+        self.addCleanup(signal.signal, signal.SIGTERM, old)
+        pool = harvest.create_worker_pool(
+            WorkerProvider, self.settings(1, 'process'))
+        self.addCleanup(pool.shutdown)
+        self.assertEqual(
+            pool.submit(signal.getsignal, signal.SIGTERM).result(),
+            signal.SIG_DFL)
 
+    def test_thread_keeps_connections(self):
         with mock.patch.object(harvest, 'models') as models:
-            models.Item
-            harvest.update_sets(
-                provider,
-                'oai:example.org:item',
-                dry_run=True,
-            )
-        item_mock = models.Item.get.return_value
-
-        self.assertEqual(item_mock.clear_sets.mock_calls, [])
-        self.assertEqual(models.Set.create_or_update.mock_calls, [])
-        self.assertEqual(item_mock.add_to_set.mock_calls, [])
+            harvest._init_worker(WorkerProvider, {})
+        self.assertFalse(models.discard_inherited_connections.called)
+
+    def test_changes_checked_in_importer(self):
+        """Changes should be checked with the provider of the importer,
+        which has scanned the items."""
+        class Provider(WorkerProvider):
+            scanned = False
+
+            def has_changed(self, identifier, since):
+                if not self.scanned:
+                    raise RuntimeError('not scanned')
+                return identifier != 'unchanged'
+
+        provider = Provider({})
+        provider.scanned = True
+        pool = harvest.create_worker_pool(
+            Provider, self.settings(2, 'thread'))
+        self.addCleanup(pool.shutdown)
+
+        with mock_models() as models:
+            harvest.update_records(provider, ['item', 'unchanged'],
+                                   ['oai_dc'], since=datetime(2014, 1, 1),
+                                   pool=pool)
+
+        models.Record.create_or_update.assert_called_once_with(
+            'item', 'oai_dc', 'item oai_dc', tree=None, valid=None,
+            checked=False)
+
+    def test_worker_fails(self):
+        """Items whose workers fail should be logged and skipped."""
+        pool = mock.Mock()
+        pool.submit.return_value.result.side_effect = (
+            RuntimeError('worker died'))
+
+        with mock_models() as models:
+            with LogCapture(harvest) as log:
+                harvest.update_records(
+                    WorkerProvider({}), ['item'], ['oai_dc'], pool=pool)
+
+        self.assertEqual(models.Record.create_or_update.mock_calls, [])
+        log.assert_emitted('Failed to update item "item": worker died')
+
+
+class BatchProvider(WorkerProvider):
+    """Metadata provider with the methods of the batch protocol."""
+
+    def __init__(self, settings):
+        super(BatchProvider, self).__init__(settings)
+        self.calls = []
+
+    def changed_since(self, since):
+        self.calls.append(('changed_since', since))
+        return ['item0', 'item1', 'bad_sets']
+
+    def get_sets_many(self, identifiers):
+        self.calls.append(('get_sets_many', identifiers))
+        if 'bad_sets' in identifiers:
+            raise ValueError('invalid set spec')
+        return dict((i, [('set', 'Set')]) for i in identifiers)
+
+    def get_records_many(self, identifiers, prefix):
+        self.calls.append(('get_records_many', identifiers, prefix))
+        if prefix == 'ddi':
+            return {}
+        return dict((i, '{0} {1}'.format(i, prefix)) for i in identifiers)
+
+
+class TestBatchProvider(ModelTestCase):
+
+    def test_batch_calls(self):
+        provider = BatchProvider({})
+        since = datetime(2014, 1, 1)
+
+        with mock_models() as models:
+            models.Item.list_harvest_times.return_value = {
+                'item0': since, 'unchanged': since,
+            }
+            with mock.patch.object(harvest, 'update_sets'):
+                harvest.update_records(
+                    provider, ['item0', 'unchanged', 'new'],
+                    ['oai_dc', 'ddi'],
+                )
+
+        self.assertEqual(provider.calls, [
+            ('changed_since', since),
+            ('get_sets_many', ['item0', 'new']),
+            ('get_records_many', ['item0', 'new'], 'oai_dc'),
+            ('get_records_many', ['item0', 'new'], 'ddi'),
+        ])
+        self.assertEqual(models.Record.create_or_update.mock_calls, [
+            mock.call('item0', 'oai_dc', 'item0 oai_dc',
+                      tree=None, valid=None, checked=False),
+            mock.call('new', 'oai_dc', 'new oai_dc',
+                      tree=None, valid=None, checked=False),
+        ])
+        self.assertEqual(models.Record.mark_as_deleted.mock_calls, [
+            mock.call('item0', 'ddi'),
+            mock.call('new', 'ddi'),
+        ])
+
+    def test_failed_batch(self):
+        """All items of a failed batch call should fail."""
+        with mock_models() as models:
+            with LogCapture(harvest) as log:
+                harvest.update_records(
+                    BatchProvider({}), ['item0', 'bad_sets'], ['oai_dc'])
+        self.assertEqual(models.Record.create_or_update.mock_calls, [])
+        log.assert_emitted('Failed to update item "item0"')
+        log.assert_emitted('Failed to update item "bad_sets"')
+
+    def test_pool(self):
+        identifiers = ['item{0}'.format(i) for i in range(250)]
+        pool = harvest.create_worker_pool(BatchProvider, {
+            'harvest_workers': 2,
+            'harvest_worker_type': 'thread',
+        })
+        self.addCleanup(pool.shutdown)
+
+        with mock_models() as models:
+            harvest.update_records(BatchProvider({}), identifiers,
+                                   ['oai_dc'], pool=pool)
+
+        self.assertEqual(
+            models.Record.create_or_update.mock_calls,
+            [mock.call(id_, 'oai_dc', '{0} oai_dc'.format(id_),
+                       tree=None, valid=None, checked=False)
+             for id_ in identifiers]
+        )
+
+    def test_pool_changed_since_once(self):
+        """Changes should be fetched once, not for each batch."""
+        identifiers = ['item{0}'.format(i) for i in range(250)]
+        since = datetime(2014, 1, 1)
+        provider = BatchProvider({})
+        pool = harvest.create_worker_pool(BatchProvider, {
+            'harvest_workers': 2,
+            'harvest_worker_type': 'thread',
+        })
+        self.addCleanup(pool.shutdown)
+
+        with mock_models() as models:
+            models.Item.list_harvest_times.side_effect = (
+                lambda chunk: dict((i, since) for i in chunk))
+            harvest.update_records(provider, identifiers, ['oai_dc'],
+                                   pool=pool)
+
+        self.assertEqual(provider.calls, [('changed_since', since)])
+        self.assertEqual(
+            models.Record.create_or_update.mock_calls,
+            [mock.call(id_, 'oai_dc', '{0} oai_dc'.format(id_),
+                       tree=None, valid=None, checked=False)
+             for id_ in ['item0', 'item1']]
+        )
+
+    def test_single_item_methods(self):
+        """Missing batch methods should fall back to the single ones."""
+        class Provider(WorkerProvider):
+            def get_records_many(self, identifiers, prefix):
+                return dict((i, 'many') for i in identifiers)
+
+        with mock_models() as models:
+            with mock.patch.object(harvest, 'update_sets') as update_sets:
+                harvest.update_records(Provider({}), ['item', 'unchanged'],
+                                       ['oai_dc'],
+                                       since=datetime(2014, 1, 1))
+        update_sets.assert_called_once_with(
+            mock.ANY, 'item', False, mock.ANY)
+        models.Record.create_or_update.assert_called_once_with(
+            'item', 'oai_dc', 'many', tree=None, valid=None, checked=False)
@@ -0,0 +1,84 @@
+import os
+import unittest
+
+import mock
+from lxml import etree
+
+from ...exception import ConfigurationError
+from ...importer import validation
+from .. import schema
+
+OAI_DC_SCHEMA = os.path.join(schema.__path__[0], 'oai_dc.xsd')
+
+VALID_DC = (
+    '<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"'
+    ' xmlns:dc="http://purl.org/dc/elements/1.1/"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    ' xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/oai_dc/'
+    ' http://www.openarchives.org/OAI/2.0/oai_dc.xsd">'
+    '<dc:title>Title</dc:title></oai_dc:dc>'
+)
+
+INVALID_DC = VALID_DC.replace('dc:title', 'dc:name')
+
+
+class TestRecordValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.validator = validation.RecordValidator({
+            'oai_dc': OAI_DC_SCHEMA,
+        })
+
+    def test_valid_record(self):
+        self.assertEqual(self.validator.validate('oai_dc', VALID_DC),
+                         (True, None))
+
+    def test_invalid_record(self):
+        valid, message = self.validator.validate('oai_dc', INVALID_DC)
+        self.assertIs(valid, False)
+        self.assertIn('name', message)
+
+    def test_ill_formed_record(self):
+        valid, message = self.validator.validate('oai_dc', '<oai_dc:dc')
+        self.assertIs(valid, False)
+        self.assertTrue(message)
+
+    def test_tree(self):
+        """Given trees should be validated without parsing the XML."""
+        tree = etree.fromstring(INVALID_DC)
+        with mock.patch.object(validation.etree, 'fromstring') as parse:
+            result = self.validator.validate('oai_dc', VALID_DC, tree)
+        self.assertEqual(parse.mock_calls, [])
+        self.assertIs(result[0], False)
+
+    def test_format_without_schema(self):
+        self.assertEqual(self.validator.validate('ddi', '<codeBook/>'),
+                         (None, None))
+
+    def test_schema_compiled_once(self):
+        with mock.patch.object(validation.etree, 'XMLSchema',
+                               wraps=etree.XMLSchema) as compile_:
+            self.validator.validate('oai_dc', VALID_DC)
+            self.validator.validate('oai_dc', INVALID_DC)
+        compile_.assert_called_once_with(file=OAI_DC_SCHEMA)
+
+    def test_invalid_schema(self):
+        validator = validation.RecordValidator({'oai_dc': __file__})
+        self.assertRaises(ConfigurationError, validator.compile_all)
+        self.assertRaises(ConfigurationError,
+                          validator.validate, 'oai_dc', VALID_DC)
+
+
+class TestCreateValidator(unittest.TestCase):
+
+    def test_no_schemas(self):
+        self.assertIsNone(validation.create_validator({}))
+        self.assertIsNone(validation.create_validator({
+            'validation_schemas': {},
+        }))
+
+    def test_schemas(self):
+        validator = validation.create_validator({
+            'validation_schemas': {'oai_dc': OAI_DC_SCHEMA},
+        })
+        self.assertEqual(validator.paths, {'oai_dc': OAI_DC_SCHEMA})
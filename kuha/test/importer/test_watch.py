@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ...exception import ConfigurationError
+from ...importer import watch
+
+
+class WatcherTests(object):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        self.write('old.xml')
+
+    def write(self, relpath, content=b'<codeBook/>'):
+        path = os.path.join(self.directory, relpath)
+        with open(path, 'wb') as file_:
+            file_.write(content)
+        return path
+
+    def make_watcher(self):
+        raise NotImplementedError()
+
+    def test_no_changes(self):
+        watcher = self.make_watcher()
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.read(0.1), (set(), False))
+
+    def test_changed_files(self):
+        watcher = self.make_watcher()
+        self.addCleanup(watcher.close)
+        added = self.write(os.path.join('sub', 'new.xml'))
+        modified = self.write('old.xml', b'<codeBook>changed</codeBook>')
+        paths, rescan = watch.wait_for_changes(watcher, 0.1)
+        self.assertEqual(paths, {added, modified})
+        self.assertFalse(rescan)
+
+    def test_removed_file(self):
+        watcher = self.make_watcher()
+        self.addCleanup(watcher.close)
+        path = os.path.join(self.directory, 'old.xml')
+        os.remove(path)
+        paths, rescan = watch.wait_for_changes(watcher, 0.1)
+        self.assertEqual(paths, {path})
+
+
+class TestPollingWatcher(WatcherTests, unittest.TestCase):
+
+    def make_watcher(self):
+        return watch.PollingWatcher(self.directory, 0.05)
+
+
+@unittest.skipIf(watch._load_libc() is None, 'inotify is not available')
+class TestInotifyWatcher(WatcherTests, unittest.TestCase):
+
+    def make_watcher(self):
+        return watch.InotifyWatcher(self.directory)
+
+    def test_new_directory(self):
+        """Files in a new directory should be reported."""
+        watcher = self.make_watcher()
+        self.addCleanup(watcher.close)
+        os.mkdir(os.path.join(self.directory, 'new'))
+        path = self.write(os.path.join('new', 'a.xml'))
+        paths, rescan = watch.wait_for_changes(watcher, 0.1)
+        self.assertIn(path, paths)
+
+    def test_removed_directory(self):
+        """The directory should be scanned again."""
+        watcher = self.make_watcher()
+        self.addCleanup(watcher.close)
+        shutil.rmtree(os.path.join(self.directory, 'sub'))
+        paths, rescan = watch.wait_for_changes(watcher, 0.1)
+        self.assertTrue(rescan)
+
+
+class TestCreateWatcher(unittest.TestCase):
+
+    def test_fallback(self):
+        with mock.patch.object(watch, '_load_libc', return_value=None):
+            watcher = watch.create_watcher('.', 'auto', 1)
+            self.assertIsInstance(watcher, watch.PollingWatcher)
+            self.assertRaises(OSError, watch.create_watcher, '.', 'inotify')
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_unsupported_provider(self):
+        provider = mock.Mock(spec=['identifiers'])
+        self.assertRaises(ConfigurationError,
+                          watch.watch_directory, provider, {})
+
+    def test_update_changed_items(self):
+        provider = mock.Mock()
+        provider.watched_directory.return_value = '/ddi'
+        provider.identifier_for_path.side_effect = (
+            lambda path: None if path.endswith('.txt') else path[5:-4]
+        )
+        watcher = mock.Mock()
+        settings = {
+            'deleted_records': 'no',
+            'dry_run': False,
+            'harvest_batch_size': 100,
+            'harvest_batch_interval': 10,
+            'watch_delay': 0,
+            'watch_method': 'auto',
+            'watch_poll_interval': 5,
+        }
+        changes = [
+            ({'/ddi/a.xml', '/ddi/b.xml', '/ddi/c.txt'}, False),
+            KeyboardInterrupt(),
+        ]
+
+        with mock.patch.object(watch, 'create_watcher',
+                               return_value=watcher), \
+                mock.patch.object(watch, 'wait_for_changes',
+                                  side_effect=changes), \
+                mock.patch.object(watch, 'models'), \
+                mock.patch.object(watch, 'update_changed') as update, \
+                mock.patch.object(watch.os.path, 'isfile',
+                                  side_effect=lambda path: 'a' in path):
+            self.assertRaises(KeyboardInterrupt,
+                              watch.watch_directory, provider, settings)
+
+        update.assert_called_once_with(
+            provider, {'a'}, {'b'}, purge=True, dry_run=False,
+            batch_size=100, batch_interval=10, pool=None, validator=None,
+        )
+        watcher.close.assert_called_once_with()
+
+    def test_watcher_started_before(self):
+        """Changes collected by a watcher started earlier should be
+        read."""
+        provider = mock.Mock()
+        watcher = mock.Mock()
+        settings = {
+            'deleted_records': 'yes',
+            'dry_run': False,
+            'harvest_batch_size': 100,
+            'harvest_batch_interval': None,
+            'watch_delay': 0,
+        }
+
+        with mock.patch.object(watch, 'create_watcher') as create, \
+                mock.patch.object(watch, 'wait_for_changes',
+                                  side_effect=KeyboardInterrupt()) as wait, \
+                mock.patch.object(watch, 'models'):
+            self.assertRaises(KeyboardInterrupt, watch.watch_directory,
+                              provider, settings, watcher=watcher)
+
+        self.assertFalse(create.called)
+        wait.assert_called_once_with(watcher, 0)
+        watcher.close.assert_called_once_with()
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from ...oai import cache
+
+
+class CacheTestMixin(object):
+
+    def test_get_and_set(self):
+        c = self.make_cache(100)
+        self.assertIsNone(c.get('a'))
+        c.set('a', b'value')
+        self.assertEqual(c.get('a'), b'value')
+        c.set('a', b'new value')
+        self.assertEqual(c.get('a'), b'new value')
+
+    def test_too_large(self):
+        c = self.make_cache(10)
+        c.set('a', b'x' * 11)
+        self.assertIsNone(c.get('a'))
+
+    def test_evict_least_recently_used(self):
+        c = self.make_cache(10)
+        c.set('a', b'aaaa')
+        self.tick()
+        c.set('b', b'bbbb')
+        self.tick()
+        c.get('a')
+        self.tick()
+        c.set('c', b'cccc')
+        self.assertEqual(c.get('a'), b'aaaa')
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('c'), b'cccc')
+
+    def tick(self):
+        pass
+
+
+class TestMemoryCache(unittest.TestCase, CacheTestMixin):
+
+    def make_cache(self, max_size):
+        return cache.MemoryCache(max_size)
+
+
+class TestFileCache(unittest.TestCase, CacheTestMixin):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_cache(self, max_size):
+        return cache.FileCache(os.path.join(self.directory, 'cache'),
+                               max_size)
+
+    def tick(self):
+        # Make sure that modification times differ.
+        time.sleep(0.01)
+
+    def test_shared(self):
+        """Responses should be shared between cache instances."""
+        self.make_cache(100).set('a', b'value')
+        self.assertEqual(self.make_cache(100).get('a'), b'value')
+
+
+class TestCreateResponseCache(unittest.TestCase):
+
+    def test_none(self):
+        self.assertIsNone(cache.create_response_cache({
+            'response_cache': 'none',
+        }))
+
+    def test_memory(self):
+        c = cache.create_response_cache({
+            'response_cache': 'memory',
+            'response_cache_size': 1000,
+        })
+        self.assertIsInstance(c, cache.MemoryCache)
+        self.assertEqual(c.max_size, 1000)
+
+    def test_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        c = cache.create_response_cache({
+            'response_cache': 'file',
+            'response_cache_directory': directory,
+            'response_cache_size': 1000,
+        })
+        self.assertIsInstance(c, cache.FileCache)
+        self.assertEqual(c.directory, directory)
+
+
+class TestStoreIterated(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.MemoryCache(10)
+
+    def test_stored(self):
+        chunks = [b'abc', b'def']
+        result = cache.store_iterated(iter(chunks), self.cache, 'key')
+        self.assertEqual(list(result), chunks)
+        self.assertEqual(self.cache.get('key'), b'abcdef')
+
+    def test_not_finished(self):
+        """Partially sent responses should not be stored."""
+        app_iter = mock.MagicMock()
+        app_iter.__iter__.return_value = iter([b'abc', b'def'])
+        result = cache.store_iterated(app_iter, self.cache, 'key')
+        next(result)
+        result.close()
+        self.assertIsNone(self.cache.get('key'))
+        app_iter.close.assert_called_once_with()
+
+    def test_too_large(self):
+        chunks = [b'abcdef', b'ghijkl']
+        result = cache.store_iterated(iter(chunks), self.cache, 'key')
+        self.assertEqual(list(result), chunks)
+        self.assertIsNone(self.cache.get('key'))
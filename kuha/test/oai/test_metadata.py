@@ -0,0 +1,104 @@
+from datetime import datetime
+
+import mock
+from pyramid import testing
+
+from ...oai import metadata
+from ...models import DBSession, Datestamp, Format, Set
+from ..test_models import ModelTestCase
+
+
+class TestRepositoryMetadata(ModelTestCase):
+
+    def setUp(self):
+        super(TestRepositoryMetadata, self).setUp()
+        Format.create('oai_dc', 'urn:dc', 'dc.xsd')
+        Format.create('ddi', 'urn:ddi', 'ddi.xsd').deleted = True
+        Set.create('a', 'Set A')
+        Set.create('a:b', 'Set B')
+
+    def test_formats(self):
+        data = metadata.RepositoryMetadata(Datestamp.get())
+        self.assertTrue(data.format_exists('oai_dc'))
+        self.assertTrue(data.format_exists('ddi'))
+        self.assertFalse(data.format_exists('ddi', ignore_deleted=True))
+        self.assertFalse(data.format_exists('ead'))
+        self.assertEqual(
+            [f.prefix for f in data.list_formats(ignore_deleted=True)],
+            ['oai_dc'],
+        )
+        self.assertCountEqual(
+            [f.prefix for f in data.list_formats()],
+            ['oai_dc', 'ddi'],
+        )
+
+    def test_sets(self):
+        data = metadata.RepositoryMetadata(Datestamp.get())
+        self.assertTrue(data.has_sets())
+        self.assertTrue(data.set_exists('a:b'))
+        self.assertFalse(data.set_exists('b'))
+        self.assertCountEqual(
+            [(s.spec, s.name) for s in data.sets],
+            [('a', 'Set A'), ('a:b', 'Set B')],
+        )
+
+    def test_no_sets(self):
+        DBSession.query(Set).delete()
+        data = metadata.RepositoryMetadata(Datestamp.get())
+        self.assertFalse(data.has_sets())
+
+
+class TestGetMetadata(ModelTestCase):
+
+    def setUp(self):
+        super(TestGetMetadata, self).setUp()
+        self.config = testing.setUp()
+        self.request = testing.DummyRequest()
+        Format.create('oai_dc', 'urn:dc', 'dc.xsd')
+
+    def tearDown(self):
+        testing.tearDown()
+        super(TestGetMetadata, self).tearDown()
+
+    def get_metadata(self):
+        (self.request.datestamp,
+         self.request.database_version) = Datestamp.get_with_version()
+        return metadata.get_metadata(self.request)
+
+    def test_cached(self):
+        """Formats and sets should be loaded only when the datestamp
+        changes."""
+        first = self.get_metadata()
+        with mock.patch.object(Format, 'list') as list_mock:
+            second = self.get_metadata()
+        self.assertIs(first, second)
+        self.assertFalse(list_mock.called)
+
+        self.request.datestamp = datetime(2100, 1, 1, 0, 0, 0)
+        third = metadata.get_metadata(self.request)
+        self.assertIsNot(third, first)
+
+    def test_new_format(self):
+        """Creating a format should invalidate the metadata."""
+        date_mock = mock.Mock(return_value=datetime(2100, 1, 1, 0, 0, 0))
+        self.assertFalse(self.get_metadata().format_exists('ddi'))
+        with mock.patch('kuha.models.datestamp_now', date_mock):
+            Format.create('ddi', 'urn:ddi', 'ddi.xsd')
+        self.assertTrue(self.get_metadata().format_exists('ddi'))
+
+    def test_new_format_in_same_second(self):
+        """Formats created in the same second as the previous change
+        should be seen."""
+        date_mock = mock.Mock(return_value=datetime(2100, 1, 1, 0, 0, 0))
+        with mock.patch('kuha.models.datestamp_now', date_mock):
+            Format.create('ddi', 'urn:ddi', 'ddi.xsd')
+            self.assertTrue(self.get_metadata().format_exists('ddi'))
+            Format.create('ead', 'urn:ead', 'ead.xsd')
+            self.assertTrue(self.get_metadata().format_exists('ead'))
+
+    def test_never_modified(self):
+        """Nothing should be cached before the first datestamp."""
+        DBSession.query(Datestamp).delete()
+        first = self.get_metadata()
+        second = self.get_metadata()
+        self.assertIsNot(first, second)
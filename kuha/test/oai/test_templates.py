@@ -3,10 +3,13 @@ import re
 from datetime import datetime
 
 from lxml import etree
+import mock
 from pyramid import testing
 from pyramid.renderers import render, get_renderer
 
 from ..schema import master_schema
+from ...oai.fragments import render_fragment
+from ...oai.streaming import StreamingRendererFactory
 
 from ...util import (
     format_datestamp,
@@ -415,6 +418,87 @@ class TestListRecords(OaiTemplateTest):
         })
 
 
+class TestStreamingRenderer(OaiTemplateTest):
+    """Test incremental rendering of list responses."""
+
+    def setUp(self):
+        self.verb = 'ListRecords'
+        super(TestStreamingRenderer, self).setUp()
+        self.request.params['metadataPrefix'] = 'oai_dc'
+        self.records = [Record('Rec 0', 'item0'),
+                        Record('Rec 1', 'item1', deleted=True)]
+
+    def render_chunks(self, template, item_template, container, token,
+                      fragments=False):
+        factory = StreamingRendererFactory(
+            'kuha.oai:templates/{0}'.format(template),
+            'kuha.oai:templates/{0}'.format(item_template),
+            container,
+            fragments=fragments,
+        )
+        info = mock.Mock(package=None)
+        self.values.update({'records': iter(self.records), 'token': token})
+        with mock.patch('kuha.oai.streaming.rollback') as rollback_mock:
+            chunks = list(factory(info)(self.values,
+                                        {'request': self.request}))
+        rollback_mock.assert_called_once_with()
+        # The header, each item and the tail are separate chunks.
+        self.assertEqual(len(chunks), len(self.records) + 2)
+        return chunks
+
+    def render_stream(self, *args, **kwargs):
+        return b''.join(self.render_chunks(*args, **kwargs)).decode('utf-8')
+
+    def test_list_records(self):
+        result = self.render_stream(
+            'listrecords.pt', 'record.pt', 'ListRecords', 'token<>')
+        self.check_response(result, {'ListRecords': [
+            ('record', {
+                'header': {'identifier': 'item0'},
+                'metadata': {'dc': {'title': 'Rec 0'}},
+            }),
+            ('record', {'header': {
+                'identifier': 'item1',
+                '@status': 'deleted',
+            }}),
+            ('resumptionToken', 'token<>'),
+        ]})
+
+    def test_list_identifiers(self):
+        self.request.params['verb'] = 'ListIdentifiers'
+        result = self.render_stream(
+            'listidentifiers.pt', 'header.pt', 'ListIdentifiers', None)
+        self.check_response(result, {'ListIdentifiers': [
+            ('header', {'identifier': 'item0'}),
+            ('header', {'identifier': 'item1', '@status': 'deleted'}),
+        ]})
+        self.assertNotIn('resumptionToken', result)
+
+    def test_render_fragment(self):
+        """Fragments should be identical to the rendered records."""
+        chunks = self.render_chunks(
+            'listrecords.pt', 'record.pt', 'ListRecords', None)
+        self.assertEqual(chunks[1:-1],
+                         [render_fragment(r) for r in self.records])
+
+    def test_stored_fragments(self):
+        """Stored fragments should be used in place of the template."""
+        self.records[0].fragment = render_fragment(Record('Stored', 'item0'))
+        self.records[1].fragment = None
+        result = self.render_stream(
+            'listrecords.pt', 'record.pt', 'ListRecords', None, True)
+        self.check_response(result, {'ListRecords': [
+            ('record', {
+                'header': {'identifier': 'item0'},
+                'metadata': {'dc': {'title': 'Stored'}},
+            }),
+            ('record', {'header': {
+                'identifier': 'item1',
+                '@status': 'deleted',
+            }}),
+        ]})
+
+
 class TestListIdentifiers(OaiTemplateTest):
     """Test listidentifiers.pt template."""
 
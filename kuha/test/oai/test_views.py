@@ -2,12 +2,15 @@ import unittest
 from datetime import datetime
 import json
 
+from lxml import etree
 import mock
 from pyramid import testing
 from webob.multidict import MultiDict
 
+from ... import models
 from ...oai import views
-from ...util import datestamp_now
+from ...oai.cache import MemoryCache
+from ...util import datestamp_now, format_datestamp
 from ...exception import (
     OaiException,
 
@@ -27,6 +30,10 @@ from ...exception import (
     ExpiredResumptionToken,
 )
 
+from ..test_models import ModelTestCase
+
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+
 
 class Data(object):
     def __init__(self, **kwargs):
@@ -40,6 +47,11 @@ class ViewTestCase(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
         self.config.include('pyramid_chameleon')
+        # By default, the database has never been modified.
+        patcher = mock.patch.object(views.Datestamp, 'get_with_version',
+                                    return_value=(None, None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         testing.tearDown()
@@ -109,6 +121,231 @@ class RepeatedVerbMixin(object):
         self.assertRaises(RepeatedVerb, self.function, request)
 
 
+class TestConditionalRequests(ViewTestCase):
+
+    def setUp(self):
+        super(TestConditionalRequests, self).setUp()
+        self.datestamp = datetime(2014, 3, 21, 15, 47, 37)
+        self.version = 1
+        patcher = mock.patch.object(
+            views.Datestamp, 'get_with_version',
+            side_effect=lambda: (self.datestamp, self.version))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The application is started before the latest modification.
+        patcher = mock.patch.object(views, 'datestamp_now',
+                                    return_value=datetime(2014, 1, 1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.handler = mock.Mock(return_value={})
+        self.function = views.oai_view(lambda request: self.handler(request))
+
+    def call(self, headers={}, **params):
+        request = testing.DummyRequest(params=MultiDict(
+            verb='Identify', **params
+        ), headers=headers)
+        result = self.function(request)
+        return request.response, result
+
+    def test_validators(self):
+        response, _ = self.call()
+        self.assertIsNotNone(response.etag)
+        self.assertEqual(response.last_modified.replace(tzinfo=None),
+                         self.datestamp)
+
+    def test_etag_changes(self):
+        """Entity tag should depend on the parameters, the datestamp,
+        the version and the settings."""
+        etags = set()
+        etags.add(self.call()[0].etag)
+        etags.add(self.call(identifier='a')[0].etag)
+        self.datestamp = datetime(2014, 3, 21, 15, 47, 38)
+        etags.add(self.call()[0].etag)
+        self.version = 2
+        etags.add(self.call()[0].etag)
+        testing.tearDown()
+        self.config = testing.setUp(settings={'repository_name': 'x'})
+        etags.add(self.call()[0].etag)
+        self.assertEqual(len(etags), 5)
+
+    def test_etag_changes_after_restart(self):
+        """Entity tag should change when the application is restarted,
+        since the templates may have changed."""
+        first = self.call()[0].etag
+        testing.tearDown()
+        self.config = testing.setUp()
+        with mock.patch.object(views, 'datestamp_now',
+                               return_value=datetime(2014, 1, 2)):
+            second = self.call()[0].etag
+        self.assertNotEqual(first, second)
+
+    def test_if_none_match(self):
+        response, _ = self.call()
+        etag = response.etag
+
+        response, result = self.call(
+            headers={'If-None-Match': 'W/"{0}"'.format(etag)})
+        self.assertIs(result, response)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(self.handler.call_count, 1)
+
+        # A modified database gives a new response.
+        self.datestamp = datetime(2014, 3, 21, 15, 47, 38)
+        response, result = self.call(
+            headers={'If-None-Match': 'W/"{0}"'.format(etag)})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(self.handler.call_count, 2)
+
+    def test_if_modified_since(self):
+        headers = {'If-Modified-Since': 'Fri, 21 Mar 2014 15:47:37 GMT'}
+        response, _ = self.call(headers=headers)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(self.handler.call_count, 0)
+
+        headers = {'If-Modified-Since': 'Fri, 21 Mar 2014 15:47:36 GMT'}
+        response, _ = self.call(headers=headers)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(self.handler.call_count, 1)
+
+    def test_post(self):
+        """Conditional headers should be ignored in POST requests."""
+        etag = self.call()[0].etag
+        request = testing.DummyRequest(
+            post=MultiDict(verb='Identify'),
+            headers={'If-None-Match': 'W/"{0}"'.format(etag)},
+        )
+        self.function(request)
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual(self.handler.call_count, 2)
+
+    def test_never_modified(self):
+        """Responses should not be validated before the first datestamp."""
+        self.datestamp = None
+        response, _ = self.call(headers={'If-None-Match': '*'})
+        self.assertIsNone(response.etag)
+        self.assertEqual(self.handler.call_count, 1)
+
+
+class TestResponseCache(ViewTestCase):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        patcher = mock.patch.object(
+            views.Datestamp, 'get_with_version',
+            return_value=(datetime(2014, 3, 21, 15, 47, 37), 1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config.registry.response_cache = MemoryCache(1000)
+
+        self.body = (
+            '<OAI-PMH><responseDate>{0}</responseDate></OAI-PMH>'
+        )
+        self.handler = mock.Mock(side_effect=self.render)
+        self.function = views.oai_view(lambda request: self.handler(request))
+
+    def render(self, request):
+        response = request.response
+        response.text = self.body.format(format_datestamp(request.time))
+        return response
+
+    def call(self, time):
+        request = testing.DummyRequest(params=MultiDict(verb='Identify'))
+        with mock.patch.object(views, 'datestamp_now', return_value=time):
+            response = self.function(request)
+        # Run the response callbacks like the router would.
+        request._process_response_callbacks(response)
+        return response
+
+    def test_cached(self):
+        first = self.call(datetime(2015, 1, 1, 0, 0, 0))
+        second = self.call(datetime(2015, 1, 2, 3, 4, 5))
+        self.assertEqual(self.handler.call_count, 1)
+        self.assertEqual(first.body, self.body.format(
+            '2015-01-01T00:00:00Z').encode('utf-8'))
+        self.assertEqual(second.body, self.body.format(
+            '2015-01-02T03:04:05Z').encode('utf-8'))
+        self.assertEqual(second.content_type, 'text/xml')
+
+    def test_streamed(self):
+        """Streamed responses should be stored after they are sent."""
+        def render(request):
+            response = request.response
+            response.app_iter = iter([
+                b'<OAI-PMH><responseDate>',
+                format_datestamp(request.time).encode('utf-8'),
+                b'</responseDate></OAI-PMH>',
+            ])
+            return response
+        self.handler.side_effect = render
+
+        first = self.call(datetime(2015, 1, 1, 0, 0, 0))
+        # Not stored before the body has been sent.
+        self.call(datetime(2015, 1, 1, 0, 0, 0))
+        self.assertEqual(self.handler.call_count, 2)
+
+        self.assertEqual(first.body, self.body.format(
+            '2015-01-01T00:00:00Z').encode('utf-8'))
+        second = self.call(datetime(2015, 1, 2, 3, 4, 5))
+        self.assertEqual(self.handler.call_count, 2)
+        self.assertEqual(second.body, self.body.format(
+            '2015-01-02T03:04:05Z').encode('utf-8'))
+
+    def test_database_modified(self):
+        self.call(datetime(2015, 1, 1, 0, 0, 0))
+        views.Datestamp.get_with_version.return_value = (
+            datetime(2015, 1, 1, 0, 0, 0), 2)
+        self.call(datetime(2015, 1, 2, 0, 0, 0))
+        self.assertEqual(self.handler.call_count, 2)
+
+
+class TestResponseCacheChanges(ModelTestCase):
+    """Cached responses should not be reused after the database has
+    changed, even in the same second."""
+
+    def setUp(self):
+        super(TestResponseCacheChanges, self).setUp()
+        self.config = testing.setUp()
+        self.config.registry.response_cache = MemoryCache(1000)
+        patcher = mock.patch.object(
+            models, 'datestamp_now',
+            return_value=datetime(2026, 10, 16, 23, 18, 59))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.function = views.oai_view(
+            lambda request: self.render(request))
+
+    def tearDown(self):
+        testing.tearDown()
+        super(TestResponseCacheChanges, self).tearDown()
+
+    def render(self, request):
+        response = request.response
+        response.text = (
+            '<OAI-PMH><responseDate>{0}</responseDate>'
+            '<sets>{1}</sets></OAI-PMH>'
+            ''.format(format_datestamp(request.time),
+                      len(models.Set.list()))
+        )
+        return response
+
+    def call(self):
+        request = testing.DummyRequest(params=MultiDict(verb='ListSets'))
+        response = self.function(request)
+        request._process_response_callbacks(response)
+        return response
+
+    def test_changes_in_same_second(self):
+        models.Item.create('item')
+        models.Datestamp.update()
+        first = self.call()
+        models.Set.create('a', 'Set A')
+        second = self.call()
+        self.assertIn(b'<sets>0</sets>', first.body)
+        self.assertIn(b'<sets>1</sets>', second.body)
+        self.assertNotEqual(first.etag, second.etag)
+
+
 class TestIdentifyView(ViewTestCase,
                        InvalidArgumentMixin,
                        RepeatedVerbMixin):
@@ -129,33 +366,115 @@ class TestIdentifyView(ViewTestCase,
             '<description2/>',
         ]
 
-    @mock.patch.object(views, 'Record')
+    def set_datestamp(self, date_mock, datestamp, earliest):
+        date_mock.get_with_version.return_value = (datestamp, None)
+        date_mock.get_with_earliest.return_value = (datestamp, earliest)
+
+    def get_identify(self, request=None):
+        if request is None:
+            request = testing.DummyRequest(params=self.minimal_params())
+        response = self.function(request)
+        self.assertEqual(response.content_type, 'text/xml')
+        return etree.fromstring(response.body)
+
+    def find_text(self, tree, tag):
+        return [e.text for e in tree.iter('{%s}%s' % (OAI_NS, tag))]
+
+    @mock.patch.object(views, 'Datestamp')
     def test_identify(self, mock_obj):
         """Identify should return the configured information."""
         date = datetime(2014, 3, 21, 15, 47, 37)
-        mock_obj.earliest_datestamp.return_value = date
-
-        request = testing.DummyRequest(params=self.minimal_params())
-        self.check_response(
-            self.function(request),
-            earliest=date,
-            repository_name='repo',
-            deleted_records='transient',
-            admin_emails=['leet@example.org', 'hacker@example.org'],
-            repository_descriptions=['<description1/>', '<description2/>'],
+        self.set_datestamp(mock_obj, datetime(2015, 1, 1, 0, 0, 0), date)
+
+        tree = self.get_identify()
+        self.assertEqual(self.find_text(tree, 'repositoryName'), ['repo'])
+        self.assertEqual(self.find_text(tree, 'earliestDatestamp'),
+                         ['2014-03-21T15:47:37Z'])
+        self.assertEqual(self.find_text(tree, 'deletedRecord'),
+                         ['transient'])
+        self.assertEqual(self.find_text(tree, 'adminEmail'),
+                         ['leet@example.org', 'hacker@example.org'])
+        self.assertEqual(
+            [etree.QName(e[0]).localname
+             for e in tree.iter('{%s}description' % OAI_NS)],
+            ['description1', 'description2'],
         )
-        mock_obj.earliest_datestamp.assert_called_once_with(False)
+        mock_obj.get_with_earliest.assert_called_once_with()
 
-    @mock.patch.object(views, 'Record')
-    def test_identify_none_datestamp(self, mock_func):
+    @mock.patch.object(views, 'Datestamp')
+    def test_identify_none_datestamp(self, mock_obj):
         """Earliest datestamp should be the current time when there are no
         records.
         """
-        mock_func.earliest_datestamp.return_value = None
+        self.set_datestamp(mock_obj, None, None)
         now = datestamp_now()
-        result = self.function(
-            testing.DummyRequest(params=self.minimal_params()))
-        self.assertTrue(result['earliest'] >= now)
+        tree = self.get_identify()
+        earliest = self.find_text(tree, 'earliestDatestamp')[0]
+        self.assertTrue(earliest >= format_datestamp(now))
+
+    @mock.patch.object(views, 'Datestamp')
+    def test_identify_cached(self, mock_obj):
+        """The response should be rendered only when the database
+        changes."""
+        date = datetime(2014, 3, 21, 15, 47, 37)
+        self.set_datestamp(mock_obj, date, date)
+
+        self.get_identify()
+        # Changes in the settings are not seen until the database
+        # changes.
+        self.config.get_settings()['repository_name'] = 'new name'
+        with mock.patch.object(views, 'datestamp_now') as now_mock:
+            now_mock.return_value = datetime(2016, 1, 2, 3, 4, 5)
+            tree = self.get_identify()
+        self.assertEqual(self.find_text(tree, 'repositoryName'), ['repo'])
+        self.assertEqual(self.find_text(tree, 'responseDate'),
+                         ['2016-01-02T03:04:05Z'])
+
+        self.set_datestamp(mock_obj,
+                           datetime(2015, 1, 1, 0, 0, 0),
+                           datetime(2013, 1, 1, 0, 0, 0))
+        tree = self.get_identify()
+        self.assertEqual(self.find_text(tree, 'repositoryName'),
+                         ['new name'])
+        self.assertEqual(self.find_text(tree, 'earliestDatestamp'),
+                         ['2013-01-01T00:00:00Z'])
+
+
+class TestIdentifyCacheChanges(ModelTestCase):
+    """The cached Identify response should be rendered again after the
+    database has changed, even in the same second."""
+
+    def setUp(self):
+        super(TestIdentifyCacheChanges, self).setUp()
+        self.config = testing.setUp(settings={
+            'repository_name': 'repo',
+            'admin_emails': ['admin@example.org'],
+            'deleted_records': 'transient',
+            'repository_descriptions': [],
+        })
+        self.config.include('pyramid_chameleon')
+        patcher = mock.patch.object(
+            models, 'datestamp_now',
+            return_value=datetime(2026, 10, 16, 23, 18, 59))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        testing.tearDown()
+        super(TestIdentifyCacheChanges, self).tearDown()
+
+    def get_name(self):
+        request = testing.DummyRequest(params=MultiDict(verb='Identify'))
+        tree = etree.fromstring(views.handle_identify(request).body)
+        return tree.findtext('.//{%s}repositoryName' % OAI_NS)
+
+    def test_changes_in_same_second(self):
+        models.Item.create('item')
+        models.Datestamp.update()
+        self.assertEqual(self.get_name(), 'repo')
+        self.config.get_settings()['repository_name'] = 'new name'
+        models.Set.create('a', 'Set A')
+        self.assertEqual(self.get_name(), 'new name')
 
 
 class TestListSetsView(ViewTestCase,
@@ -165,26 +484,24 @@ class TestListSetsView(ViewTestCase,
         self.function = views.handle_list_sets
         super(TestListSetsView, self).setUp()
 
-    @mock.patch.object(views, 'Set')
-    def test_no_set_hierarchy(self, set_mock):
+    @mock.patch.object(views, 'get_metadata')
+    def test_no_set_hierarchy(self, metadata_mock):
         """View should raise NoSetHierarchy."""
-        set_mock.list.return_value = []
+        metadata_mock.return_value.sets = []
         request = testing.DummyRequest(params=self.minimal_params())
         self.assertRaises(NoSetHierarchy, self.function, request)
 
-    @mock.patch.object(views, 'Set')
-    def test_has_sets(self, set_mock):
-        """View should raise NoSetHierarchy."""
+    @mock.patch.object(views, 'get_metadata')
+    def test_has_sets(self, metadata_mock):
+        """View should return the sets."""
         sets = [mock.Mock(), mock.Mock()]
-        set_mock.list.return_value = sets
+        metadata_mock.return_value.sets = sets
         request = testing.DummyRequest(params=self.minimal_params())
         result = self.function(request)
         self.assertCountEqual(result['sets'], sets)
 
-    @mock.patch.object(views, 'Datestamp')
-    def test_invalid_resumption(self, date_mock):
+    def test_invalid_resumption(self):
         """Using a resumption token should raise InvalidResumptionToken."""
-        date_mock.get.return_value = datetime(2000, 4, 5, 12, 3, 4)
         token = {'verb': self.verb, 'date': '2015-04-01', 'offset': 'a'}
         request = testing.DummyRequest(params=MultiDict(
             verb=self.verb,
@@ -192,11 +509,10 @@ class TestListSetsView(ViewTestCase,
         ))
         self.assertRaises(InvalidResumptionToken, self.function, request)
 
-    @mock.patch.object(views, 'Datestamp')
-    def test_expired_resumption(self, date_mock):
-        """Using an expired token should raise InvalidResumptionToken."""
-        date_mock.get.return_value = datetime(3100, 4, 5, 12, 3, 4)
-        token = {'verb': self.verb, 'date': '2015-04-01', 'offset': 'a'}
+    def test_future_resumption(self):
+        """Using a token from the future should raise
+        InvalidResumptionToken."""
+        token = {'verb': self.verb, 'date': '3100-04-01', 'offset': 'a'}
         request = testing.DummyRequest(params=MultiDict(
             verb=self.verb,
             resumptionToken=json.dumps(token),
@@ -213,15 +529,16 @@ class TestListFormatsView(ViewTestCase,
         super(TestListFormatsView, self).setUp()
         self.config.add_settings(deleted_records='transient')
 
-    @mock.patch.object(views, 'Format')
-    def test_list_all_formats(self, format_mock):
+    @mock.patch.object(views, 'get_metadata')
+    def test_list_all_formats(self, metadata_mock):
         formats = [Data(prefix='oai_dc'), Data(prefix='ead')]
-        format_mock.list.return_value = formats
+        list_mock = metadata_mock.return_value.list_formats
+        list_mock.return_value = formats
 
         request = testing.DummyRequest(params=self.minimal_params())
 
         self.check_response(self.function(request), formats=formats)
-        format_mock.list.assert_called_once_with(None, False)
+        list_mock.assert_called_once_with(False)
 
     @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Item')
@@ -289,7 +606,8 @@ class TestListItemsView(ViewTestCase,
     def test_list_all_records(self):
         params = self.minimal_params()
 
-        with mock.patch.object(views, '_get_records') as mock_func:
+        with mock.patch.object(views, '_get_records') as mock_func, \
+                mock.patch.object(views, 'get_metadata') as metadata_mock:
             mock_func.return_value = (['1', '2'], '3')
             result = self.function(testing.DummyRequest(params=params))
 
@@ -302,7 +620,9 @@ class TestListItemsView(ViewTestCase,
             'from': None,
             'until': None,
         })
-        mock_func.assert_called_once_with(params, False, 4)
+        mock_func.assert_called_once_with(
+            params, False, 4, metadata_mock.return_value,
+            headers_only=False, snapshot=result['time'])
 
     def test_list_identifiers(self):
         """View should handle ListIdentifiers as well."""
@@ -310,20 +630,21 @@ class TestListItemsView(ViewTestCase,
         params = self.minimal_params()
         params['verb'] = self.verb
 
-        with mock.patch.object(views, '_get_records') as mock_func:
+        with mock.patch.object(views, '_get_records') as mock_func, \
+                mock.patch.object(views, 'get_metadata') as metadata_mock:
             mock_func.return_value = ([1, 2], None)
             result = self.function(testing.DummyRequest(params=params))
 
         self.check_response(result, records=[1, 2])
-        mock_func.assert_called_once_with(params, False, 4)
+        mock_func.assert_called_once_with(
+            params, False, 4, metadata_mock.return_value,
+            headers_only=True, snapshot=result['time'])
 
-    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'get_metadata')
     @mock.patch.object(views, 'Record')
-    @mock.patch.object(views, 'Set')
-    def test_resumption(self, set_mock, record_mock, format_mock):
-        set_mock.list.return_value = [mock.Mock]
-        record_mock.list.return_value = self.records
-        format_mock.exists.return_value = True
+    def test_resumption(self, record_mock, metadata_mock):
+        record_mock.identifier_at.side_effect = ['b', None]
+        record_mock.iterate.return_value = iter(self.records)
         token_mock = mock.Mock(return_value={
             'verb': self.verb,
             'metadataPrefix': 'dummy',
@@ -342,19 +663,87 @@ class TestListItemsView(ViewTestCase,
         with mock.patch.object(views, '_get_resumption_token', token_mock):
             result = self.function(request)
 
-        self.check_response(result, records=self.records, token='')
-        record_mock.list.assert_called_once_with(
+        self.check_response(result, token='')
+        self.assertEqual(list(result['records']), self.records)
+        conditions = dict(
             metadata_prefix='dummy',
             from_date=datetime(1970, 1, 1, 0, 0, 0),
-            until_date=datetime(2140, 1, 1, 23, 59, 59),
+            # limited by the date of the token
+            until_date=datetime(2014, 3, 31, 0, 0, 0),
             set_='math:geometry',
             ignore_deleted=False,
-            offset='b', limit=5,
+            offset='b',
+        )
+        self.assertEqual(
+            record_mock.identifier_at.mock_calls,
+            [mock.call(0, **conditions), mock.call(4, **conditions)]
+        )
+        record_mock.iterate.assert_called_once_with(
+            end_offset=None,
+            headers_only=False,
+            fragments=True,
+            **conditions
         )
         token_mock.assert_called_once_with(request)
 
-    @mock.patch.object(views, 'Format')
-    def test_resumption_invalid_argument(self, format_mock):
+    @mock.patch.object(views, 'get_metadata')
+    @mock.patch.object(views, 'Record')
+    def test_resumption_keeps_date(self, record_mock, metadata_mock):
+        """The new token should have the date of the previous token."""
+        record_mock.identifier_at.side_effect = ['b', 'f']
+        record_mock.iterate.return_value = iter(self.records)
+        token_mock = mock.Mock(return_value={
+            'verb': self.verb,
+            'metadataPrefix': 'dummy',
+            'offset': 'b',
+            'date': '2014-03-31T12:00:00Z',
+            'from': None,
+            'until': None,
+            'set': None,
+        })
+        request = testing.DummyRequest(params=MultiDict(
+            verb=self.verb,
+            resumptionToken='token',
+        ))
+
+        with mock.patch.object(views, '_get_resumption_token', token_mock):
+            result = self.function(request)
+
+        token = json.loads(result['token'])
+        self.assertEqual(token['offset'], 'f')
+        self.assertEqual(token['date'], '2014-03-31T12:00:00Z')
+        self.assertEqual(
+            record_mock.identifier_at.call_args[1]['until_date'],
+            datetime(2014, 3, 31, 12, 0, 0),
+        )
+
+    @mock.patch.object(views, 'get_metadata')
+    @mock.patch.object(views, 'Record')
+    def test_resumption_no_records_left(self, record_mock, metadata_mock):
+        """Should raise ExpiredResumptionToken if the remaining records
+        have been removed."""
+        record_mock.identifier_at.return_value = None
+        token_mock = mock.Mock(return_value={
+            'verb': self.verb,
+            'metadataPrefix': 'dummy',
+            'offset': 'b',
+            'date': '2014-03-31',
+            'from': None,
+            'until': None,
+            'set': None,
+        })
+        request = testing.DummyRequest(params=MultiDict(
+            verb=self.verb,
+            resumptionToken='token',
+        ))
+
+        with mock.patch.object(views, '_get_resumption_token', token_mock):
+            self.assertRaises(ExpiredResumptionToken,
+                              self.function,
+                              request)
+
+    @mock.patch.object(views, 'get_metadata')
+    def test_resumption_invalid_argument(self, metadata_mock):
         """Should raise InvalidResumptionToken when token contain invalid
         arguments."""
         request = testing.DummyRequest(params=MultiDict(
@@ -362,12 +751,11 @@ class TestListItemsView(ViewTestCase,
             resumptionToken='token',
         ))
 
-        format_mock.exists.return_value = False
         token_mock = mock.Mock(return_value={
             'verb': self.verb,
-            'metadataPrefix': 'dummy', # non-existent format
+            'metadataPrefix': 'dummy',
             'offset': 'b',
-            'from': None,
+            'from': 'yesterday', # invalid date
             'until': None,
             'set': None,
             'date': '2014-04-08T15:37:56Z',
@@ -384,7 +772,32 @@ class TestListItemsView(ViewTestCase,
                     'resumptionToken': 'token',
                 }
         token_mock.assert_called_once_with(MatchRequest())
-        format_mock.exists.assert_called_once_with('dummy', False)
+
+    @mock.patch.object(views, 'get_metadata')
+    def test_resumption_format_removed(self, metadata_mock):
+        """Should raise ExpiredResumptionToken when the format of the token
+        no longer exists."""
+        request = testing.DummyRequest(params=MultiDict(
+            verb=self.verb,
+            resumptionToken='token',
+        ))
+
+        exists_mock = metadata_mock.return_value.format_exists
+        exists_mock.return_value = False
+        token_mock = mock.Mock(return_value={
+            'verb': self.verb,
+            'metadataPrefix': 'dummy', # non-existent format
+            'offset': 'b',
+            'from': None,
+            'until': None,
+            'set': None,
+            'date': '2014-04-08T15:37:56Z',
+        })
+        with mock.patch.object(views, '_get_resumption_token', token_mock):
+            self.assertRaises(ExpiredResumptionToken,
+                              self.function,
+                              request)
+        exists_mock.assert_called_once_with('dummy', False)
 
     def test_resumption_expired(self):
         request = testing.DummyRequest(params=MultiDict(
@@ -409,71 +822,84 @@ class TestGetRecords(unittest.TestCase):
             'until': '2014-02-01',
             'set': 'abcde',
         }
+        self.metadata = mock.Mock()
+        self.metadata.format_exists.return_value = True
+        self.metadata.has_sets.return_value = True
+        self.metadata.set_exists.return_value = True
 
-    @mock.patch.object(views, 'Format')
-    def test_invalid_prefix(self, format_mock):
-        format_mock.exists.return_value = False
+    def test_invalid_prefix(self):
+        self.metadata.format_exists.return_value = False
         self.assertRaises(UnsupportedMetadataFormat,
                           views._get_records,
-                          self.test_params, False, 10)
-        format_mock.exists.assert_called_once_with('prefix', False)
+                          self.test_params, False, 10, self.metadata)
+        self.metadata.format_exists.assert_called_once_with('prefix', False)
 
-    @mock.patch.object(views, 'Format')
-    @mock.patch.object(views, 'Set')
-    def test_no_set_hierarchy(self, set_mock, format_mock):
-        set_mock.list.return_value = []
-        format_mock.exists.return_value = True
+    def test_no_set_hierarchy(self):
+        self.metadata.has_sets.return_value = False
         self.assertRaises(NoSetHierarchy,
                           views._get_records,
-                          self.test_params, False, 10)
+                          self.test_params, False, 10, self.metadata)
 
-    @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Record')
-    @mock.patch.object(views, 'Set')
-    def test_no_matching_records(self,
-                                 set_mock,
-                                 record_mock,
-                                 format_mock):
-        set_mock.list.return_value = [mock.Mock()]
-        format_mock.exists.return_value = True
-        record_mock.list.return_value = []
+    def test_no_such_set(self, record_mock):
+        """Should raise NoRecordsMatch without a query if the set does not
+        exist."""
+        self.metadata.set_exists.return_value = False
         self.assertRaises(NoRecordsMatch,
                           views._get_records,
-                          self.test_params, True, 10)
-        record_mock.list.assert_called_once_with(
+                          self.test_params, False, 10, self.metadata)
+        self.metadata.set_exists.assert_called_once_with('abcde')
+        self.assertEqual(record_mock.mock_calls, [])
+
+    @mock.patch.object(views, 'Record')
+    def test_no_matching_records(self, record_mock):
+        record_mock.identifier_at.return_value = None
+        self.assertRaises(NoRecordsMatch,
+                          views._get_records,
+                          self.test_params, True, 10, self.metadata)
+        record_mock.identifier_at.assert_called_once_with(
+            0,
             metadata_prefix='prefix',
             from_date=datetime(2014, 1, 30, 0, 0, 0),
             until_date=datetime(2014, 2, 1, 23, 59, 59),
             set_='abcde',
             ignore_deleted=True,
-            offset=None, limit=11,
+            offset=None,
         )
+        self.assertEqual(record_mock.iterate.mock_calls, [])
 
-    @mock.patch.object(views, 'Format')
     @mock.patch.object(views, 'Record')
-    @mock.patch.object(views, 'Set')
-    def test_limited_list(self, set_mock, record_mock, format_mock):
-        set_mock.list.return_value = [mock.Mock()]
+    def test_limited_list(self, record_mock):
         model_records = [
             Data(identifier='1', prefix='prefix', xml='data'),
             Data(identifier='2', prefix='prefix', xml='data'),
             Data(identifier='3', prefix='prefix', xml='data'),
-            Data(identifier='4', prefix='prefix', xml='data'),
         ]
-        record_mock.list.return_value = model_records
-        format_mock.exists.return_value = True
+        record_mock.identifier_at.side_effect = ['1', '4']
+        record_mock.iterate.return_value = iter(model_records)
 
-        records, offset = views._get_records(self.test_params, False, 3)
+        records, offset = views._get_records(
+            self.test_params, False, 3, self.metadata, headers_only=True)
 
-        self.assertEqual(records, model_records[0:3])
+        self.assertEqual(list(records), model_records)
         self.assertEqual(offset, '4')
-        record_mock.list.assert_called_once_with(
+        conditions = dict(
             metadata_prefix='prefix',
             from_date=datetime(2014, 1, 30, 0, 0, 0),
             until_date=datetime(2014, 2, 1, 23, 59, 59),
             set_='abcde',
             ignore_deleted=False,
-            offset=None, limit=4,
+            offset=None,
+        )
+        self.assertEqual(
+            record_mock.identifier_at.mock_calls,
+            [mock.call(0, **conditions), mock.call(3, **conditions)]
+        )
+        record_mock.iterate.assert_called_once_with(
+            end_offset='4',
+            headers_only=True,
+            fragments=False,
+            **conditions
         )
 
 
@@ -494,46 +920,49 @@ class TestGetResumptionToken(unittest.TestCase):
     def tearDown(self):
         testing.tearDown()
 
-    @mock.patch.object(views, 'Datestamp')
-    def test_valid_token(self, date_mock):
-        date_mock.get.return_value = datetime(2000, 1, 1, 0, 0, 0)
-        request = testing.DummyRequest(params=MultiDict(
+    def _request(self, **params):
+        request = testing.DummyRequest(params=MultiDict(**params))
+        request.time = datetime(2014, 6, 1, 0, 0, 0)
+        return request
+
+    def test_valid_token(self):
+        request = self._request(
             verb='ListRecords',
             resumptionToken=json.dumps(self.token_dict),
-        ))
+        )
         token = views._get_resumption_token(request)
         self.assertEqual(token, self.token_dict)
 
-    @mock.patch.object(views, 'Datestamp')
-    def test_no_token(self, date_mock):
-        date_mock.get.return_value = datetime(2000, 1, 1, 0, 0, 0)
-        request = testing.DummyRequest(params=MultiDict(
+    def test_no_token(self):
+        request = self._request(
             verb='ListIdentifiers',
             metadataPrefix='oai_dc',
-        ))
+        )
         self.assertIsNone(views._get_resumption_token(request))
 
-    @mock.patch.object(views, 'Datestamp')
-    def test_token_expired(self, date_mock):
-        date_mock.get.return_value = datetime(2000, 1, 1, 0, 0, 0)
+    def test_old_token(self):
+        """Tokens should not expire when the database is modified."""
         self.token_dict['date'] = '1970-01-01'
-        request = testing.DummyRequest(params=MultiDict(
+        request = self._request(
             verb='ListRecords',
             resumptionToken=json.dumps(self.token_dict),
-        ))
-        self.assertRaises(ExpiredResumptionToken,
-                          views._get_resumption_token,
-                          request)
+        )
+        token = views._get_resumption_token(request)
+        self.assertEqual(token, self.token_dict)
+
+    def test_future_date(self):
+        self.token_dict['date'] = '2014-06-02'
+        self._test_invalid_token(json.dumps(self.token_dict))
 
     def _test_invalid_token(self, token):
         """
         Assert that _get_resumption_token raises InvalidResumptionToken
         with the given token.
         """
-        request = testing.DummyRequest(params=MultiDict(
+        request = self._request(
             verb='ListRecords',
             resumptionToken=token,
-        ))
+        )
         self.assertRaises(InvalidResumptionToken,
                           views._get_resumption_token,
                           request)
@@ -586,12 +1015,12 @@ class TestGetRecordView(ViewTestCase,
         )
 
     @mock.patch.object(views, 'Record')
-    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'get_metadata')
     @mock.patch.object(views, 'Item')
-    def test_get_record(self, item_mock, format_mock, record_mock):
+    def test_get_record(self, item_mock, metadata_mock, record_mock):
         """Calling with valid params should fetch the record."""
         item_mock.exists.return_value = True
-        format_mock.exists.return_value = True
+        metadata_mock.return_value.format_exists.return_value = True
         record_mock.list.return_value = [self.record]
         request = testing.DummyRequest(params=self.minimal_params())
 
@@ -599,41 +1028,43 @@ class TestGetRecordView(ViewTestCase,
 
         self.check_response(result, record=self.record)
         item_mock.exists.assert_called_once_with('item', True)
-        format_mock.exists.assert_called_once_with('dummy', True)
+        metadata_mock.return_value.format_exists.assert_called_once_with(
+            'dummy', True)
         record_mock.list.assert_called_once_with(
             identifier='item',
             metadata_prefix='dummy',
             ignore_deleted=True,
         )
 
-    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'get_metadata')
     @mock.patch.object(views, 'Item')
-    def test_invalid_prefix(self, item_mock, format_mock):
+    def test_invalid_prefix(self, item_mock, metadata_mock):
         item_mock.exists.return_value = True
-        format_mock.exists.return_value = False
+        metadata_mock.return_value.format_exists.return_value = False
         request = testing.DummyRequest(params=self.minimal_params())
 
         self.assertRaises(UnsupportedMetadataFormat,
                           self.function,
                           request)
-        format_mock.exists.assert_called_once_with('dummy', True)
+        metadata_mock.return_value.format_exists.assert_called_once_with(
+            'dummy', True)
 
-    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'get_metadata')
     @mock.patch.object(views, 'Item')
-    def test_invalid_identifier(self, item_mock, format_mock):
+    def test_invalid_identifier(self, item_mock, metadata_mock):
         item_mock.exists.return_value = False
-        format_mock.exists.return_value = True
+        metadata_mock.return_value.format_exists.return_value = True
         request = testing.DummyRequest(params=self.minimal_params())
 
         self.assertRaises(IdDoesNotExist, self.function, request)
         item_mock.exists.assert_called_once_with('item', True)
 
     @mock.patch.object(views, 'Record')
-    @mock.patch.object(views, 'Format')
+    @mock.patch.object(views, 'get_metadata')
     @mock.patch.object(views, 'Item')
-    def test_unavailable_format(self, item_mock, format_mock, record_mock):
+    def test_unavailable_format(self, item_mock, metadata_mock, record_mock):
         item_mock.exists.return_value = True
-        format_mock.exists.return_value = True
+        metadata_mock.return_value.format_exists.return_value = True
         record_mock.list.return_value = []
         request = testing.DummyRequest(params=self.minimal_params())
 
@@ -44,6 +44,68 @@ class TestCleanSettings(unittest.TestCase):
         cleaners['setting'].assert_called_once_with('   ')
 
 
+    def test_defaults(self):
+        settings = {'a': '1'}
+        cleaners = {'a': int, 'b': int}
+        config._clean_settings(settings, cleaners, {'a': '2', 'b': '3'})
+        self.assertEqual(settings, {'a': 1, 'b': 3})
+
+
+class TestCleanOaiSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = {
+            'admin_emails': 'admin@example.org',
+            'deleted_records': 'no',
+            'item_list_limit': '10',
+            'logging_config': 'test.ini',
+            'repository_descriptions': '',
+            'repository_name': 'Test',
+            'sqlalchemy.url': 'sqlite://',
+        }
+
+    def test_response_cache_defaults(self):
+        config.clean_oai_settings(self.settings)
+        self.assertEqual(self.settings['response_cache'], 'none')
+        self.assertEqual(self.settings['response_cache_size'],
+                         64 * 1024 * 1024)
+
+    def test_file_cache_without_directory(self):
+        self.settings['response_cache'] = 'file'
+        self.assertRaises(ConfigurationError,
+                          config.clean_oai_settings,
+                          self.settings)
+
+
+class TestCleanResponseCache(unittest.TestCase):
+
+    def test_valid_values(self):
+        for v in ['none', 'memory', 'file']:
+            self.assertEqual(config._clean_response_cache(v), v)
+
+    def test_invalid_value(self):
+        self.assertRaises(ValueError,
+                          config._clean_response_cache,
+                          'disk')
+
+
+class TestCleanSize(unittest.TestCase):
+
+    def test_valid_sizes(self):
+        cases = [
+            ('100', 100),
+            ('4KB', 4096),
+            (' 3 mb ', 3 * 1024 * 1024),
+            ('1GB', 1024 * 1024 * 1024),
+        ]
+        for value, expected in cases:
+            self.assertEqual(config._clean_size(value), expected)
+
+    def test_invalid_sizes(self):
+        for value in ['0', '-1MB', 'MB', 'abc', '1TB']:
+            self.assertRaises(ValueError, config._clean_size, value)
+
+
 class TestCleanAdminEmails(unittest.TestCase):
 
     def test_valid_emails(self):
@@ -114,6 +176,113 @@ class TestCleanItemListLimit(unittest.TestCase):
                               value)
 
 
+class TestCleanImporterSettings(unittest.TestCase):
+
+    def test_batch_defaults(self):
+        settings = {
+            'deleted_records': 'no',
+            'dry_run': 'no',
+            'force_update': 'no',
+            'logging_config': 'test.ini',
+            'sqlalchemy.url': 'sqlite://',
+            'timestamp_file': 'last_update',
+            'metadata_provider_class': 'module:Class',
+        }
+        config.clean_importer_settings(settings)
+        self.assertEqual(settings['harvest_batch_size'], 100)
+        self.assertEqual(settings['harvest_batch_interval'], 10)
+        self.assertEqual(settings['harvest_workers'], 0)
+        self.assertEqual(settings['harvest_worker_type'], 'process')
+        self.assertFalse(settings['watch'])
+        self.assertEqual(settings['watch_delay'], 2)
+        self.assertEqual(settings['watch_method'], 'auto')
+        self.assertEqual(settings['watch_poll_interval'], 5)
+        self.assertEqual(settings['validation_schemas'], {})
+
+
+class TestCleanBatchSize(unittest.TestCase):
+
+    def test_valid_size(self):
+        self.assertEqual(config._clean_batch_size('500'), 500)
+
+    def test_invalid_size(self):
+        for value in [-1, 0, 'abc']:
+            self.assertRaises(ValueError, config._clean_batch_size, value)
+
+
+class TestCleanBatchInterval(unittest.TestCase):
+
+    def test_valid_interval(self):
+        self.assertEqual(config._clean_batch_interval('2.5'), 2.5)
+
+    def test_disabled(self):
+        self.assertIsNone(config._clean_batch_interval('0'))
+
+    def test_invalid_interval(self):
+        for value in ['-1', 'abc']:
+            self.assertRaises(ValueError,
+                              config._clean_batch_interval,
+                              value)
+
+
+class TestCleanWorkers(unittest.TestCase):
+
+    def test_valid_values(self):
+        self.assertEqual(config._clean_workers('0'), 0)
+        self.assertEqual(config._clean_workers('4'), 4)
+
+    def test_invalid_values(self):
+        for value in ['-1', 'abc']:
+            self.assertRaises(ValueError, config._clean_workers, value)
+
+
+class TestCleanWorkerType(unittest.TestCase):
+
+    def test_valid_values(self):
+        for v in ['process', 'thread']:
+            self.assertEqual(config._clean_worker_type(v), v)
+
+    def test_invalid_value(self):
+        self.assertRaises(ValueError,
+                          config._clean_worker_type,
+                          'fiber')
+
+
+class TestCleanWatchSettings(unittest.TestCase):
+
+    def test_valid_values(self):
+        self.assertEqual(config._clean_watch_delay('0'), 0)
+        self.assertEqual(config._clean_watch_delay('0.5'), 0.5)
+        self.assertEqual(config._clean_poll_interval('10'), 10)
+        for v in ['auto', 'inotify', 'poll']:
+            self.assertEqual(config._clean_watch_method(v), v)
+
+    def test_invalid_values(self):
+        for value in ['-1', 'abc']:
+            self.assertRaises(ValueError, config._clean_watch_delay, value)
+        for value in ['0', '-1', 'abc']:
+            self.assertRaises(ValueError,
+                              config._clean_poll_interval,
+                              value)
+        self.assertRaises(ValueError, config._clean_watch_method, 'fanotify')
+
+
+class TestCleanValidationSchemas(unittest.TestCase):
+
+    def test_valid_value(self):
+        value = '\noai_dc {0}\n\nddi {0}'.format(__file__)
+        self.assertEqual(
+            config._clean_validation_schemas(value),
+            {'oai_dc': __file__, 'ddi': __file__},
+        )
+
+    def test_invalid_values(self):
+        for value in ['oai_dc', 'oai_dc a b', 'oai_dc no-such-file.xsd']:
+            self.assertRaises(ValueError,
+                              config._clean_validation_schemas,
+                              value)
+
+
 class TestCleanUnicode(unittest.TestCase):
 
     def test_valid_values(self):
@@ -1,5 +1,8 @@
 # encoding: utf-8
 
+import os
+import shutil
+import tempfile
 import unittest
 from datetime import datetime, timedelta
 
@@ -68,6 +71,8 @@ class ModelTestCase(unittest.TestCase):
         models._Base.metadata.create_all(self.engine)
 
     def tearDown(self):
+        # Leave no changes in the transaction of the thread.
+        models.rollback()
         self.transaction.rollback()
         DBSession.remove()
 
@@ -118,6 +123,24 @@ class TestUpdateItems(ModelTestCase):
         self.assertEqual(i2.identifier, 'other id')
         self.assertIs(i2.deleted, False)
 
+    def test_create_many(self):
+        identifiers = ['item{0}'.format(i) for i in range(1200)]
+        Item.create_many(identifiers)
+        self.assertEqual(Item.list_identifiers(),
+                         dict((i, False) for i in identifiers))
+
+    def test_undelete_many(self):
+        Item.create('i1').deleted = True
+        Item.create('i2').deleted = True
+        Item.undelete_many(['i1'])
+        self.assertEqual(Item.list_identifiers(),
+                         {'i1': False, 'i2': True})
+
+    def test_batches(self):
+        self.assertEqual(list(models._batches(range(5), 2)),
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(models._batches([], 2)), [])
+
 
 class TestListItems(ModelTestCase):
 
@@ -131,6 +154,19 @@ class TestListItems(ModelTestCase):
     def test_empty_list(self):
         self.assertEqual(Item.list(), [])
 
+    def test_list_identifiers(self):
+        Item.create('qwe')
+        Item.create('rty').deleted = True
+        self.assertEqual(Item.list_identifiers(),
+                         {'qwe': False, 'rty': True})
+
+    def test_list_some_identifiers(self):
+        Item.create('qwe')
+        Item.create('rty').deleted = True
+        Item.create('uio')
+        self.assertEqual(Item.list_identifiers(['rty', 'uio', 'missing']),
+                         {'rty': True, 'uio': False})
+
 
 class TestMarkItemsAsDeleted(ModelTestCase):
 
@@ -164,6 +200,55 @@ class TestMarkItemsAsDeleted(ModelTestCase):
         # Datestamp should have updated since records were deleted.
         self.assertTrue(Datestamp.get() > date)
 
+    def test_mark_many(self):
+        date = datetime(1970, 1, 1, 0, 0, 0)
+        fmt = make_format('oai_dc')
+        for identifier in ['i1', 'i2', 'i3']:
+            Item.create(identifier)
+            Record.create(identifier, 'oai_dc', make_xml(fmt))
+        DBSession.query(Datestamp).one().datestamp = date
+
+        Item.mark_many_as_deleted(['i1', 'i3'])
+
+        self.assertEqual(Item.list_identifiers(),
+                         {'i1': True, 'i2': False, 'i3': True})
+        self.assertEqual(
+            [r.identifier for r in Record.list(ignore_deleted=True)],
+            ['i2']
+        )
+        self.assertTrue(Datestamp.get() > date)
+
+
+class TestHarvestTimes(ModelTestCase):
+
+    def setUp(self):
+        super(TestHarvestTimes, self).setUp()
+        self.time = datetime(2014, 1, 1, 0, 0, 0)
+        for identifier in ['i1', 'i2', 'i3']:
+            Item.create(identifier)
+
+    def test_mark_harvested(self):
+        self.assertFalse(Item.any_harvested())
+        Item.mark_harvested(['i1', 'i3'], self.time)
+        self.assertTrue(Item.any_harvested())
+        self.assertEqual(
+            Item.list_harvest_times(['i1', 'i2', 'i3', 'unknown']),
+            {'i1': self.time, 'i3': self.time},
+        )
+
+    def test_deleted_items(self):
+        """Deleted and undeleted items should be harvested again."""
+        Item.mark_harvested(['i1', 'i2', 'i3'], self.time)
+        Item.mark_many_as_deleted(['i1'])
+        Item.get('i2').mark_as_deleted()
+        Item.create_or_update('i2')
+        self.assertEqual(Item.list_harvest_times(['i1', 'i2', 'i3']),
+                         {'i3': self.time})
+        Item.mark_harvested(['i1'], self.time)
+        Item.undelete_many(['i1'])
+        self.assertEqual(Item.list_harvest_times(['i1', 'i2', 'i3']),
+                         {'i3': self.time})
+
 
 class TestCreateFormat(ModelTestCase):
 
@@ -395,6 +480,28 @@ class TestCreateRecord(ModelTestCase):
         self.assertIn('non-existent identifier', str(cm.exception))
         self.assertIn('item', str(cm.exception))
 
+    def test_loaded_objects_not_queried(self):
+        """Formats and items found before should not be queried."""
+        xml = make_xml(make_format('ead'))
+        Item.create('id1')
+        Item.create('id2')
+        DBSession.flush()
+        Record.create('id1', 'ead', xml)
+        # Loaded like by the first record of the item.
+        Item.get('id2')
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+        sa.event.listen(self.engine, 'before_cursor_execute', count)
+        self.addCleanup(sa.event.remove, self.engine,
+                        'before_cursor_execute', count)
+
+        Record.create('id2', 'ead', xml)
+        self.assertEqual(statements, [])
+
 
 class TestListRecords(ModelTestCase):
 
@@ -543,6 +650,180 @@ class TestListRecords(ModelTestCase):
             self.records[0:3]
         )
 
+    def test_end_offset(self):
+        self.assertCountEqual(
+            Record.list(offset='item1', end_offset='item3'),
+            self.records[0:3]
+        )
+
+    def test_iterate(self):
+        for batch_size in [1, 2, 100]:
+            records = Record.iterate(batch_size=batch_size,
+                                     ignore_deleted=True)
+            self.assertEqual(list(records), self.records[0:3])
+        self.assertEqual(
+            list(Record.iterate(metadata_prefix='fmt1', offset='item2')),
+            [self.records[2]]
+        )
+
+    def test_identifier_at(self):
+        self.assertEqual(Record.identifier_at(0), 'item1')
+        self.assertEqual(Record.identifier_at(2), 'item2')
+        self.assertEqual(
+            Record.identifier_at(1, metadata_prefix='fmt1'),
+            'item2'
+        )
+        self.assertIsNone(Record.identifier_at(4))
+
+    def test_headers_only(self):
+        """The XML data should not be loaded."""
+        DBSession.flush()
+        DBSession.expunge_all()
+        records = Record.list(metadata_prefix='fmt1', headers_only=True)
+        self.assertEqual(
+            [(r.identifier, r.prefix) for r in records],
+            [('item1', 'fmt1'), ('item2', 'fmt1')]
+        )
+        with self.assertRaises(exc.InvalidRequestError):
+            records[0].xml
+
+
+class TestRecordSetSpecs(ModelTestCase):
+
+    def setUp(self):
+        super(TestRecordSetSpecs, self).setUp()
+        fmt = make_format('oai_dc')
+        a = Set.create('a', 'Set A')
+        ab = Set.create('a:b', 'Set B')
+        c = Set.create('c', 'Set C')
+        for identifier, sets in [('item1', [a, ab, c]),
+                                 ('item2', [a]),
+                                 ('item3', [])]:
+            Item.create(identifier)
+            Item.change_sets(identifier, [set_.spec for set_ in sets], [])
+            Record.create(identifier, 'oai_dc', make_xml(fmt))
+
+    def test_parent_sets_excluded(self):
+        records = DBSession.query(Record).order_by(Record.identifier).all()
+        self.assertCountEqual(records[0].set_specs, ['a:b', 'c'])
+        self.assertEqual(records[1].set_specs, ['a'])
+        self.assertEqual(records[2].set_specs, [])
+
+    def test_list_loads_set_specs(self):
+        """Set specs should be available without further queries."""
+        records = Record.list(metadata_prefix='oai_dc')
+        with mock.patch.object(DBSession, 'query') as query_mock:
+            specs = dict((r.identifier, r.set_specs) for r in records)
+        self.assertEqual(query_mock.mock_calls, [])
+        self.assertCountEqual(specs['item1'], ['a:b', 'c'])
+        self.assertEqual(specs['item2'], ['a'])
+        self.assertEqual(specs['item3'], [])
+
+
+class TestRecordFragments(ModelTestCase):
+
+    def setUp(self):
+        super(TestRecordFragments, self).setUp()
+        fmt = make_format('oai_dc')
+        self.set_ = Set.create('a', 'Set A')
+        for identifier in ['item1', 'item2']:
+            Item.create(identifier)
+            record = Record.create(identifier, 'oai_dc', make_xml(fmt))
+            record.fragment = b'<record/>'
+
+    def get_record(self, identifier):
+        return DBSession.query(Record).filter_by(identifier=identifier).one()
+
+    def test_update_clears_fragment(self):
+        record = self.get_record('item1')
+        record.update(record.xml.replace('Test Record', 'Changed'))
+        self.assertIsNone(record.fragment)
+        self.assertIsNotNone(self.get_record('item2').fragment)
+
+    def test_delete_clears_fragment(self):
+        Record.mark_as_deleted(identifier='item1')
+        DBSession.expire_all()
+        self.assertIsNone(self.get_record('item1').fragment)
+        self.assertIsNotNone(self.get_record('item2').fragment)
+
+    def test_clear_fragments(self):
+        Record.clear_fragments('item1')
+        DBSession.expire_all()
+        self.assertIsNone(self.get_record('item1').fragment)
+        self.assertIsNotNone(self.get_record('item2').fragment)
+        Record.clear_fragments()
+        DBSession.expire_all()
+        self.assertIsNone(self.get_record('item2').fragment)
+
+    def test_list_without_fragment(self):
+        self.assertEqual(Record.list_without_fragment(10), [])
+        Record.clear_fragments()
+        Item.change_sets('item1', ['a'], [])
+        records = Record.list_without_fragment(1)
+        self.assertEqual([r.identifier for r in records], ['item1'])
+        with mock.patch.object(DBSession, 'query') as query_mock:
+            self.assertEqual(records[0].set_specs, ['a'])
+        self.assertEqual(query_mock.mock_calls, [])
+
+    def test_iterate_fragments(self):
+        """Set specs should only be loaded for records without a
+        fragment."""
+        Record.clear_fragments('item2')
+        DBSession.expire_all()
+        with mock.patch.object(Record, 'load_set_specs') as load_mock:
+            records = list(Record.iterate(fragments=True))
+        self.assertEqual([r.identifier for r in records],
+                         ['item1', 'item2'])
+        self.assertEqual(records[0].fragment, b'<record/>')
+        loaded = [r.identifier
+                  for call in load_mock.call_args_list
+                  for r in call[0][0]]
+        self.assertEqual(loaded, ['item2'])
+
+    def test_iterate_fragments_loads_xml_in_batch(self):
+        """XML data should be loaded with one query per batch."""
+        fmt = DBSession.query(Format).filter_by(prefix='oai_dc').one()
+        for i in range(20):
+            Item.create('new%02d' % i)
+            Record.create('new%02d' % i, 'oai_dc', make_xml(fmt))
+        DBSession.flush()
+        DBSession.expire_all()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+        sa.event.listen(self.engine, 'before_cursor_execute', count)
+        self.addCleanup(sa.event.remove, self.engine,
+                        'before_cursor_execute', count)
+
+        records = list(Record.iterate(fragments=True))
+        xml = [r.xml for r in records if r.fragment is None]
+        self.assertEqual(len(xml), 20)
+        self.assertTrue(all(xml))
+        # Records, their XML data and their set specs.
+        self.assertEqual(len(statements), 3)
+
+    def test_change_sets(self):
+        Set.create('b', 'Set B')
+        Item.change_sets('item1', ['a'], [])
+        DBSession.flush()
+        time = datetime(2100, 1, 1, 0, 0, 0)
+        with mock.patch('kuha.models.datestamp_now', return_value=time):
+            Item.change_sets('item1', ['b'], ['a'])
+        self.assertEqual(Datestamp.get(), time)
+        self.assertEqual(Item.list_set_specs(['item1', 'item2']),
+                         {'item1': {'b'}})
+        DBSession.expire_all()
+        self.assertIsNone(self.get_record('item1').fragment)
+        self.assertIsNotNone(self.get_record('item2').fragment)
+
+    def test_sets_not_changed(self):
+        Item.change_sets('item1', [], [])
+        DBSession.expire_all()
+        self.assertIsNotNone(self.get_record('item1').fragment)
+
 
 class TestUpdateRecords(ModelTestCase):
 
@@ -598,6 +879,96 @@ class TestUpdateRecords(ModelTestCase):
         with self.assertRaises(XMLSyntaxError):
             r.update('<test:dc><invalid xml/')
 
+    def test_digest(self):
+        Item.create('item')
+        f = make_format('oai_dc')
+        data = make_xml(f)
+        record = Record.create('item', 'oai_dc', data)
+        self.assertEqual(record.digest, Record.make_digest(data))
+        self.assertEqual(len(record.digest), 40)
+        self.assertIsNone(Record.make_digest(None))
+        self.assertEqual(Record.make_digest(data.encode('utf-8')),
+                         record.digest)
+
+        modified_data = data.replace('Test Record', 'Changed')
+        record.update(modified_data)
+        self.assertEqual(record.digest, Record.make_digest(modified_data))
+
+    def test_unchanged_data_not_loaded(self):
+        """The old data should not be loaded if the digest matches."""
+        Item.create('item')
+        data = make_xml(make_format('oai_dc'))
+        Record.create('item', 'oai_dc', data)
+        DBSession.flush()
+        DBSession.expunge_all()
+
+        record = Record.create_or_update('item', 'oai_dc', data)
+        self.assertIn('xml', sa.inspect(record).unloaded)
+
+    def test_validation_status(self):
+        Item.create('item')
+        data = make_xml(make_format('oai_dc'))
+        record = Record.create('item', 'oai_dc', data, valid=False)
+        self.assertIs(record.valid, False)
+
+        # The status of unchanged data is kept unless it is given.
+        record.update(data)
+        self.assertIs(record.valid, False)
+        record.update(data.replace('Test Record', 'Changed'), valid=True)
+        self.assertIs(record.valid, True)
+        record.update(data)
+        self.assertIsNone(record.valid)
+
+    def test_validate_unchanged_record(self):
+        """Validating unchanged data should not change the record."""
+        time = datetime(1970, 1, 1, 0, 0, 0)
+        Item.create('item')
+        data = make_xml(make_format('oai_dc'))
+        record = Record.create('item', 'oai_dc', data, time)
+
+        record.update(data, valid=True)
+        self.assertIs(record.valid, True)
+        self.assertEqual(record.datestamp, time)
+
+    def test_record_without_digest(self):
+        """Digests of records from older versions should be filled in
+        without changing the records."""
+        time = datetime(1970, 1, 1, 0, 0, 0)
+        Item.create('item')
+        data = make_xml(make_format('oai_dc'))
+        record = Record.create('item', 'oai_dc', data, time)
+        record.digest = None
+
+        record.update(data)
+        self.assertEqual(record.digest, Record.make_digest(data))
+        self.assertEqual(record.datestamp, time)
+
+    def test_list_digests(self):
+        f = make_format('oai_dc')
+        data = make_xml(f)
+        for identifier in ['i1', 'i2', 'i3', 'i4']:
+            Item.create(identifier)
+            Record.create(identifier, 'oai_dc', data)
+        Record.mark_as_deleted(identifier='i2')
+        DBSession.query(Record).filter_by(identifier='i3').one().digest = None
+
+        self.assertEqual(
+            Record.list_digests(['i1', 'i2', 'i3', 'unknown']),
+            {('i1', 'oai_dc'): Record.make_digest(data)},
+        )
+
+    def test_list_validated_digests(self):
+        data = make_xml(make_format('oai_dc'))
+        Item.create('i1')
+        Item.create('i2')
+        Record.create('i1', 'oai_dc', data, valid=False)
+        Record.create('i2', 'oai_dc', data)
+
+        self.assertEqual(
+            Record.list_digests(['i1', 'i2'], validated=True),
+            {('i1', 'oai_dc'): Record.make_digest(data)},
+        )
+
 
 class TestDeleteRecords(ModelTestCase):
 
@@ -643,6 +1014,30 @@ class TestDatestamp(ModelTestCase):
         Datestamp.update()
         self.assertEqual(len(DBSession.query(Datestamp).all()), 1)
 
+    def test_changes_in_same_second(self):
+        """Every change should increment the version, and the datestamp
+        should stay at the current time."""
+        time = datetime(2026, 10, 16, 23, 18, 59)
+        with mock.patch.object(models, 'datestamp_now', return_value=time):
+            Item.create('item')
+            Datestamp.update()
+            self.assertEqual(Datestamp.get_with_version(), (time, 1))
+            Set.create('a', 'Set A')
+            self.assertEqual(Datestamp.get_with_version(), (time, 2))
+            Set.create('b', 'Set B')
+            self.assertEqual(Datestamp.get_with_version(), (time, 3))
+
+    def test_version_of_old_database(self):
+        """Datestamps stored without a version should be counted from
+        the first change."""
+        time = datetime(2026, 10, 16, 23, 18, 59)
+        DBSession.add(Datestamp(time))
+        DBSession.flush()
+        DBSession.query(Datestamp).update({'version': None})
+        self.assertEqual(Datestamp.get_with_version(), (time, None))
+        Set.create('a', 'Set A')
+        self.assertEqual(Datestamp.get_with_version()[1], 1)
+
     def test_datestamp_changes(self):
         """Datestamp should change whenever tokens could be invalidated."""
         second = timedelta(seconds=1)
@@ -702,6 +1097,42 @@ class TestDatestamp(ModelTestCase):
         self.assertEqual(Datestamp.get(), date_mock.return_value)
 
 
+    def test_metadata_changes(self):
+        """Datestamp should change when formats or sets change."""
+        second = timedelta(seconds=1)
+        date_mock = mock.Mock(return_value=datetime(1988,5,14, 9,29,2))
+
+        with mock.patch.object(models, 'datestamp_now', date_mock):
+            Format.create_or_update('a', 'urn:a', 'a.xsd')
+            Set.create_or_update('s', 'Set S')
+        self.assertEqual(Datestamp.get(), date_mock.return_value)
+
+        # Datestamp does not change when nothing changes.
+        old_date = date_mock.return_value
+        date_mock.return_value += second
+        with mock.patch.object(models, 'datestamp_now', date_mock):
+            Format.create_or_update('a', 'urn:a', 'a.xsd')
+            Set.create_or_update('s', 'Set S')
+        self.assertEqual(Datestamp.get(), old_date)
+
+        # Datestamp changes when a set is renamed.
+        with mock.patch.object(models, 'datestamp_now', date_mock):
+            Set.create_or_update('s', 'New Name')
+        self.assertEqual(Datestamp.get(), date_mock.return_value)
+
+        # Datestamp changes when a format is deleted.
+        date_mock.return_value += second
+        with mock.patch.object(models, 'datestamp_now', date_mock):
+            Format.list()[0].mark_as_deleted()
+        self.assertEqual(Datestamp.get(), date_mock.return_value)
+
+        # Datestamp changes when a deleted format is restored.
+        date_mock.return_value += second
+        with mock.patch.object(models, 'datestamp_now', date_mock):
+            Format.create_or_update('a', 'urn:a', 'a.xsd')
+        self.assertEqual(Datestamp.get(), date_mock.return_value)
+
+
 class TestEarliestDatestamp(ModelTestCase):
 
     def test_has_earliest(self):
@@ -745,6 +1176,42 @@ class TestEarliestDatestamp(ModelTestCase):
             dates[1]
         )
 
+    def test_stored_earliest(self):
+        """The earliest datestamp should be stored when records are
+        created."""
+        dates = [
+            datetime(2014, 3, 21, 13, 38, 00),
+            datetime(2014, 3, 21, 13, 37, 59),
+            datetime(2014, 3, 21, 13, 38, 10),
+        ]
+        f = Format.create('test', 'ns', 'schema.xsd')
+        for i in range(0, 3):
+            id_ = 'item{0}'.format(i)
+            Item.create(id_)
+            Record.create(id_, 'test', make_xml(f), dates[i])
+        # Write the datestamp.
+        Datestamp.get()
+
+        with mock.patch.object(Record, 'earliest_datestamp') as mock_func:
+            datestamp, earliest = Datestamp.get_with_earliest()
+        self.assertEqual(earliest, dates[1])
+        self.assertEqual(datestamp, Datestamp.get())
+        self.assertFalse(mock_func.called)
+
+    def test_not_stored_earliest(self):
+        """Should fall back to querying the records if the earliest
+        datestamp is not stored."""
+        date = datetime(2014, 3, 21, 13, 38, 00)
+        f = Format.create('test', 'ns', 'schema.xsd')
+        Item.create('item')
+        Record.create('item', 'test', make_xml(f), date)
+        DBSession.query(Datestamp).one().earliest = None
+
+        self.assertEqual(Datestamp.get_with_earliest()[1], date)
+
+    def test_no_datestamp(self):
+        self.assertEqual(Datestamp.get_with_earliest(), (None, None))
+
 
 class TestPurgeDeleted(ModelTestCase):
 
@@ -772,36 +1239,6 @@ class TestPurgeDeleted(ModelTestCase):
         self.assertEqual(DBSession.query(Record).all(), [existing])
 
 
-class TestItemSetAssociations(ModelTestCase):
-
-    def test_add_and_clear(self):
-        i = Item.create('asdasd')
-        s1 = Set.create('spec', 'Set Name')
-        s2 = Set.create('spec2', 'Set Name II')
-        i.add_to_set(s1)
-        # Trying to add twice to the same set should not do anything.
-        i.add_to_set(s1)
-        self.assertEqual(
-            (DBSession.query(Item).join(Item.sets)
-                                  .filter(Set.spec=='spec')
-                                  .all()),
-            [i]
-        )
-        self.assertEqual(
-            (DBSession.query(Item).join(Item.sets)
-                                  .filter(Set.spec=='spec2')
-                                  .all()),
-            []
-        )
-
-        i.clear_sets()
-        self.assertEqual(
-            (DBSession.query(Item).join(Item.sets)
-                                  .filter(Set.spec=='spec')
-                                  .all()),
-            []
-        )
-
 class TestSets(ModelTestCase):
 
     def test_create_set(self):
@@ -837,3 +1274,175 @@ class TestSets(ModelTestCase):
             [(s.spec, s.name) for s in Set.list()],
             [('a', 'Set A'), ('b', 'Set B'), ('b:c', 'Set C')]
         )
+        self.assertEqual(Set.list_names(),
+                         {'a': 'Set A', 'b': 'Set B', 'b:c': 'Set C'})
+
+    def test_create_many(self):
+        Set.create_many([('a', 'Set A'), ('a:b', 'Set B')])
+        Set.create_many([])
+        self.assertEqual(Set.list_names(), {'a': 'Set A', 'a:b': 'Set B'})
+        self.assertRaises(ValueError, Set.create_many,
+                          [('c', 'Set C'), ('abcd:', 'Invalid')])
+        self.assertNotIn('c', Set.list_names())
+
+    def test_rename(self):
+        Set.create('a', 'Set A')
+        Set.rename('a', 'New Name')
+        self.assertEqual(Set.list_names(), {'a': 'New Name'})
+
+
+class TestSchemaUpgrade(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+
+    def index_names(self):
+        inspector = sa.inspect(self.engine)
+        return set(
+            index['name']
+            for table in inspector.get_table_names()
+            for index in inspector.get_indexes(table)
+        )
+
+    def test_create_missing_indexes(self):
+        """Indexes should be added to an existing database."""
+        with self.engine.begin() as connection:
+            connection.execute(sa.text(
+                'CREATE TABLE records (identifier VARCHAR, '
+                'prefix VARCHAR, datestamp DATETIME, xml TEXT, '
+                'deleted BOOLEAN)'
+            ))
+        models._Base.metadata.create_all(self.engine)
+        self.assertNotIn('ix_records_prefix_deleted_identifier',
+                         self.index_names())
+
+        models.create_missing_indexes(self.engine)
+        self.assertLessEqual(
+            {'ix_records_prefix_deleted_identifier',
+             'ix_records_prefix_datestamp_identifier',
+             'ix_item_set_association_set_item',
+             'ix_item_set_association_item_set'},
+            self.index_names()
+        )
+
+    def test_create_missing_columns(self):
+        """Nullable columns should be added to an existing database."""
+        with self.engine.begin() as connection:
+            connection.execute(sa.text(
+                'CREATE TABLE datestamp (datestamp DATETIME PRIMARY KEY)'
+            ))
+        models._Base.metadata.create_all(self.engine)
+        models.create_missing_columns(self.engine)
+
+        columns = sa.inspect(self.engine).get_columns('datestamp')
+        self.assertEqual([c['name'] for c in columns],
+                         ['datestamp', 'earliest', 'version'])
+
+    def test_indexes_exist(self):
+        """Existing indexes should be left alone."""
+        models._Base.metadata.create_all(self.engine)
+        names = self.index_names()
+        models.create_missing_indexes(self.engine)
+        self.assertEqual(self.index_names(), names)
+
+    def test_in_memory_engine(self):
+        """An in-memory SQLite database should be set up."""
+        DBSession.remove()
+        self.addCleanup(DBSession.remove)
+        models.create_engine({'sqlalchemy.url': 'sqlite://'})
+        Item.create('item')
+        models.commit()
+        self.assertEqual(Item.list_identifiers(), {'item': False})
+        models.rollback()
+
+
+class TestDiscardInheritedConnections(unittest.TestCase):
+
+    def setUp(self):
+        DBSession.remove()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        models.create_engine({'sqlalchemy.url': 'sqlite:///{0}'.format(
+            os.path.join(directory, 'test.sqlite'))})
+        self.addCleanup(DBSession.remove)
+
+    def test_connections_left_open(self):
+        Item.create('item')
+        DBSession.flush()
+        session = DBSession()
+        engine = session.get_bind()
+        pool = engine.pool
+        self.addCleanup(models.rollback)
+
+        models.discard_inherited_connections()
+        self.assertIsNot(engine.pool, pool)
+        self.assertIsNot(DBSession(), session)
+        # The transaction of the parent is not rolled back.
+        self.assertTrue(session.in_transaction())
+        self.assertEqual(session.query(Item.identifier).all(), [('item',)])
+
+
+class TestSavepoint(unittest.TestCase):
+
+    def setUp(self):
+        DBSession.remove()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        models.create_engine({'sqlalchemy.url': 'sqlite:///{0}'.format(
+            os.path.join(directory, 'test.sqlite'))})
+        self.addCleanup(DBSession.remove)
+
+    def test_release_does_not_commit(self):
+        with models.savepoint():
+            Item.create('item')
+        models.rollback()
+        self.assertEqual(Item.list_identifiers(), {})
+
+    def test_rollback_to_savepoint(self):
+        Item.create('kept')
+        with self.assertRaises(ValueError):
+            with models.savepoint():
+                Item.create('removed')
+                raise ValueError('failed')
+        models.commit()
+        self.assertEqual(Item.list_identifiers(), {'kept': False})
+        models.rollback()
+
+    def test_commit_bulk_insert(self):
+        Item.create_many(['item'])
+        models.commit()
+        self.assertEqual(Item.list_identifiers(), {'item': False})
+        models.rollback()
+
+    def test_datestamp_written_once(self):
+        """The datestamp should be written once when committing."""
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith(('INSERT INTO datestamp',
+                                     'UPDATE datestamp')):
+                statements.append(statement)
+        engine = DBSession.get_bind()
+        sa.event.listen(engine, 'before_cursor_execute', count)
+        self.addCleanup(sa.event.remove, engine, 'before_cursor_execute',
+                        count)
+
+        format_ = Format.create('test', 'urn:test', 'test.xsd')
+        for i in range(3):
+            Item.create('item{0}'.format(i))
+            with models.savepoint():
+                Record.create('item{0}'.format(i), 'test',
+                              make_xml(format_),
+                              datetime(2014, 1, 1 + i))
+        self.assertEqual(statements, [])
+        models.commit()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(Datestamp.get_with_earliest()[1],
+                         datetime(2014, 1, 1))
+        models.rollback()
+
+    def test_datestamp_discarded_on_rollback(self):
+        Datestamp.update()
+        models.rollback()
+        self.assertIsNone(Datestamp.get())
+        models.rollback()